@@ -1,25 +1,37 @@
-import datetime
 import random
-from time import sleep
 
+from cloud.clock import clock_from_env, sleep
+from cloud.placement import PlacementIndex
 from cloud.reservation_maker import ReservationMaker
-from cloud.constants import NUMBER_OF_SPOTS
-from cloud.models import CurrentSpotState, ReservationStatus, CurrentElectricityState
+from cloud.constants import NUMBER_OF_SPOTS, STATION_LOCATIONS
+from cloud.instrumentation import get_instrumentation
+from cloud.models import CurrentSpotState, ReservationStatus, CurrentElectricityState, transaction, release_session
+from cloud.timeutil import utcnow
+
+metrics = get_instrumentation("cloud_application")
 
 
 def initialize_spot_states_if_none():
-    current_states = CurrentSpotState.get_current_states()
-    if not current_states:
-        for spot_id in range(0, NUMBER_OF_SPOTS):
-            CurrentSpotState(spot_id=spot_id).make_inital_entry()
+    # stations not configured in STATION_LOCATIONS are added by the server once they send data
+    for station_id in STATION_LOCATIONS:
+        CurrentSpotState.initialize_spots(station_id, range(0, NUMBER_OF_SPOTS))
+        CurrentElectricityState.initialize(station_id)
+
+
+def random_user_location():
+    """Simulates a user within roughly 2 km of a random station."""
+    latitude, longitude = STATION_LOCATIONS[random.choice(list(STATION_LOCATIONS))]
+    return latitude + random.uniform(-0.02, 0.02), longitude + random.uniform(-0.03, 0.03)
 
 
 def display_spots_state():
     # update expired reservations before displaying
-    CurrentSpotState.update_all_expired_reservations()
+    with metrics.timer("commit_expired"), transaction():
+        CurrentSpotState.update_all_expired_reservations()
     print("\n \n---------------------------------------- Station State ---------------------------------------------------------------")
     print(
-        "{:<12} | {:<8} | {:<18} | {:<21} |  {:<14} | {:<9}".format(
+        "{:<8} | {:<12} | {:<8} | {:<18} | {:<21} |  {:<14} | {:<9}".format(
+            "Station",
             "Spot ID",
             "Occupied",
             "Bike Battery Level",
@@ -28,15 +40,19 @@ def display_spots_state():
             "Remaining",
         )
     )
-    for spot_state in CurrentSpotState.get_current_states():
+    with metrics.timer("db_query"):
+        spot_states = CurrentSpotState.get_current_states()
+    now = utcnow()
+    for spot_state in spot_states:
         remaining_time = None
         if spot_state.reservation_valid_from is not None and spot_state.reservation_duration is not None:
             remaining_time = int(
                         spot_state.reservation_duration -
-                        (datetime.datetime.utcnow() - spot_state.reservation_valid_from).total_seconds()
+                        (now - spot_state.reservation_valid_from).total_seconds()
                 )
         print(
-            "{:<12} | {:<8} | {:<18} | {:<21} | {:<14} | {:<9}".format(
+            "{:<8} | {:<12} | {:<8} | {:<18} | {:<21} | {:<14} | {:<9}".format(
+                str(spot_state.station_id),
                 str(spot_state.spot_id),
                 str(spot_state.is_occupied),
                 "" if not spot_state.battery_level else str(round(spot_state.battery_level * 100, 2)),
@@ -47,11 +63,14 @@ def display_spots_state():
         )
 
 def display_electricity_state():
-    electricity_state = CurrentElectricityState.get_current_state()
+    with metrics.timer("db_query"):
+        station_ids = CurrentSpotState.get_station_ids()
+        electricity_states = [CurrentElectricityState.get_current_state(station_id) for station_id in station_ids]
     print(
         "\n-------------------------- Current Electricity info -----------------------------------------------------------")
     print(
-        "{:<10} | {:<16} | {:<18} | {:<14} | {:<16}".format(
+        "{:<8} | {:<10} | {:<16} | {:<18} | {:<14} | {:<16}".format(
+            "Station",
             "Production",
             "Self-consumption",
             "Consumption saving",
@@ -59,27 +78,37 @@ def display_electricity_state():
             "Feed-In Revenue",
         )
     )
-    print(
-        "{:<10} | {:<16} | {:<18} | {:<14} | {:<16} \n".format(
-            electricity_state.production,
-            electricity_state.self_consumption,
-            electricity_state.consumption_saving,
-            electricity_state.feed_in,
-            electricity_state.feed_in_revenue,
+    for electricity_state in electricity_states:
+        if electricity_state is None:
+            continue
+        print(
+            "{:<8} | {:<10} | {:<16} | {:<18} | {:<14} | {:<16}".format(
+                electricity_state.station_id,
+                electricity_state.production,
+                electricity_state.self_consumption,
+                electricity_state.consumption_saving,
+                electricity_state.feed_in,
+                electricity_state.feed_in_revenue,
+            )
         )
-    )
+    print()
 
 
 if __name__ == "__main__":
-    CurrentElectricityState().save_or_update()  # initialize electricity state
-    initialize_spot_states_if_none()
+    clock_from_env()
+    initialize_spot_states_if_none()  # initialize spot and electricity states
+    placement_index = PlacementIndex()
     while True:
         # Display current station state known to cloud component
         display_electricity_state()
         display_spots_state()
-        reservable_spots = CurrentSpotState.get_reservable_spots()
-        if not reservable_spots:
+        with metrics.timer("placement_refresh"):
+            placement_index.refresh()
+        metrics.gauge("reservable_spots", placement_index.number_of_reservable_spots)
+        if not placement_index.number_of_reservable_spots:
             print("No spots to reserve..")
+            release_session()
+            metrics.end_cycle()
             sleep(5)
             continue
 
@@ -88,19 +117,29 @@ if __name__ == "__main__":
         if reserve_spot:
             print("\n----------------------------------- Creating Reservation ---------------------------------------------------------")
 
-            # randomly choose one of the reservable spots and a duration time
-            spot = reservable_spots[random.randint(0, len(reservable_spots)-1)]
+            # choose the best spot for a user randomly located around a station and a random duration time
+            user_location = random_user_location()
+            with metrics.timer("placement_query"):
+                station_id, spot_id = placement_index.best_spot(user_location)
+            spot = CurrentSpotState.get_spot_state(station_id, spot_id)
             duration = random.randint(20, 50)  # Should be (5 min, 15 min) in reality but (20, 50) is better for demo
-            reservation_id = ReservationMaker.make_reservation(spot, duration=duration)
+            with metrics.timer("commit"), transaction():
+                reservation_id = ReservationMaker.make_reservation(spot, duration=duration)
+            placement_index.apply_spot_state(spot)
+            metrics.count("reservations")
             print(
-                "{:<12} | {:<14} | {:<20} \n {:<12} | {:<14} | {:<20}".format(
+                "{:<8} | {:<12} | {:<14} | {:<20} \n {:<8} | {:<12} | {:<14} | {:<20}".format(
+                    "Station",
                     "Spot ID",
                     "Reservation ID",
                     "Reservation Duration",
+                    spot.station_id,
                     spot.spot_id,
                     reservation_id,
                     duration,
                 )
             )
+        release_session()
+        metrics.end_cycle()
         sleep(2)
 
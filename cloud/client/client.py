@@ -2,75 +2,102 @@ import json
 import os, itertools
 import logging
 import random
-from time import sleep
 
 import zmq
 from dotenv import load_dotenv
 
-from cloud.models import ReservationRequest
+from cloud.clock import clock_from_env, sleep
+from cloud.compression import Codec, compression_enabled
+from cloud.connection import ReliableRequester
+from cloud.constants import DEFAULT_STATION_ID
+from cloud.models import ReservationRequest, transaction, release_session
+from cloud.instrumentation import get_instrumentation
+from cloud.recorder import get_recorder_from_env, CLOUD_TO_EDGE
+from cloud.timeutil import json_default
 
 load_dotenv()
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-REQUEST_TIMEOUT = 2500
 MAX_NUMBER_OF_RETRIES = 5
-server_url = os.getenv("server_address")
 context = zmq.Context()
+recorder = get_recorder_from_env()  # records outgoing traffic for replay, if enabled
+metrics = get_instrumentation("cloud_client")
 
-logging.info("Connecting to server...")
-client = context.socket(zmq.REQ)
-client.connect(server_url)
 
-for sequence in itertools.count():
-    sleep(3)
-    current_electricity_price_per_kwh = round(random.uniform(0.27, 0.68), 4)
-    pending_reservations = ReservationRequest.get_pending_reservations()
-    reservations_dict = ReservationRequest.make_query_dictionary(pending_reservations)
+def get_station_urls():
+    """Server addresses of the stations: station_addresses="0=tcp://<ip>:5555,1=tcp://<ip>:5555" in .env,
+    a single station at server_address otherwise.
+    """
+    station_addresses = os.getenv("station_addresses")
+    if not station_addresses:
+        return {DEFAULT_STATION_ID: os.getenv("server_address")}
+    station_urls = {}
+    for station_address in station_addresses.split(","):
+        station_id, url = station_address.split("=", 1)
+        station_urls[int(station_id)] = url.strip()
+    return station_urls
 
-    message_dict = {
-        "current_market_price": current_electricity_price_per_kwh,
-        "reservations": reservations_dict,
+
+def get_current_market_price():
+    # the market price is the same for all stations
+    return round(random.uniform(0.27, 0.68), 4)
+
+
+def make_station_message(station_id, current_electricity_price_per_kwh, metrics):
+    """Returns the pending reservations of the station and the encoded message carrying them and the price."""
+    with metrics.timer("db_query"):
+        pending_reservations = ReservationRequest.get_pending_reservations(station_id)
+    metrics.count("reservations", len(pending_reservations))
+    with metrics.timer("serialize"):
+        reservations_dict = ReservationRequest.make_query_dictionary(pending_reservations)
+
+        message_dict = {
+            "station_id": station_id,
+            "current_market_price": current_electricity_price_per_kwh,
+            "reservations": reservations_dict,
+        }
+        encoded_message = json.dumps(message_dict, default=json_default).encode()
+    if recorder:
+        recorder.record(CLOUD_TO_EDGE, encoded_message)
+    return pending_reservations, encoded_message
+
+
+def mark_reservations_sent(reservation_ids, metrics):
+    # status of sent reservations need to be set to "processed"
+    with metrics.timer("commit"), transaction():
+        ReservationRequest.set_to_processed_by_ids(reservation_ids)
+
+
+def send_to_station(station_id, current_electricity_price_per_kwh):
+    """Sends market price and pending reservations to one station."""
+    pending_reservations, encoded_message = make_station_message(station_id, current_electricity_price_per_kwh, metrics)
+    logging.info(f"Sending current market price and open reservations to station {station_id}.")
+    reply = clients[station_id].request(encoded_message, max_attempts=MAX_NUMBER_OF_RETRIES)
+    if reply is None:
+        # give up to renew information (current is outdated)
+        logging.warning(f"Maximum retries reached for station {station_id}, fetch new data to send.")
+    elif reply.decode() == 'ok':
+        logging.info("Server replied OK")
+        mark_reservations_sent([reservation.reservation_id for reservation in pending_reservations], metrics)
+    else:
+        logging.error("Malformed reply from server: %s", reply)
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    station_urls = get_station_urls()
+    logging.info(f"Connecting to stations {list(station_urls)}...")
+    clients = {
+        station_id: ReliableRequester(
+            context, url, metrics, name=f"station_{station_id}", codec=Codec(compression_enabled(), metrics)
+        )
+        for station_id, url in station_urls.items()
     }
-    encoded_message = json.dumps(message_dict, default=str).encode()
-    logging.info("Sending current market price and open reservations.")
-
-    client.send(encoded_message)
-
-    retries = 0
-
-    while True:
-        if (client.poll(REQUEST_TIMEOUT) & zmq.POLLIN) != 0:
-            reply = client.recv()
-            #print(reply)
-            if reply.decode() == 'ok':  # sanity check with length of sent object
-                logging.info("Server replied OK")
-                # status of sent reservations need to be set to "processed"
-                for reservation in pending_reservations:
-                    reservation.set_to_processed()
-                break
-            else:
-                logging.error("Malformed reply from server: %s", reply)
-
-        # After MAX_NUMBER_OF_RETRIES of resend tries, break to renew information (current is outdated)
-        if retries > MAX_NUMBER_OF_RETRIES:
-            logging.warning("Maximum retries reached, fetch new data to send.")
-            # Socket is confused. Close and remove it.
-            client.setsockopt(zmq.LINGER, 0)
-            client.close()
-            logging.info("Reconnecting to server…")
-            # Create new connection
-            client = context.socket(zmq.REQ)
-            client.connect(server_url)
-            break
-        logging.warning("No response from server")
-        # Socket is confused. Close and remove it.
-        client.setsockopt(zmq.LINGER, 0)
-        client.close()
-        logging.info("Reconnecting to server…")
-        # Create new connection
-        client = context.socket(zmq.REQ)
-        client.connect(server_url)
-        logging.info("Resending (%s)", encoded_message)
-        client.send(encoded_message)
-        retries += 1
 
+    for sequence in itertools.count():
+        sleep(3)
+        current_electricity_price_per_kwh = get_current_market_price()
+        for station_id in station_urls:
+            send_to_station(station_id, current_electricity_price_per_kwh)
+        release_session()
+        metrics.end_cycle()
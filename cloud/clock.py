@@ -0,0 +1,135 @@
+"""The clock of the process, real or simulated.
+
+Everything that models station behaviour reads time through the installed clock: timeutil.now_ms(), utcnow()
+and monotonic(), and sleep() below. SystemClock is the wall clock. SimulatedClock starts at a chosen time and
+jumps forward on sleep() instead of waiting, so a day of station activity runs in seconds; with a seed the random
+sensor values and reservations are repeatable too. Networking (timeouts, retries, heartbeats), metrics and the
+compactor keep using real time, they are about the process rather than the simulated world.
+
+Every entry point installs the configured clock with clock_from_env(), but every process has a clock of its own:
+a simulated clock only moves while its process sleeps on it, so the clocks of different processes drift apart.
+A simulated run across tiers only makes sense if all of them share one clock_start and run at the same speed.
+Times that are compared with each other are therefore taken from one clock, e.g. the received time of a
+reservation request is stamped by the station that decides on it, not by the process storing the request.
+
+Configured through environment variables:
+    clock          "simulated" to run faster than real time (default: system)
+    clock_start    ISO 8601 start time of the simulated clock (default: now)
+    clock_seed     seed of the random number generator
+    clock_run_for  seconds of clock time after which the edge station stops (default: runs forever)
+"""
+import datetime
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+
+class SystemClock:
+    def time(self):
+        """Seconds since the unix epoch."""
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class SimulatedClock:
+    """Virtual time that only moves when it is slept on or advanced. Meant to be driven by one thread."""
+
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.start + self.elapsed
+
+    def monotonic(self):
+        return self.elapsed
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        if seconds > 0:
+            with self.lock:
+                self.elapsed += seconds
+
+
+class Scheduler:
+    """Runs callbacks at points in time of a clock, in time order.
+    Waiting for the next callback is a sleep on the clock, i.e. instant with a simulated clock.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or get_clock()
+        self.events = []  # heap of (due time, sequence number, callback, repeat interval)
+        self.sequence = itertools.count()
+
+    def call_at(self, when, callback, interval=None):
+        heapq.heappush(self.events, (when, next(self.sequence), callback, interval))
+
+    def call_later(self, delay, callback):
+        self.call_at(self.clock.monotonic() + delay, callback)
+
+    def call_every(self, interval, callback, delay=0):
+        """Runs callback every interval seconds, measured from the start of one call to the start of the next."""
+        self.call_at(self.clock.monotonic() + delay, callback, interval)
+
+    def run(self, duration=None):
+        """Runs due callbacks until no events are left or, if given, duration seconds of clock time have passed."""
+        end = None if duration is None else self.clock.monotonic() + duration
+        while self.events:
+            when, _, callback, interval = self.events[0]
+            if end is not None and when > end:
+                self.clock.sleep(max(0.0, end - self.clock.monotonic()))
+                return
+            heapq.heappop(self.events)
+            # overdue when the previous callback overran its slot
+            self.clock.sleep(max(0.0, when - self.clock.monotonic()))
+            callback()
+            if interval is not None:
+                # a callback running longer than its interval doesn't lead to a burst of catch-up calls
+                self.call_at(max(when + interval, self.clock.monotonic()), callback, interval)
+
+
+_clock = SystemClock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock, seed=None):
+    """Installs the clock of the process, seed makes the random values of the run repeatable."""
+    global _clock
+    _clock = clock
+    if seed is not None:
+        random.seed(seed)
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def clock_from_env():
+    """Installs the clock configured by the environment and returns it."""
+    seed = os.getenv("clock_seed")
+    if os.getenv("clock", "system") == "simulated":
+        start = os.getenv("clock_start")
+        if start:
+            start = datetime.datetime.fromisoformat(start)
+            if start.tzinfo is None:
+                start = start.replace(tzinfo=datetime.timezone.utc)
+            start = start.timestamp()
+        clock = SimulatedClock(start or None)
+    else:
+        clock = SystemClock()
+    set_clock(clock, None if seed is None else int(seed))
+    return clock
@@ -0,0 +1,111 @@
+"""Optional compression of the messages between edge and cloud, for stations on metered cellular links.
+
+Enable it with compression=zlib in the .env files. A framed message starts with one byte telling its encoding:
+    0x0a  uncompressed, a newline json parsers skip, so peers without compression read the message as it is
+    0x01  zlib
+    0x02  zlib with the preset dictionary, which holds the json keys of typical station messages
+Unframed messages (plain json, starting with "{") are still understood. Compression is negotiated per connection:
+a sender starts with uncompressed framed messages and compresses once the peer has answered with a framed reply,
+receivers always answer in the framing of the request. Messages below MIN_COMPRESSED_SIZE are never compressed.
+"""
+import json
+import os
+import zlib
+
+RAW = b"\n"  # json with a leading newline is still json, see above
+ZLIB = b"\x01"
+ZLIB_DICTIONARY = b"\x02"
+MIN_COMPRESSED_SIZE = 200  # bytes, smaller messages don't get smaller
+COMPRESSION_LEVEL = 6
+
+
+def _typical_messages():
+    """Messages like the ones stations and cloud exchange, the more frequent keys near the end.
+    Changing this changes the dictionary, which then needs a new encoding byte.
+    """
+    reading = {"datetime": 1625140800000, "reading_id": 1000, "is_occupied": True, "battery_level": 0.5}
+    electricity_item = {
+        "datetime": 1625140800000,
+        "production": 100,
+        "self_consumption": 50,
+        "consumption_saving": 0.02,
+        "feed_in": 50,
+        "feed_in_revenue": 0.02,
+    }
+    down = {
+        "station_id": 0,
+        "current_market_price": 0.4,
+        "reservations": {"1000": {"created_at": 1625140800000, "spot_id": 0, "duration": 60}},
+    }
+    up = {
+        "station_id": 0,
+        "number_of_spots": 5,
+        "sensor_data": {str(spot_id): [reading, reading] for spot_id in range(5)},
+        "rejected_reservations": [1000],
+        "confirmed_reservations": {"1000": 1625140800000},
+        "electricity_info": {"1000": electricity_item, "1001": electricity_item},
+    }
+    return json.dumps(down).encode() + json.dumps(up).encode()
+
+
+PRESET_DICTIONARY = _typical_messages()
+
+
+def compress(payload, dictionary=PRESET_DICTIONARY):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary)
+    return ZLIB_DICTIONARY + compressor.compress(payload) + compressor.flush()
+
+
+def decode(message):
+    """Returns the payload of a message and whether the message was framed."""
+    encoding = message[:1]
+    if encoding == RAW:
+        return message[1:], True
+    if encoding == ZLIB:
+        return zlib.decompress(message[1:]), True
+    if encoding == ZLIB_DICTIONARY:
+        decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+        return decompressor.decompress(message[1:]) + decompressor.flush(), True
+    # plain json of a peer without compression
+    return message, False
+
+
+def frame_like(reply, request_was_framed):
+    """Answers in the framing of the request, replies are too small to be compressed."""
+    return RAW + reply if request_was_framed else reply
+
+
+class Codec:
+    """Compression state of one connection, reports compression ratio and time spent compressing."""
+
+    def __init__(self, enabled, metrics, peer_accepts=False):
+        self.enabled = enabled
+        self.metrics = metrics
+        self.peer_accepts = peer_accepts
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+
+    def encode(self, payload):
+        if not self.enabled:
+            return payload
+        if not self.peer_accepts or len(payload) < MIN_COMPRESSED_SIZE:
+            return RAW + payload
+        with self.metrics.timer("compress"):
+            message = compress(payload)
+        self.uncompressed_bytes += len(payload)
+        self.compressed_bytes += len(message)
+        self.metrics.count("bytes_saved", len(payload) - len(message))
+        self.metrics.gauge("compression_ratio", round(self.uncompressed_bytes / self.compressed_bytes, 2))
+        return message
+
+    def decode(self, message):
+        with self.metrics.timer("decompress"):
+            payload, framed = decode(message)
+        if framed:
+            # the peer understands framed messages
+            self.peer_accepts = True
+        return payload
+
+
+def compression_enabled():
+    return os.getenv("compression", "none") == "zlib"
@@ -0,0 +1,199 @@
+"""Streaming export of the history tables (spot_state, electricity_data) to files for analysis.
+
+Every station's history is read in keyset pages in the order it was ingested, each page a short read of its own
+that is finished before its rows are written, so months of data are exported with bounded memory and without
+holding a lock on the live db. Files are partitioned by table, day and station:
+    <output>/<table>/date=<YYYY-MM-DD>/station_id=<id>/part-<first ingest key>.parquet   (if pyarrow is installed)
+    <output>/<table>/date=<YYYY-MM-DD>/station_id=<id>/part-<first ingest key>.csv.gz    (otherwise)
+A watermark file in the output directory records the last exported row of every table and station once the files
+holding it are complete, so running the export again only exports rows ingested since. That includes old readings
+a station uploads late, after an outage. An interrupted export rewrites the incomplete files.
+
+    python export.py exports/ [--format parquet|csv] [--tables spot_state electricity_data]
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+
+from sqlalchemy import inspect, select
+
+from cloud.models import SpotStateData, ElectricityData, storage
+from cloud.timeutil import UTC
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # optional, files are written as gzipped csv without it
+    pyarrow = None
+
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+# table -> (model, time column)
+EXPORT_TABLES = {
+    "spot_state": (SpotStateData, "sensor_reading_timestamp"),
+    "electricity_data": (ElectricityData, "data_timestamp"),
+}
+PAGE_SIZE = 20000  # rows per keyset query
+FETCH_SIZE = 2000  # rows written at once
+MAX_OPEN_PARTS = 32  # days written at the same time (rows ingested late mix days), checked between chunks
+WATERMARK_FILE = "_watermark.json"
+
+
+def _day_of(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(UTC)
+    return timestamp.date()
+
+
+class CsvPartWriter:
+    def __init__(self, path, table):
+        self.file = gzip.open(path, "wt", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(column.name for column in table.columns)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def _arrow_type(column):
+    python_type = column.type.python_type
+    if python_type is datetime.datetime:
+        return pyarrow.timestamp("us", tz="UTC")  # naive timestamps read from sqlite are UTC
+    return {int: pyarrow.int64(), float: pyarrow.float64(), bool: pyarrow.bool_()}.get(python_type, pyarrow.string())
+
+
+class ParquetPartWriter:
+    """Every chunk becomes a row group, so the file is written without collecting its rows first."""
+
+    def __init__(self, path, table):
+        self.schema = pyarrow.schema([(column.name, _arrow_type(column)) for column in table.columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression="zstd")
+
+    def write(self, rows):
+        names = self.schema.names
+        self.writer.write_table(pyarrow.Table.from_pylist([dict(zip(names, row)) for row in rows], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+FORMATS = {
+    "csv": (CsvPartWriter, ".csv.gz"),
+    "parquet": (ParquetPartWriter, ".parquet"),
+}
+
+
+class Watermark:
+    """Last exported ingest key per table and station, written atomically."""
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, WATERMARK_FILE)
+        try:
+            with open(self.path) as f:
+                self.keys = json.load(f)
+        except FileNotFoundError:
+            self.keys = {}
+
+    def get(self, table_name, station_id):
+        key = self.keys.get(f"{table_name}/{station_id}")
+        if isinstance(key, list):
+            # event time watermark of an earlier version, missed rows ingested late
+            logging.warning(f"Outdated watermark of {table_name} of station {station_id}, exporting all rows again.")
+            return None
+        return key
+
+    def set(self, table_name, station_id, key):
+        self.keys[f"{table_name}/{station_id}"] = key
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.keys, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def read_pages(station_id, table, after_key):
+    """Yields (rows, ingest keys) of a station ingested after after_key in chunks, in ingest order."""
+    engine = storage.get_history_engine(station_id)
+    if not inspect(engine).has_table(table.name):  # e.g. a shard of a station that never sent electricity data
+        return
+    ingest_key = storage.ingest_order(table)
+    while True:
+        query = select(*table.columns, ingest_key).where(table.c.station_id == station_id)
+        if after_key is not None:
+            query = query.where(ingest_key > after_key)
+        query = query.order_by(ingest_key).limit(PAGE_SIZE)
+        # the page is read completely before its rows are written, writing files while the read transaction is
+        # open would block ingest into the shard for as long
+        with engine.connect() as connection:
+            page = connection.execute(query).fetchall()
+        for start in range(0, len(page), FETCH_SIZE):
+            chunk = page[start:start + FETCH_SIZE]
+            yield [row[:-1] for row in chunk], [row[-1] for row in chunk]
+        if len(page) < PAGE_SIZE:
+            return
+        after_key = page[-1][-1]
+
+
+def export_station(output_dir, table_name, station_id, watermark, file_format):
+    """Exports the history rows of one station ingested since the last export, returns the number of rows."""
+    model, time_column = EXPORT_TABLES[table_name]
+    table = model.__table__
+    time_index = [column.name for column in table.columns].index(time_column)
+    writer_class, extension = FORMATS[file_format]
+    writers = {}  # day -> writer of the part of the day
+    last_key, exported = None, 0
+
+    def close_parts():
+        for writer in writers.values():
+            writer.close()
+        writers.clear()
+        # only complete files move the watermark
+        watermark.set(table_name, station_id, last_key)
+
+    for rows, keys in read_pages(station_id, table, watermark.get(table_name, station_id)):
+        if len(writers) >= MAX_OPEN_PARTS:
+            # all rows up to last_key are written, the watermark can move
+            close_parts()
+        rows_per_day = {}
+        for row, key in zip(rows, keys):
+            rows_per_day.setdefault(_day_of(row[time_index]), ([], key))[0].append(row)
+        for day, (day_rows, first_key) in rows_per_day.items():
+            writer = writers.get(day)
+            if writer is None:
+                directory = os.path.join(output_dir, table_name, f"date={day.isoformat()}", f"station_id={station_id}")
+                os.makedirs(directory, exist_ok=True)
+                writer = writer_class(os.path.join(directory, f"part-{first_key}{extension}"), table)
+                writers[day] = writer
+            writer.write(day_rows)
+            exported += len(day_rows)
+        last_key = keys[-1]
+    if writers:
+        close_parts()
+    return exported
+
+
+def export(output_dir, table_names=tuple(EXPORT_TABLES), file_format=None):
+    file_format = file_format or ("parquet" if pyarrow is not None else "csv")
+    if file_format == "parquet" and pyarrow is None:
+        raise ValueError("Parquet export requires pyarrow, install it or use --format csv")
+    os.makedirs(output_dir, exist_ok=True)
+    watermark = Watermark(output_dir)
+    for table_name in table_names:
+        for station_id in storage.get_history_station_ids():
+            exported = export_station(output_dir, table_name, station_id, watermark, file_format)
+            logging.info(f"Exported {exported} new rows of {table_name} of station {station_id}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the history tables partitioned by day and station.")
+    parser.add_argument("output", help="output directory, also holds the watermark of earlier exports")
+    parser.add_argument("--format", choices=FORMATS.keys(), help="default: parquet if pyarrow is installed, else csv")
+    parser.add_argument("--tables", nargs="+", choices=EXPORT_TABLES.keys(), default=list(EXPORT_TABLES))
+    args = parser.parse_args()
+    export(args.output, args.tables, args.format)
@@ -0,0 +1,113 @@
+"""Columnar decoding of the readings of an edge message for the ingest of the cloud server.
+
+The readings of a message are turned into columns once, instead of walking the nested dicts per reading several
+times: the latest state per spot is a group-by over the spot and timestamp columns, and the history rows for the
+bulk insert (executemany) are zipped from the columns without creating ORM objects. Timestamps are converted in
+one go instead of parsing each separately. With numpy installed the spot and timestamp columns are arrays and the
+group-by and timestamp conversion are vectorized, without it the same is done with plain lists.
+"""
+import itertools
+from operator import itemgetter
+
+from cloud.timeutil import UTC, from_epoch_ms, parse_timestamp, to_epoch_ms
+
+try:
+    import numpy
+except ImportError:  # optional, the columns are plain lists without it
+    numpy = None
+
+get_reading_id = itemgetter("reading_id")
+get_is_occupied = itemgetter("is_occupied")
+get_battery_level = itemgetter("battery_level")
+get_timestamp = itemgetter("datetime")
+
+
+def _to_epoch_ms(timestamps):
+    """Epoch ms of the timestamps of the wire, older versions of the edge send ISO 8601 strings."""
+    if any(isinstance(timestamp, str) for timestamp in timestamps):
+        return [
+            to_epoch_ms(parse_timestamp(timestamp)) if isinstance(timestamp, str) else int(timestamp)
+            for timestamp in timestamps
+        ]
+    return timestamps
+
+
+class ReadingColumns:
+    """Readings of one message as columns, in the order they were received."""
+
+    def __init__(self, spot_ids, reading_ids, is_occupied, timestamps_ms, battery_levels):
+        self.spot_ids = spot_ids
+        self.reading_ids = reading_ids
+        self.is_occupied = is_occupied
+        self.timestamps_ms = timestamps_ms
+        self.battery_levels = battery_levels  # may contain None, so always a list
+
+    def __len__(self):
+        return len(self.reading_ids)
+
+    def latest_per_spot(self):
+        """spot_id -> (is_occupied, battery_level) of the reading with the latest timestamp of each spot."""
+        if not len(self):
+            return {}
+        if numpy is not None:
+            # sorted by spot, then timestamp, then reversed position: the last row of a spot is its latest
+            # reading, the first received one of equal timestamps
+            order = numpy.lexsort((-numpy.arange(len(self)), self.timestamps_ms, self.spot_ids))
+            sorted_spot_ids = self.spot_ids[order]
+            is_last_of_spot = numpy.append(sorted_spot_ids[1:] != sorted_spot_ids[:-1], True)
+            latest = order[is_last_of_spot].tolist()
+        else:
+            latest_by_spot = {}
+            for index, (spot_id, timestamp) in enumerate(zip(self.spot_ids, self.timestamps_ms)):
+                current = latest_by_spot.get(spot_id)
+                if current is None or timestamp > self.timestamps_ms[current]:
+                    latest_by_spot[spot_id] = index
+            latest = latest_by_spot.values()
+        return {
+            int(self.spot_ids[index]): (self.is_occupied[index], self.battery_levels[index]) for index in latest
+        }
+
+    def timestamps(self):
+        """Timezone aware UTC datetimes of the readings."""
+        if numpy is not None:
+            # datetime64 -> naive datetimes is done in C, only attaching the timezone is left per value
+            naive = self.timestamps_ms.astype("datetime64[ms]").tolist()
+            return [timestamp.replace(tzinfo=UTC) for timestamp in naive]
+        return list(map(from_epoch_ms, self.timestamps_ms))
+
+    def rows(self, station_id):
+        """History rows of the readings for a bulk insert."""
+        spot_ids = self.spot_ids.tolist() if numpy is not None else self.spot_ids
+        return [
+            {
+                "station_id": station_id,
+                "spot_id": spot_id,
+                "sensor_reading_id": reading_id,
+                "is_occupied": is_occupied,
+                "sensor_reading_timestamp": timestamp,
+                "battery_level": battery_level,
+            }
+            for spot_id, reading_id, is_occupied, timestamp, battery_level in zip(
+                spot_ids, self.reading_ids, self.is_occupied, self.timestamps(), self.battery_levels
+            )
+        ]
+
+
+def decode_readings(sensor_data):
+    """Columns of the readings of a message, sensor_data maps spot ids (strings) to lists of readings."""
+    spot_ids = []
+    readings = []
+    for spot_id, data_list in (sensor_data or {}).items():
+        spot_ids.extend(itertools.repeat(int(spot_id), len(data_list)))
+        readings.extend(data_list)
+    timestamps_ms = _to_epoch_ms(list(map(get_timestamp, readings)))
+    if numpy is not None:
+        spot_ids = numpy.array(spot_ids, dtype=numpy.int64)
+        timestamps_ms = numpy.array(timestamps_ms, dtype=numpy.int64)
+    return ReadingColumns(
+        spot_ids,
+        list(map(get_reading_id, readings)),
+        list(map(get_is_occupied, readings)),
+        timestamps_ms,
+        list(map(get_battery_level, readings)),
+    )
@@ -0,0 +1,252 @@
+"""Cloud end of the multiplexed station link, replaces server/server.py and client/client.py.
+
+Every station keeps one DEALER connection to the ROUTER socket of this process, both directions share it:
+    edge -> cloud   data      sensor readings and electricity data
+    edge -> cloud   priority  reservation responses
+    cloud -> edge   down  market price and new reservations
+    both            ack   acknowledges a message of the other side without carrying data
+A message is sent as the frames [type, sequence number, acknowledged sequence number, payload]. Acks are
+piggybacked on the next message going the other way, a separate ack is only sent if there is nothing to send.
+Data messages are processed by the ingest workers of the server, so stations don't wait for each other.
+Priority messages go to a worker of their own, they don't queue behind the backlog of sensor data the ingest
+workers may be busy with, e.g. after an outage of many stations. Only one message of a station is processed at a
+time, a waiting priority message is handed out before waiting data. Messages are never processed by the thread
+of the router socket, so heartbeats, acks and other stations don't wait for a message that waits for a locked db.
+"""
+import logging
+import os
+import threading
+import time
+
+import zmq
+from dotenv import load_dotenv
+
+from cloud.client.client import get_current_market_price, make_station_message, mark_reservations_sent
+from cloud.clock import clock_from_env
+from cloud.compression import Codec, decode
+from cloud.connection import RttEstimator, Backoff, configure_heartbeat
+from cloud.constants import INGEST_WORKERS
+from cloud.instrumentation import get_instrumentation
+from cloud.models import ReservationRequest, release_session
+from cloud.server.server import context, run_worker, WORKERS_ADDRESS, PRIORITY_WORKER_ADDRESS
+
+load_dotenv()
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+DATA = b"data"
+PRIORITY = b"priority"
+DOWN = b"down"
+ACK = b"ack"
+
+POLL_INTERVAL = 200  # milliseconds
+MAX_NUMBER_OF_RETRIES = 5
+PRICE_INTERVAL = 3  # seconds between two market price updates
+RESERVATION_CHECK_INTERVAL = 0.5  # seconds between two checks for new reservations
+
+
+def station_identity(station_id):
+    """Socket identity of a station's link, the cloud routes messages to the station with it."""
+    return f"station-{station_id}".encode()
+
+
+def station_id_of(identity):
+    return int(identity.decode().rsplit("-", 1)[1])
+
+
+class StationLink:
+    """Sequence numbers and the unacknowledged down message of one station."""
+
+    def __init__(self, identity):
+        self.identity = identity
+        self.station_id = station_id_of(identity)
+        self.next_sequence = 1
+        self.data_sequence_to_ack = None  # processed data or priority message, not yet acknowledged
+        self.sequence_in_progress = None  # data or priority message handed to a worker
+        self.waiting = {}  # message type -> (sequence, payload) received while another message was in progress
+        self.last_processed_sequences = {DATA: None, PRIORITY: None}
+        self.down_in_flight = None  # (sequence, reservation ids, encoded message)
+        self.down_sent_at = 0.0
+        self.resend_at = 0.0
+        self.retries = 0
+        self.price_sent = None
+        self.rtt = RttEstimator()
+        self.backoff = Backoff()
+        self.codec = None  # created with the first data message, down messages use the framing of the station
+
+
+class LinkServer:
+
+    def __init__(self, bind_address, metrics):
+        self.metrics = metrics
+        self.router = context.socket(zmq.ROUTER)
+        # fail instead of silently dropping messages to stations that are gone
+        self.router.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        # connections of dead stations are detected and dropped by heartbeats
+        configure_heartbeat(self.router)
+        self.router.bind(bind_address)
+        self.backend = context.socket(zmq.DEALER)
+        self.backend.bind(WORKERS_ADDRESS)
+        self.priority_backend = context.socket(zmq.DEALER)
+        self.priority_backend.bind(PRIORITY_WORKER_ADDRESS)
+        self.stations = {}  # identity -> StationLink
+        self.current_price = get_current_market_price()
+        self.price_updated_at = time.monotonic()
+        self.reservations_checked_at = 0.0
+
+    def _send(self, station, message_type, sequence=b"", payload=b""):
+        ack = b""
+        if station.data_sequence_to_ack is not None:
+            ack = str(station.data_sequence_to_ack).encode()
+            station.data_sequence_to_ack = None
+        try:
+            self.router.send_multipart([station.identity, message_type, sequence, ack, payload])
+        except zmq.ZMQError as e:
+            # station disconnected, it resends its unacknowledged data after reconnecting
+            logging.warning(f"Could not reach station {station.station_id}: {e}")
+            self.metrics.count("unroutable")
+            return
+        self.metrics.count("bytes_sent", len(payload))
+
+    def _on_station_message(self, identity, message_type, sequence, ack, payload):
+        station = self.stations.get(identity)
+        if station is None:
+            station = StationLink(identity)
+            self.stations[identity] = station
+            logging.info(f"Station {station.station_id} connected.")
+        if ack and station.down_in_flight is not None and int(ack) == station.down_in_flight[0]:
+            if station.retries == 0:
+                # the round trip of a resent message is ambiguous
+                station.rtt.observe(time.monotonic() - station.down_sent_at)
+                self.metrics.gauge(f"station_{station.station_id}_rtt_ms", round(station.rtt.smoothed * 1000, 1))
+            station.backoff.reset()
+            self.metrics.gauge(f"station_{station.station_id}_link_up", 1)
+            mark_reservations_sent(station.down_in_flight[1], self.metrics)
+            station.down_in_flight = None
+        if message_type not in (DATA, PRIORITY):
+            return
+        with self.metrics.timer("decompress"):
+            payload, framed = decode(payload)
+        if station.codec is None:
+            station.codec = Codec(enabled=framed, metrics=self.metrics, peer_accepts=True)
+        sequence = int(sequence)
+        if sequence == station.last_processed_sequences[message_type]:
+            # the ack got lost, acknowledge again without processing it twice
+            station.data_sequence_to_ack = sequence
+            self._flush(station)
+        elif sequence != station.sequence_in_progress:
+            # a resend of a waiting message replaces it
+            station.waiting[message_type] = (sequence, payload)
+            self._dispatch(station)
+
+    def _dispatch(self, station):
+        """Hands the next waiting message of the station to a worker, unless one of its messages is in progress.
+        Reservation responses go first, to the priority worker.
+        """
+        if station.sequence_in_progress is not None:
+            return
+        if PRIORITY in station.waiting:
+            message_type, backend = PRIORITY, self.priority_backend
+        elif DATA in station.waiting:
+            message_type, backend = DATA, self.backend
+        else:
+            return
+        sequence, payload = station.waiting.pop(message_type)
+        station.sequence_in_progress = sequence
+        backend.send_multipart([station.identity, str(sequence).encode(), b"", payload])
+
+    def _on_processed(self, message_type, identity, sequence, reply):
+        station = self.stations[identity]
+        station.sequence_in_progress = None
+        if reply != b"0":
+            station.last_processed_sequences[message_type] = int(sequence)
+            station.data_sequence_to_ack = int(sequence)
+            self._flush(station)
+        # a failed message is sent again by the station after its ack timeout
+        self._dispatch(station)
+
+    def _send_down(self, station, now):
+        pending_reservations, encoded_message = make_station_message(
+            station.station_id, self.current_price, self.metrics
+        )
+        if station.codec is not None:
+            encoded_message = station.codec.encode(encoded_message)
+        sequence = station.next_sequence
+        station.next_sequence += 1
+        station.down_in_flight = (
+            sequence, [reservation.reservation_id for reservation in pending_reservations], encoded_message
+        )
+        station.down_sent_at = now
+        station.resend_at = now + station.rtt.timeout
+        station.retries = 0
+        station.price_sent = self.current_price
+        self._send(station, DOWN, str(sequence).encode(), encoded_message)
+
+    def _flush(self, station, now=None, stations_with_reservations=()):
+        """Sends what is due for the station: a resend, a new down message or a bare ack."""
+        now = now or time.monotonic()
+        if station.down_in_flight is not None:
+            if now >= station.resend_at:
+                self.metrics.gauge(f"station_{station.station_id}_link_up", 0)
+                station.rtt.on_timeout()
+                if station.retries >= MAX_NUMBER_OF_RETRIES:
+                    # outdated by now, the next down message carries current price and reservations
+                    logging.warning(f"Maximum retries reached for station {station.station_id}.")
+                    station.down_in_flight = None
+                else:
+                    self.metrics.count("timeouts")
+                    sequence, _, encoded_message = station.down_in_flight
+                    station.resend_at = now + station.rtt.timeout + station.backoff.next_delay()
+                    station.retries += 1
+                    self._send(station, DOWN, str(sequence).encode(), encoded_message)
+                    return
+        if station.down_in_flight is None and (
+                station.price_sent != self.current_price or station.station_id in stations_with_reservations
+        ):
+            self._send_down(station, now)
+        elif station.data_sequence_to_ack is not None:
+            self._send(station, ACK)
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self.router, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        poller.register(self.priority_backend, zmq.POLLIN)
+        while True:
+            with self.metrics.timer("poll"):
+                events = dict(poller.poll(POLL_INTERVAL))
+            if self.router in events:
+                identity, message_type, sequence, ack, payload = self.router.recv_multipart()
+                self.metrics.count("bytes_received", len(payload))
+                self._on_station_message(identity, message_type, sequence, ack, payload)
+            if self.priority_backend in events:
+                identity, sequence, _, reply = self.priority_backend.recv_multipart()
+                self._on_processed(PRIORITY, identity, sequence, reply)
+            if self.backend in events:
+                identity, sequence, _, reply = self.backend.recv_multipart()
+                self._on_processed(DATA, identity, sequence, reply)
+
+            now = time.monotonic()
+            if now - self.price_updated_at >= PRICE_INTERVAL:
+                self.current_price = get_current_market_price()
+                self.price_updated_at = now
+            stations_with_reservations = ()
+            if now - self.reservations_checked_at >= RESERVATION_CHECK_INTERVAL:
+                with self.metrics.timer("db_query"):
+                    stations_with_reservations = set(ReservationRequest.get_station_ids_with_pending_reservations())
+                self.reservations_checked_at = now
+            for station in self.stations.values():
+                self._flush(station, now, stations_with_reservations)
+            release_session()
+            self.metrics.end_cycle()
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    logging.info('Listening to station links...')
+    link_server = LinkServer(os.getenv("bind_address"), get_instrumentation("cloud_link"))
+    for number in range(INGEST_WORKERS):
+        threading.Thread(target=run_worker, args=(number,), name=f"ingest-worker-{number}", daemon=True).start()
+    threading.Thread(
+        target=run_worker, args=("priority", PRIORITY_WORKER_ADDRESS), name="priority-worker", daemon=True
+    ).start()
+    link_server.run()
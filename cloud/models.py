@@ -1,18 +1,87 @@
-import datetime
 import enum
 import os
+import threading
+from contextlib import contextmanager
 
 import pytz
-from sqlalchemy import Column, Integer, DateTime, Boolean, Enum, REAL, func, create_engine, true
+from sqlalchemy import (
+    Column, Integer, String, DateTime, Boolean, Enum, REAL, func, create_engine, true, event, inspect, select, update,
+    Index, and_, or_,
+)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 from dotenv import load_dotenv
+
+from cloud.constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_BUSY_TIMEOUT, DEFAULT_DATABASE_URL, DEFAULT_STATION_ID
+from cloud.reservation_log import Event, get_reservation_log_from_env
+from cloud.storage import get_storage_backend
+from cloud.timeutil import utcnow
+
 load_dotenv()
 
-engine = create_engine(f'sqlite:///sqlite.db', echo=False)  # sqlite db relative path
-Session = sessionmaker(bind=engine)
-# create a Session
-session = Session()
+database_url = os.getenv("database_url", DEFAULT_DATABASE_URL)
+if database_url.startswith("sqlite"):
+    # the pool hands connections between threads, but a connection is never used by two threads at once
+    connect_args = {"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT}
+else:
+    connect_args = {}
+engine = create_engine(
+    database_url,
+    echo=False,
+    poolclass=QueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=not database_url.startswith("sqlite"),  # survive restarts of a database server
+    connect_args=connect_args,
+)
+storage = get_storage_backend(engine)
+reservation_log = get_reservation_log_from_env()  # reservation events, if enabled
+# thread-local sessions: `session` proxies to the session of the calling thread
+Session = scoped_session(sessionmaker(bind=engine))
+session = Session
+
+_transaction_state = threading.local()
+
+
+@contextmanager
+def transaction():
+    """Unit of work: commits of all model methods called inside are batched into one commit at the end.
+    Nested blocks join the outermost one. Everything is rolled back if the block raises.
+    """
+    depth = getattr(_transaction_state, "depth", 0)
+    _transaction_state.depth = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except BaseException:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        _transaction_state.depth = depth
+
+
+def commit():
+    """Commits, unless called inside a transaction() block, where it only flushes (e.g. to get generated ids).
+    A failed commit is rolled back, so the session stays usable for the next unit of work.
+    """
+    if getattr(_transaction_state, "depth", 0):
+        session.flush()
+        return
+    try:
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def release_session():
+    """Closes the session of the calling thread and drops its identity map.
+    Call at the end of every loop cycle, objects loaded before must not be used afterwards.
+    """
+    Session.remove()
 
 Base = declarative_base()
 
@@ -24,15 +93,25 @@ class SpotStateData(Base):
     __tablename__ = "spot_state"
     sensor_reading_timestamp = Column(DateTime(timezone=True), primary_key=True)
     sensor_reading_id = Column(Integer, nullable=False)
+    station_id = Column(Integer, nullable=False, primary_key=True, default=DEFAULT_STATION_ID)
     spot_id = Column(Integer, nullable=False, primary_key=True)
     is_occupied = Column(Boolean, default=False)
     battery_level = Column(REAL)
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
+    @staticmethod
+    def bulk_add(station_id, rows):
+        """Stores many readings of a station given as dicts without creating ORM objects,
+        already stored readings are skipped.
+        """
+        storage.bulk_ingest(session.connection(), SpotStateData.__table__, rows, station_id)
+        commit()
+
+
 class MessageStatus(enum.Enum):
     created = 0
     processed = 1
@@ -43,31 +122,61 @@ class MessageStatus(enum.Enum):
 class ReservationRequest(Base):
     __tablename__ = "reservation_request"
     reservation_id = Column(Integer, primary_key=True)
-    creation_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc))
+    creation_timestamp = Column(DateTime(timezone=True), default=utcnow, server_default=func.now(tz=pytz.utc))
+    station_id = Column(Integer, nullable=False, default=DEFAULT_STATION_ID, index=True)
     spot_id = Column(Integer, nullable=False)
     duration_in_seconds = Column(Integer, nullable=False)
     sent_status = Column(Enum(MessageStatus), default=MessageStatus.created)
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
     def set_to_processed(self):
         self.sent_status = MessageStatus.processed
-        session.commit()
+        commit()
+
+    @staticmethod
+    def set_to_processed_by_ids(reservation_ids):
+        if not reservation_ids:
+            return
+        session.query(ReservationRequest).filter(
+            ReservationRequest.reservation_id.in_(reservation_ids)
+        ).update({"sent_status": MessageStatus.processed}, synchronize_session=False)
+        commit()
 
     @staticmethod
-    def get_pending_reservations():
-        """Get pending reservations, ordered by descending creation
+    def get_pending_reservations(station_id):
+        """Get pending reservations of a station, ordered by descending creation
         """
         return (
             session.query(ReservationRequest)
-            .filter(ReservationRequest.sent_status == MessageStatus.created)
+            .filter(
+                ReservationRequest.station_id == station_id,
+                ReservationRequest.sent_status == MessageStatus.created,
+            )
             .order_by("creation_timestamp")
             .all()
         )
 
+    @staticmethod
+    def get_station_ids_with_pending_reservations():
+        return [
+            station_id for station_id, in session.query(ReservationRequest.station_id).filter(
+                ReservationRequest.sent_status == MessageStatus.created
+            ).distinct()
+        ]
+
+    @staticmethod
+    def count_pending_by_station():
+        """Number of reservation requests not yet sent to the station, per station id."""
+        return dict(
+            session.query(ReservationRequest.station_id, func.count(ReservationRequest.reservation_id)).filter(
+                ReservationRequest.sent_status == MessageStatus.created
+            ).group_by(ReservationRequest.station_id).all()
+        )
+
     @staticmethod
     def make_query_dictionary(query):
         reservations_dict = {}
@@ -85,7 +194,7 @@ class ReservationRequest(Base):
         session.query(ReservationRequest).filter(
             ReservationRequest.sent_status == MessageStatus.processed
         ).delete()
-        session.commit()
+        commit()
 
 
 class ReservationStatus(enum.Enum):
@@ -99,6 +208,7 @@ class CurrentSpotState(Base):
     """Represents most recent state of the station's spot known to the cloud component.
     """
     __tablename__ = "current_spot_state"
+    station_id = Column(Integer, primary_key=True, default=DEFAULT_STATION_ID)
     spot_id = Column(Integer, primary_key=True)
     is_occupied = Column(Boolean, default=False)
     battery_level = Column(REAL)
@@ -106,10 +216,54 @@ class CurrentSpotState(Base):
     reservation_id = Column(Integer)
     reservation_valid_from = Column(DateTime(timezone=True))
     reservation_duration = Column(Integer)
+    # number of the last change of the station's spot states (see ChangeCounter), lets the placement index pick up
+    # changed spots incrementally
+    change_number = Column(Integer, nullable=False, default=0)
+    __table_args__ = (Index("ix_current_spot_state_station_change", "station_id", "change_number"),)
+
+    @staticmethod
+    def get_current_states(station_id=None):
+        """Gets the spot states of one station, of all stations if station_id is None."""
+        query = session.query(CurrentSpotState)
+        if station_id is not None:
+            query = query.filter(CurrentSpotState.station_id == station_id)
+        return query.order_by("station_id", "spot_id").all()
+
+    @staticmethod
+    def get_spot_state(station_id, spot_id):
+        return session.query(CurrentSpotState).get((station_id, spot_id))
+
+    @staticmethod
+    def get_station_ids():
+        return [station_id for station_id, in session.query(CurrentSpotState.station_id).distinct()]
 
     @staticmethod
-    def get_current_states():
-        return session.query(CurrentSpotState).order_by("spot_id").all()
+    def get_changed_since(change_numbers=None):
+        """Gets the spot states of the given stations changed after their change number (station_id -> change
+        number), all spot states if change_numbers is None.
+        """
+        if change_numbers is None:
+            return session.query(CurrentSpotState).all()
+        stations = list(change_numbers.items())
+        spot_states = []
+        for start in range(0, len(stations), CHANGED_STATIONS_PER_QUERY):
+            spot_states += session.query(CurrentSpotState).filter(or_(*[
+                and_(CurrentSpotState.station_id == station_id, CurrentSpotState.change_number > change_number)
+                for station_id, change_number in stations[start:start + CHANGED_STATIONS_PER_QUERY]
+            ])).all()
+        return spot_states
+
+    @staticmethod
+    def get_change_numbers():
+        """Gets station_id -> number of the last committed change of its spot states, of every station with a
+        change counter.
+        """
+        return {
+            int(name[len(SPOT_STATE_CHANGES):]): value
+            for name, value in session.query(ChangeCounter.name, ChangeCounter.value).filter(
+                ChangeCounter.name.startswith(SPOT_STATE_CHANGES, autoescape=True)
+            )
+        }
 
     @staticmethod
     def get_reservable_spots():
@@ -129,14 +283,14 @@ class CurrentSpotState(Base):
     def update_occupied_and_battery_state(self, is_occupied, battery_level=0.0):
         self.is_occupied = is_occupied
         self.battery_level = battery_level
-        session.commit()
+        commit()
 
     def end_reservation(self):
         self.reservation_status = ReservationStatus.no_reservation
         self.reservation_id = None
         self.reservation_duration = None
         self.reservation_valid_from = None
-        session.commit()
+        commit()
 
     def update_reservation_state(
             self, reservation_status: ReservationStatus,
@@ -153,35 +307,114 @@ class CurrentSpotState(Base):
             self.reservation_valid_from = valid_from
             if duration:
                 self.reservation_duration = duration
-        session.commit()
+        commit()
 
-    def update_expired_reservation(self):
+    def update_expired_reservation(self, now=None):
         if self.reservation_valid_from:
+            now = now or utcnow()
             remaining_time = (
                     self.reservation_duration -
-                    (datetime.datetime.utcnow() - self.reservation_valid_from).total_seconds()
+                    (now - self.reservation_valid_from).total_seconds()
             )
             # remove reservation if it is expired
             if remaining_time <= 0:
+                if reservation_log is not None:
+                    reservation_log.append(Event.expired, self.reservation_id, self.spot_id, station_id=self.station_id)
                 self.end_reservation()
 
     @staticmethod
     def update_all_expired_reservations():
+        now = utcnow()
         for spot_state in CurrentSpotState.get_all_reserved_spots():
-            spot_state.update_expired_reservation()
+            spot_state.update_expired_reservation(now)
 
     def make_inital_entry(self):
         """Use only if no entry for the spot exists yet."""
         session.add(self)
-        session.commit()
+        commit()
         return self
 
+    @staticmethod
+    def initialize_spots(station_id, spot_ids):
+        """Creates an entry for every spot of the station which doesn't have one yet."""
+        change_number = next_spot_state_change(station_id)
+        storage.upsert(
+            session.connection(),
+            CurrentSpotState.__table__,
+            [{"station_id": station_id, "spot_id": spot_id, "change_number": change_number} for spot_id in spot_ids],
+            index_elements=["station_id", "spot_id"],
+        )
+        commit()
+
+
+SPOT_STATE_CHANGES = "current_spot_state:"  # followed by the station id, see spot_state_changes
+CHANGED_STATIONS_PER_QUERY = 200  # keeps the condition within sqlite's limits of expression depth and variables
+
+
+class ChangeCounter(Base):
+    """Increasing change numbers, e.g. of spot states, to find the rows changed since a point of a reader.
+    Timestamps can't do this: they have a precision of seconds on sqlite, and on PostgreSQL a transaction can commit
+    a timestamp older than one already read. Taking a number locks the counter's row until the transaction ends,
+    so changes become visible in the order of their numbers. Spot states are numbered per station: a station's
+    messages are processed one at a time anyway, and different stations never wait for the same counter row.
+    """
+    __tablename__ = "change_counter"
+    name = Column(String(64), primary_key=True)
+    value = Column(Integer, nullable=False, default=0)
+
+    @staticmethod
+    def next_value(name, start=None):
+        """Takes the next number of the counter in the session's transaction.
+        start is called for the value of a counter that doesn't exist yet (default 0).
+        """
+        table = ChangeCounter.__table__
+        connection = session.connection()
+        increment = update(table).where(table.c.name == name).values(value=table.c.value + 1)
+        if connection.execute(increment).rowcount == 0:
+            value = 0 if start is None else start()
+            storage.upsert(connection, table, [{"name": name, "value": value}], index_elements=["name"])
+            connection.execute(increment)
+        return connection.execute(select(table.c.value).where(table.c.name == name)).scalar()
+
+
+def spot_state_changes(station_id):
+    """Name of the counter of the changes of a station's spot states."""
+    return f"{SPOT_STATE_CHANGES}{station_id}"
+
+
+def next_spot_state_change(station_id):
+    """Takes the next change number of the station's spot states."""
+
+    def last_change_number():
+        # spot states numbered before the station had a counter of its own
+        return session.connection().execute(
+            select(func.coalesce(func.max(CurrentSpotState.change_number), 0)).where(
+                CurrentSpotState.station_id == station_id
+            )
+        ).scalar()
+
+    return ChangeCounter.next_value(spot_state_changes(station_id), start=last_change_number)
+
+
+@event.listens_for(Session, "before_flush")
+def number_spot_state_changes(flush_session, flush_context, instances):
+    """All spot states changed by a flush get the next change number of their station."""
+    changed = {}
+    for instance in list(flush_session.new) + list(flush_session.dirty):
+        if isinstance(instance, CurrentSpotState) and flush_session.is_modified(instance):
+            changed.setdefault(instance.station_id, []).append(instance)
+    # counters in the same order in every transaction
+    for station_id in sorted(changed):
+        change_number = next_spot_state_change(station_id)
+        for spot_state in changed[station_id]:
+            spot_state.change_number = change_number
+
 
 class CurrentElectricityState(Base):
     """Represents most recent state of the station's electricity data known to the cloud component.
     """
     __tablename__ = "current_electricity_state"
-    pk = Column(Integer, primary_key=True)
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
     production = Column(Integer, nullable=False, default=0)
     self_consumption = Column(Integer, nullable=False, default=0)
     feed_in = Column(Integer, nullable=False, default=0)
@@ -190,9 +423,20 @@ class CurrentElectricityState(Base):
 
     def save_or_update(self):
         session.merge(self)
-        session.commit()
+        commit()
         return self
 
+    @staticmethod
+    def initialize(station_id):
+        """Creates the electricity state entry of the station if it doesn't exist yet."""
+        storage.upsert(
+            session.connection(),
+            CurrentElectricityState.__table__,
+            [{"station_id": station_id}],
+            index_elements=["station_id"],
+        )
+        commit()
+
     def update_state(self, latest_data):
         self.production = latest_data["production"]
         self.feed_in = latest_data["feed_in"]
@@ -202,8 +446,12 @@ class CurrentElectricityState(Base):
         self.save_or_update()
 
     @staticmethod
-    def get_current_state():
-        return session.query(CurrentElectricityState).first()
+    def get_current_state(station_id):
+        return session.query(CurrentElectricityState).get(station_id)
+
+    @staticmethod
+    def get_all_current_states():
+        return session.query(CurrentElectricityState).all()
 
 
 class ElectricityData(Base):
@@ -211,8 +459,10 @@ class ElectricityData(Base):
     Can be used for data analysis e.g. to improve business model, functionality, etc.
     """
     __tablename__ = "electricity_data"
-    data_item_id = Column(Integer, primary_key=True)
-    data_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc))
+    station_id = Column(Integer, primary_key=True, default=DEFAULT_STATION_ID)
+    data_item_id = Column(Integer, primary_key=True, autoincrement=False)
+    # part of the primary key, so the table can be partitioned by time
+    data_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc), primary_key=True)
     production = Column(Integer, nullable=False, default=0)
     self_consumption = Column(Integer, nullable=False, default=0)
     feed_in = Column(Integer, nullable=False, default=0)
@@ -221,8 +471,27 @@ class ElectricityData(Base):
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
+    @staticmethod
+    def bulk_add(station_id, rows):
+        """Stores many items of a station given as dicts without creating ORM objects,
+        already stored items are skipped.
+        """
+        storage.bulk_ingest(session.connection(), ElectricityData.__table__, rows, station_id)
+        commit()
+
 
 Base.metadata.create_all(engine)
+with engine.begin() as connection:
+    if "change_number" not in {column["name"] for column in inspect(connection).get_columns("current_spot_state")}:
+        # added to an existing db, every spot state counts as changed before the first number
+        connection.exec_driver_sql(
+            "ALTER TABLE current_spot_state ADD COLUMN change_number INTEGER NOT NULL DEFAULT 0"
+        )
+    for index in CurrentSpotState.__table__.indexes:
+        index.create(connection, checkfirst=True)
+    # replaced by the index of station and change number
+    connection.exec_driver_sql("DROP INDEX IF EXISTS ix_current_spot_state_change_number")
+storage.setup_schema()
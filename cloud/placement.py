@@ -0,0 +1,170 @@
+"""Answers "best spot for this user" queries across all stations.
+
+Spots are ranked by battery level of the parked bike, distance of the station to the user and reservation load
+of the station. Every station keeps a max-heap of its reservable spots ordered by battery level, so a query
+only looks at the top of each station's heap. The index is maintained incrementally from spot state changes.
+"""
+import heapq
+import math
+
+from cloud.constants import (
+    DEFAULT_STATION_ID,
+    STATION_LOCATIONS,
+    PLACEMENT_BATTERY_WEIGHT,
+    PLACEMENT_DISTANCE_WEIGHT,
+    PLACEMENT_LOAD_WEIGHT,
+)
+from cloud.models import CurrentSpotState, ReservationStatus
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def distance_km(location, other_location):
+    """Great-circle distance between two (latitude, longitude) pairs."""
+    latitude, longitude = map(math.radians, location)
+    other_latitude, other_longitude = map(math.radians, other_location)
+    a = (
+        math.sin((other_latitude - latitude) / 2) ** 2
+        + math.cos(latitude) * math.cos(other_latitude) * math.sin((other_longitude - longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class StationIndex:
+    """Reservable spots of one station in a heap ordered by battery level (highest first).
+    Entries of changed spots are not removed from the heap but skipped once they reach the top.
+    """
+
+    def __init__(self, station_id, location=None):
+        self.station_id = station_id
+        self.location = location
+        self.heap = []  # (-battery_level, spot_id, version)
+        self.spots = {}  # spot_id -> (version, reservable, reserved)
+        self.number_of_reserved = 0
+
+    def update_spot(self, spot_id, reservable, reserved, battery_level):
+        version, _, was_reserved = self.spots.get(spot_id, (0, False, False))
+        version += 1
+        self.spots[spot_id] = (version, reservable, reserved)
+        self.number_of_reserved += int(reserved) - int(was_reserved)
+        if reservable:
+            heapq.heappush(self.heap, (-(battery_level or 0.0), spot_id, version))
+        if len(self.heap) > 2 * len(self.spots) + 16:
+            self._rebuild_heap()
+
+    def _is_current(self, entry):
+        _, spot_id, version = entry
+        current_version, reservable, _ = self.spots[spot_id]
+        return version == current_version and reservable
+
+    def _rebuild_heap(self):
+        """Drops entries of changed spots, keeps the heap from growing with frequent updates."""
+        self.heap = [entry for entry in self.heap if self._is_current(entry)]
+        heapq.heapify(self.heap)
+
+    def best_spot(self):
+        """Returns (battery_level, spot_id) of the reservable spot with the fullest battery or None."""
+        while self.heap and not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        negative_battery_level, spot_id, _ = self.heap[0]
+        return -negative_battery_level, spot_id
+
+    @property
+    def reservation_load(self):
+        return self.number_of_reserved / len(self.spots) if self.spots else 0.0
+
+
+class PlacementIndex:
+    def __init__(self, station_locations=STATION_LOCATIONS):
+        self.station_locations = station_locations
+        self.stations = {}  # station_id -> StationIndex
+        self.change_numbers = None  # station_id -> change number of the spot states applied so far
+
+    def _get_station(self, station_id):
+        station = self.stations.get(station_id)
+        if station is None:
+            station = StationIndex(station_id, self.station_locations.get(station_id))
+            self.stations[station_id] = station
+        return station
+
+    def update_spot(self, spot_id, is_occupied, reservation_status, battery_level, station_id=DEFAULT_STATION_ID):
+        reservable = bool(is_occupied) and reservation_status == ReservationStatus.no_reservation
+        reserved = reservation_status in (
+            ReservationStatus.reservation_requested, ReservationStatus.reservation_confirmed
+        )
+        self._get_station(station_id).update_spot(spot_id, reservable, reserved, battery_level)
+
+    def apply_spot_state(self, spot_state: CurrentSpotState):
+        self.update_spot(
+            spot_state.spot_id,
+            spot_state.is_occupied,
+            spot_state.reservation_status,
+            spot_state.battery_level,
+            station_id=spot_state.station_id,
+        )
+
+    def refresh(self):
+        """Applies all spot states changed since the last refresh (all of them on the first call)."""
+        if self.change_numbers is None:
+            changed_spot_states = CurrentSpotState.get_changed_since()
+            self.change_numbers = {}
+        else:
+            # only stations whose counter moved on are queried
+            changed_spot_states = CurrentSpotState.get_changed_since({
+                station_id: self.change_numbers.get(station_id, 0)
+                for station_id, change_number in CurrentSpotState.get_change_numbers().items()
+                if change_number > self.change_numbers.get(station_id, 0)
+            })
+        for spot_state in changed_spot_states:
+            self.apply_spot_state(spot_state)
+            if spot_state.change_number > self.change_numbers.get(spot_state.station_id, -1):
+                self.change_numbers[spot_state.station_id] = spot_state.change_number
+        return len(changed_spot_states)
+
+    def score(self, station, battery_level, user_location):
+        distance = 0.0
+        if user_location is not None:
+            if station.location is None:
+                # distance unknown, only offered if no station with a location has a spot
+                return -math.inf
+            distance = distance_km(user_location, station.location)
+        return (
+            PLACEMENT_BATTERY_WEIGHT * battery_level
+            - PLACEMENT_DISTANCE_WEIGHT * distance
+            - PLACEMENT_LOAD_WEIGHT * station.reservation_load
+        )
+
+    def best_spot(self, user_location=None):
+        """Returns (station_id, spot_id) of the best reservable spot for a user at (latitude, longitude) or None."""
+        best_score, best = None, None
+        for station in self.stations.values():
+            top = station.best_spot()
+            if top is None:
+                continue
+            battery_level, spot_id = top
+            score = self.score(station, battery_level, user_location)
+            if best_score is None or score > best_score:
+                best_score, best = score, (station.station_id, spot_id)
+        return best
+
+    def claim(self, station_id, spot_id):
+        """Marks the spot as requested, so it isn't offered again until its state changes."""
+        self._get_station(station_id).update_spot(spot_id, reservable=False, reserved=True, battery_level=None)
+
+    def best_spots(self, user_locations):
+        """Batch API: assigns distinct spots to many users, in the given order. Users without a spot get None."""
+        placements = []
+        for user_location in user_locations:
+            placement = self.best_spot(user_location)
+            if placement is not None:
+                self.claim(*placement)
+            placements.append(placement)
+        return placements
+
+    @property
+    def number_of_reservable_spots(self):
+        return sum(
+            1 for station in self.stations.values() for _, reservable, _ in station.spots.values() if reservable
+        )
@@ -0,0 +1,184 @@
+"""Read-only HTTP api for the current state of the stations, for dashboards and apps.
+
+    GET /stations               ids of all stations
+    GET /stations/<station_id>  spots, electricity state and reservation status of one station
+
+Requests are answered from an in-memory, versioned snapshot of the state, the db is queried at most once per
+QUERY_CACHE_TTL however many clients poll. Responses carry an ETag and Last-Modified, so clients polling with
+If-None-Match or If-Modified-Since get an empty 304 as long as the state of the station didn't change. The
+X-State-Version header counts the snapshots in which anything changed.
+
+    python query_api.py  serves on port QUERY_API_PORT (query_api_port in .env)
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from cloud.constants import QUERY_API_PORT, QUERY_CACHE_TTL
+from cloud.instrumentation import get_instrumentation
+from cloud.models import CurrentSpotState, CurrentElectricityState, ReservationRequest, release_session
+from cloud.timeutil import json_default
+
+load_dotenv()
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+STATION_PATH = re.compile(r"^/stations/(\d+)/?$")
+
+
+class Resource:
+    """Serialized response body with its validators."""
+    __slots__ = ("body", "etag", "last_modified")
+
+    def __init__(self, body, etag, last_modified):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class StateSnapshot:
+    """Versioned in-memory copy of the station state, rebuilt from the db once it is older than ttl.
+    Resources whose content didn't change keep their ETag and Last-Modified.
+    """
+
+    def __init__(self, metrics, ttl=QUERY_CACHE_TTL):
+        self.ttl = ttl
+        self.metrics = metrics
+        self.version = 0
+        self.resources = {}  # path -> Resource
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """Returns the resource at path (None if there is no such resource) and the version of the snapshot."""
+        with self.lock:
+            if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.ttl:
+                self._refresh()
+            self.metrics.count("requests")
+            self.metrics.end_cycle()
+            return self.resources.get(path), self.version
+
+    def count(self, counter):
+        # the instrumentation isn't thread safe, handler threads share it through the lock
+        with self.lock:
+            self.metrics.count(counter)
+
+    def _load_stations(self):
+        stations = {}
+        for spot_state in CurrentSpotState.get_current_states():
+            station = stations.setdefault(spot_state.station_id, {"spots": [], "electricity": None})
+            station["spots"].append({
+                "spot_id": spot_state.spot_id,
+                "is_occupied": spot_state.is_occupied,
+                "battery_level": spot_state.battery_level,
+                "reservation_status": spot_state.reservation_status.name,
+                "reservation_id": spot_state.reservation_id,
+                "reservation_valid_from": spot_state.reservation_valid_from,
+                "reservation_duration": spot_state.reservation_duration,
+            })
+        for electricity_state in CurrentElectricityState.get_all_current_states():
+            station = stations.setdefault(electricity_state.station_id, {"spots": [], "electricity": None})
+            station["electricity"] = {
+                "production": electricity_state.production,
+                "self_consumption": electricity_state.self_consumption,
+                "consumption_saving": electricity_state.consumption_saving,
+                "feed_in": electricity_state.feed_in,
+                "feed_in_revenue": electricity_state.feed_in_revenue,
+            }
+        pending_reservations = ReservationRequest.count_pending_by_station()
+        for station_id, station in stations.items():
+            station["pending_reservation_requests"] = pending_reservations.get(station_id, 0)
+        return stations
+
+    def _refresh(self):
+        with self.metrics.timer("db_query"):
+            try:
+                stations = self._load_stations()
+            finally:
+                release_session()
+        now = time.time()
+        bodies = {"/stations": {"stations": sorted(stations)}}
+        for station_id, station in stations.items():
+            bodies[f"/stations/{station_id}"] = {"station_id": station_id, **station}
+        resources = {}
+        changed = False
+        with self.metrics.timer("serialize"):
+            for path, content in bodies.items():
+                body = json.dumps(content, default=json_default, sort_keys=True).encode()
+                etag = '"' + hashlib.sha1(body).hexdigest()[:16] + '"'
+                previous = self.resources.get(path)
+                if previous is not None and previous.etag == etag:
+                    resources[path] = previous
+                else:
+                    resources[path] = Resource(body, etag, now)
+                    changed = True
+        if changed or resources.keys() != self.resources.keys():
+            self.version += 1
+        self.resources = resources
+        self.refreshed_at = time.monotonic()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    snapshot = None  # set by serve()
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/") or "/"
+        if path != "/stations" and not STATION_PATH.match(path):
+            self.send_error(404, "Unknown resource, use /stations or /stations/<station_id>")
+            return
+        resource, version = self.snapshot.get(path)
+        if resource is None:
+            self.send_error(404, "Unknown station")
+            return
+        if self._not_modified(resource):
+            self.snapshot.count("not_modified")
+            self.send_response(304)
+            self._send_validators(resource)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(resource.body)))
+        self.send_header("X-State-Version", str(version))
+        self._send_validators(resource)
+        self.end_headers()
+        self.wfile.write(resource.body)
+
+    def _not_modified(self, resource):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            # takes precedence over If-Modified-Since
+            return resource.etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is not None:
+            try:
+                return int(resource.last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _send_validators(self, resource):
+        self.send_header("ETag", resource.etag)
+        self.send_header("Last-Modified", formatdate(resource.last_modified, usegmt=True))
+        self.send_header("Cache-Control", f"max-age={int(self.snapshot.ttl)}")
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve(port=QUERY_API_PORT):
+    QueryHandler.snapshot = StateSnapshot(get_instrumentation("query_api"))
+    server = ThreadingHTTPServer(("0.0.0.0", port), QueryHandler)
+    logging.info(f"Serving station state on port {port}...")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve(int(os.getenv("query_api_port", QUERY_API_PORT)))
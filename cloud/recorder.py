@@ -0,0 +1,60 @@
+import os
+import struct
+import time
+import zlib
+
+# direction of a recorded message
+EDGE_TO_CLOUD = 0
+CLOUD_TO_EDGE = 1
+
+FILE_MAGIC = b"BSREC1\n"
+# direction, unix timestamp of the message, length of the compressed payload
+RECORD_HEADER = struct.Struct("<BdI")
+
+
+class MessageRecorder:
+    """Appends raw messages with their timestamp to a compact, append-only recording file.
+    Payloads are zlib compressed, the repetitive json keys make them very small.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # O_APPEND with one write per record lets the cloud server and client share one recording file
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size == 0:
+            os.write(self.fd, FILE_MAGIC)
+
+    def record(self, direction, payload: bytes, timestamp=None):
+        compressed = zlib.compress(payload)
+        header = RECORD_HEADER.pack(direction, timestamp or time.time(), len(compressed))
+        os.write(self.fd, header + compressed)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_records(path, direction=None):
+    """Yields (timestamp, direction, payload) of all records in the file, optionally filtered by direction.
+    A truncated record at the end of the file (e.g. crash while recording) is ignored.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f"{path} is not a message recording")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            record_direction, timestamp, length = RECORD_HEADER.unpack(header)
+            compressed = f.read(length)
+            if len(compressed) < length:
+                return
+            if direction is None or record_direction == direction:
+                yield timestamp, record_direction, zlib.decompress(compressed)
+
+
+def get_recorder_from_env():
+    """Returns a recorder if the record_file environment variable is set, None otherwise."""
+    path = os.getenv("record_file")
+    if not path:
+        return None
+    return MessageRecorder(path)
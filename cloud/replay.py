@@ -0,0 +1,148 @@
+"""Replays recorded message streams against the cloud server or the edge server for load testing.
+
+Examples:
+    # replay edge->cloud traffic of 50 virtual stations against the cloud server at 10x speed
+    python replay.py recording.bin --direction edge_to_cloud --target tcp://localhost:6666 --stations 50 --speed 10
+
+    # replay cloud->edge traffic as fast as possible against an edge server
+    python replay.py recording.bin --direction cloud_to_edge --target tcp://<edge_ip>:5555 --speed 0
+"""
+import argparse
+import json
+import logging
+import statistics
+import threading
+import time
+
+import zmq
+
+from cloud.recorder import read_records, EDGE_TO_CLOUD, CLOUD_TO_EDGE
+
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+DIRECTIONS = {"edge_to_cloud": EDGE_TO_CLOUD, "cloud_to_edge": CLOUD_TO_EDGE}
+
+
+class VirtualStation(threading.Thread):
+    """Sends the recorded messages over its own connection, keeping the recorded timing scaled by speed.
+    A speed of 0 sends every message as soon as the previous one got its reply.
+    """
+
+    def __init__(self, station_number, context, target, records, speed, timeout, start_time):
+        super().__init__(name=f"virtual-station-{station_number}", daemon=True)
+        self.context = context
+        self.target = target
+        self.records = records
+        self.speed = speed
+        self.timeout = timeout
+        self.start_time = start_time
+        self.latencies = []
+        self.sent_bytes = 0
+        self.failures = 0
+
+    def _connect(self):
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.target)
+        return socket
+
+    def run(self):
+        socket = self._connect()
+        first_timestamp = self.records[0][0]
+        for timestamp, _, payload in self.records:
+            if self.speed > 0:
+                delay = self.start_time + (timestamp - first_timestamp) / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            sent_at = time.perf_counter()
+            socket.send(payload)
+            if socket.poll(self.timeout) & zmq.POLLIN:
+                socket.recv()
+                self.latencies.append(time.perf_counter() - sent_at)
+                self.sent_bytes += len(payload)
+            else:
+                # REQ socket can't send again without a reply, start over with a fresh one
+                self.failures += 1
+                socket.close()
+                socket = self._connect()
+        socket.close()
+
+
+def as_station(records, station_id):
+    """Rewrites the station id of recorded edge messages, so every virtual station has a state of its own."""
+    station_records = []
+    for timestamp, direction, payload in records:
+        message = json.loads(payload.decode())
+        message["station_id"] = station_id
+        station_records.append((timestamp, direction, json.dumps(message).encode()))
+    return station_records
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def print_report(stations, duration):
+    latencies = sorted(latency for station in stations for latency in station.latencies)
+    sent_bytes = sum(station.sent_bytes for station in stations)
+    failures = sum(station.failures for station in stations)
+    print("\n---------------------------------------- Replay Report ------------------------------------------------")
+    print(f"Virtual stations:   {len(stations)}")
+    print(f"Duration:           {duration:.2f} s")
+    print(f"Messages replied:   {len(latencies)}")
+    print(f"Messages timed out: {failures}")
+    print(f"Throughput:         {len(latencies) / duration:.1f} msg/s, {sent_bytes / duration / 1024:.1f} KiB/s")
+    if latencies:
+        print(
+            "Latency (ms):       mean {:.2f} | p50 {:.2f} | p90 {:.2f} | p99 {:.2f} | max {:.2f}".format(
+                statistics.mean(latencies) * 1000,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.9) * 1000,
+                percentile(latencies, 0.99) * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded station traffic for load testing.")
+    parser.add_argument("recording", help="recording file written with the record_file environment variable")
+    parser.add_argument("--direction", choices=DIRECTIONS.keys(), default="edge_to_cloud")
+    parser.add_argument("--target", required=True, help="address of the server, e.g. tcp://localhost:6666")
+    parser.add_argument("--stations", type=int, default=1, help="number of virtual stations")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, 1 = real time, 0 = as fast as possible")
+    parser.add_argument("--timeout", type=int, default=2500, help="reply timeout in milliseconds")
+    args = parser.parse_args()
+
+    records = list(read_records(args.recording, DIRECTIONS[args.direction]))
+    if not records:
+        logging.error("No %s messages in %s", args.direction, args.recording)
+        return
+    logging.info(f"Replaying {len(records)} messages with {args.stations} virtual stations against {args.target}")
+
+    context = zmq.Context()
+    start_time = time.monotonic()
+    stations = [
+        VirtualStation(
+            number,
+            context,
+            args.target,
+            as_station(records, number) if args.direction == "edge_to_cloud" else records,
+            args.speed,
+            args.timeout,
+            start_time,
+        )
+        for number in range(args.stations)
+    ]
+    for station in stations:
+        station.start()
+    for station in stations:
+        station.join()
+    print_report(stations, time.monotonic() - start_time)
+    context.term()
+
+
+if __name__ == "__main__":
+    main()
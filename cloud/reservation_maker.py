@@ -1,6 +1,7 @@
 import logging
 
-from cloud.models import CurrentSpotState, ReservationRequest, ReservationStatus
+from cloud.models import CurrentSpotState, ReservationRequest, ReservationStatus, reservation_log
+from cloud.reservation_log import Event
 
 
 class ReservationMaker:
@@ -10,6 +11,7 @@ class ReservationMaker:
             duration: int
     ):
         reservation_request = ReservationRequest(
+            station_id=spot.station_id,
             spot_id=spot.spot_id,
             duration_in_seconds=duration
         ).add()
@@ -19,7 +21,12 @@ class ReservationMaker:
             reservation_id=reservation_id,
             duration=duration,
         )
+        if reservation_log is not None:
+            reservation_log.append(
+                Event.requested, reservation_id, spot.spot_id, duration, station_id=spot.station_id
+            )
         logging.info(
-            f"Request created for reservation {reservation_id} if spot {spot.spot_id}, reservation duration: {duration}"
+            f"Request created for reservation {reservation_id} of spot {spot.spot_id} at station {spot.station_id}, "
+            f"reservation duration: {duration}"
         )
         return reservation_id
@@ -1,61 +1,68 @@
-import datetime
 import os
-import itertools
 import logging
-import time
+import threading
 
-import pytz
 import zmq
 import json
 from dotenv import load_dotenv
 
-from cloud.models import CurrentSpotState, ReservationStatus, SpotStateData, CurrentElectricityState, ElectricityData
+from cloud.models import (
+    CurrentSpotState,
+    ReservationStatus,
+    SpotStateData,
+    CurrentElectricityState,
+    ElectricityData,
+    transaction,
+    release_session,
+    reservation_log,
+)
+from cloud.clock import clock_from_env
+from cloud.compression import decode, frame_like
+from cloud.ingest import decode_readings
+from cloud.constants import DEFAULT_STATION_ID, INGEST_WORKERS
+from cloud.instrumentation import get_instrumentation
+from cloud.recorder import get_recorder_from_env, EDGE_TO_CLOUD
+from cloud.reservation_log import Event
+from cloud.timeutil import parse_timestamp, to_epoch_ms
 
 load_dotenv()
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-context = zmq.Context()
-server = context.socket(zmq.REP)
-logging.info('Listening to the incoming requests...')
-server.bind(os.getenv("bind_address"))
-
-
-def convert_json_string_to_datetime(timestamp, with_ms):
-    format = "%Y-%m-%d %H:%M:%S"
-    if with_ms:
-        format += ".%f"
-    return datetime.datetime.strptime(
-                    timestamp, format
-                ).replace(tzinfo=pytz.utc)
-
+WORKERS_ADDRESS = "inproc://ingest-workers"
+PRIORITY_WORKER_ADDRESS = "inproc://priority-worker"  # reservation responses of link.py, see LinkServer
 
-for cycles in itertools.count():
-    request = server.recv()
-    request = json.loads(request.decode())
-    #print(request)
-
-    # process sensor data
-    sensor_data = request.get("sensor_data")
-    rejected_reservations = request.get("rejected_reservations")
-    confirmed_reservations = request.get("confirmed_reservations")
-    electricity_data = request.get("electricity_info")
+context = zmq.Context()
+recorder = get_recorder_from_env()  # records incoming traffic for replay, if enabled
+
+
+def update_spot_states(station_id, number_of_spots, latest_readings, confirmed_reservations, rejected_reservations):
+    # iterate over current spot state of the station and update state and reservations
+    spot_states = CurrentSpotState.get_current_states(station_id)
+    if not spot_states:
+        # first message of a new station
+        spot_ids = set(range(number_of_spots or 0)) | set(latest_readings)
+        logging.info(f"New station {station_id} with spots {sorted(spot_ids)}")
+        CurrentSpotState.initialize_spots(station_id, spot_ids)
+        spot_states = CurrentSpotState.get_current_states(station_id)
+
+    def log_event(event, spot_state, timestamp=None):
+        if reservation_log is not None:
+            reservation_log.append(
+                event, spot_state.reservation_id, spot_state.spot_id, spot_state.reservation_duration,
+                station_id=station_id, timestamp=timestamp,
+            )
 
-    # iterate over current spot state and update state and reservations
-    spot_states = CurrentSpotState.get_current_states()
     for spot_state in spot_states:
         spot_id = spot_state.spot_id
-        # get latest data and set current state accordingly
-        new_readings = sensor_data[str(spot_id)]
-        if new_readings:
-            latest_reading = sorted(new_readings, key=lambda d: d['datetime'], reverse=True)[0]
-            is_occupied = latest_reading["is_occupied"]
-            spot_state.update_occupied_and_battery_state(
-                is_occupied=latest_reading["is_occupied"],
-                battery_level=latest_reading["battery_level"]
-            )
+        # set current state according to the latest reading of the spot
+        latest_reading = latest_readings.get(spot_id)
+        if latest_reading is not None:
+            is_occupied, battery_level = latest_reading
+            spot_state.update_occupied_and_battery_state(is_occupied=is_occupied, battery_level=battery_level)
             # remove reservations for already removed bikes
             if not is_occupied and spot_state.reservation_status != ReservationStatus.no_reservation:
+                log_event(Event.ended, spot_state)
                 spot_state.end_reservation()
 
         # update reservation state if responses have been received
@@ -67,63 +74,127 @@ for cycles in itertools.count():
         if spot_reservation_id:
             reservation_id_key = str(spot_reservation_id)
             if reservation_id_key in confirmed_reservations.keys():
-                valid_from_datetime = convert_json_string_to_datetime(
-                    confirmed_reservations[reservation_id_key], True
-                )
+                valid_from_datetime = parse_timestamp(confirmed_reservations[reservation_id_key])
+                if spot_state.reservation_status != ReservationStatus.reservation_confirmed:
+                    # confirmations are resent until the edge got the ack
+                    log_event(Event.confirmed, spot_state, to_epoch_ms(valid_from_datetime))
                 spot_state.update_reservation_state(
                     reservation_status=ReservationStatus.reservation_confirmed,
                     reservation_id=spot_reservation_id,
                     valid_from=valid_from_datetime,
                 )
             if spot_reservation_id in rejected_reservations:
+                log_event(Event.rejected, spot_state)
                 spot_state.update_reservation_state(
                     reservation_status=ReservationStatus.no_reservation
                 )
 
-    # update electricity data state
+
+def update_electricity_state(station_id, electricity_data):
+    # update electricity data state of the station
     if electricity_data:
-        latest_data = sorted(
-            electricity_data.values(), key=lambda d: d['datetime'], reverse=True
-        )[0]
-        current_state = CurrentElectricityState.get_current_state()
+        latest_data = max(electricity_data.values(), key=lambda d: d['datetime'])
+        current_state = CurrentElectricityState.get_current_state(station_id)
 
-        while current_state is None:
-            logging.info('Database is empty. Waiting for some information')
-            time.sleep(3)
-            current_state = CurrentElectricityState.get_current_state()
+        if current_state is None:
+            CurrentElectricityState.initialize(station_id)
+            current_state = CurrentElectricityState.get_current_state(station_id)
 
         current_state.update_state(latest_data)
 
-    logging.info("Successfully updated state.")
-
-    # persist all received readings to db
-    received_readings = []  # for monitoring purposes only
-    for spot_id, data_list in sensor_data.items():
-        for reading in data_list:
-            received_readings.append(reading["reading_id"])
-            SpotStateData(
-                spot_id=spot_id,
-                sensor_reading_id=reading["reading_id"],
-                is_occupied=reading["is_occupied"],
-                sensor_reading_timestamp=convert_json_string_to_datetime(reading["datetime"], False),
-                battery_level=reading["battery_level"]
-            )
-    logging.info(f"Saved readings {received_readings}")
-
-    # persist all received electricity data to db
-    received_data_items = []  # for monitoring purposes only
-    for item_id, electricity_data_item in electricity_data.items():
-        received_data_items.append(item_id)
-        ElectricityData(
-            data_item_id=int(item_id),
-            data_timestamp=convert_json_string_to_datetime(electricity_data_item["datetime"], False),
-            production=electricity_data_item["production"],
-            feed_in=electricity_data_item["feed_in"],
-            self_consumption=electricity_data_item["self_consumption"],
-            consumption_saving=electricity_data_item["consumption_saving"],
-            feed_in_revenue=electricity_data_item["feed_in_revenue"],
-        )
-    logging.info(f"Saved electricity data items {received_data_items}")
 
+def persist_readings(station_id, readings):
+    # persist all received readings to the history of the station in one bulk insert
+    SpotStateData.bulk_add(station_id, readings.rows(station_id))
+    logging.info(f"Saved {len(readings)} readings")
+
+
+def persist_electricity_data(station_id, electricity_data):
+    # persist all received electricity data to the history of the station in one bulk insert
+    rows = [
+        {
+            "station_id": station_id,
+            "data_item_id": int(item_id),
+            "data_timestamp": parse_timestamp(electricity_data_item["datetime"]),
+            "production": electricity_data_item["production"],
+            "feed_in": electricity_data_item["feed_in"],
+            "self_consumption": electricity_data_item["self_consumption"],
+            "consumption_saving": electricity_data_item["consumption_saving"],
+            "feed_in_revenue": electricity_data_item["feed_in_revenue"],
+        }
+        for item_id, electricity_data_item in electricity_data.items()
+    ]
+    ElectricityData.bulk_add(station_id, rows)
+    logging.info(f"Saved electricity data items {list(electricity_data.keys())}")
+
+
+def handle_request(raw_request, metrics):
+    """Processes one message of an edge station and returns the reply."""
+    metrics.count("bytes_received", len(raw_request))
+    if recorder:
+        recorder.record(EDGE_TO_CLOUD, raw_request)
+    with metrics.timer("deserialize"):
+        request = json.loads(raw_request.decode())
+    #print(request)
+
+    # process sensor data
+    station_id = request.get("station_id", DEFAULT_STATION_ID)
+    sensor_data = request.get("sensor_data")
+    rejected_reservations = request.get("rejected_reservations")
+    confirmed_reservations = request.get("confirmed_reservations")
+    electricity_data = request.get("electricity_info")
+
+    with metrics.timer("decode_readings"):
+        readings = decode_readings(sensor_data)
+        latest_readings = readings.latest_per_spot()
+
+    with metrics.timer("update_state"), transaction():
+        update_spot_states(
+            station_id, request.get("number_of_spots"), latest_readings, confirmed_reservations, rejected_reservations
+        )
+        update_electricity_state(station_id, electricity_data)
+    logging.info(f"Successfully updated state of station {station_id}.")
+
+    with metrics.timer("persist"), transaction():
+        persist_readings(station_id, readings)
+        persist_electricity_data(station_id, electricity_data)
+    metrics.count("readings", len(readings))
+    metrics.count("electricity_items", len(electricity_data))
+    release_session()
     # after making sure that all data have been processed send ok reply
-    server.send(str(len(request)).encode())
+    return str(len(request)).encode()
+
+
+def run_worker(worker_number, address=WORKERS_ADDRESS):
+    """Handles requests in a thread of its own. Every station waits for the reply before sending again,
+    so requests of one station are never processed concurrently, while different stations are.
+    """
+    worker = context.socket(zmq.REP)
+    worker.connect(address)
+    metrics = get_instrumentation(f"cloud_server_worker_{worker_number}")
+    while True:
+        request = worker.recv()
+        with metrics.timer("decompress"):
+            request, framed = decode(request)
+        try:
+            reply = handle_request(request, metrics)
+        except Exception:
+            logging.exception("Failed to process request")
+            release_session()
+            reply = b"0"  # not acknowledged, the station sends the data again
+        with metrics.timer("send"):
+            worker.send(frame_like(reply, framed))
+        metrics.end_cycle()
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    frontend = context.socket(zmq.ROUTER)
+    logging.info('Listening to the incoming requests...')
+    frontend.bind(os.getenv("bind_address"))
+    backend = context.socket(zmq.DEALER)
+    backend.bind(WORKERS_ADDRESS)
+    for number in range(INGEST_WORKERS):
+        threading.Thread(target=run_worker, args=(number,), name=f"ingest-worker-{number}", daemon=True).start()
+    # distribute requests of all stations over the workers
+    zmq.proxy(frontend, backend)
@@ -0,0 +1,85 @@
+"""One time representation for edge and cloud.
+
+On the wire and in hot paths timestamps are integer milliseconds since the unix epoch (UTC),
+durations are measured with the monotonic clock. Datetimes only appear at the db boundary.
+The current time comes from the installed clock, which may be simulated (see clock.py).
+
+    python timeutil.py  benchmarks the codec against the former strptime based parsing
+"""
+import datetime
+
+from cloud.clock import get_clock
+
+UTC = datetime.timezone.utc
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=UTC)
+NAIVE_EPOCH = datetime.datetime(1970, 1, 1)
+ONE_MILLISECOND = datetime.timedelta(milliseconds=1)
+
+
+def now_ms():
+    """Current wall clock time in epoch milliseconds."""
+    return int(get_clock().time() * 1000)
+
+
+def monotonic():
+    """Seconds of a clock that never jumps, for measuring durations."""
+    return get_clock().monotonic()
+
+
+def utcnow():
+    """Current time as naive UTC datetime, comparable with timestamps read from sqlite."""
+    return datetime.datetime.utcfromtimestamp(get_clock().time())
+
+
+def to_epoch_ms(value):
+    """Epoch milliseconds of a datetime, naive datetimes are taken as UTC."""
+    if value.tzinfo is None:
+        return (value - NAIVE_EPOCH) // ONE_MILLISECOND
+    return (value - EPOCH) // ONE_MILLISECOND
+
+
+def from_epoch_ms(milliseconds):
+    """Timezone aware UTC datetime of epoch milliseconds."""
+    return EPOCH + datetime.timedelta(milliseconds=milliseconds)
+
+
+def parse_timestamp(value):
+    """Datetime (aware, UTC) of a timestamp received on the wire: epoch milliseconds,
+    or an ISO 8601 string as sent by older versions.
+    """
+    if isinstance(value, (int, float)):
+        return from_epoch_ms(value)
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=UTC)
+    return parsed
+
+
+def json_default(value):
+    """`default` for json.dumps: datetimes become epoch milliseconds, everything else its string."""
+    if isinstance(value, datetime.datetime):
+        return to_epoch_ms(value)
+    return str(value)
+
+
+def _benchmark(number=100000):
+    import timeit
+
+    timestamp = datetime.datetime(2021, 7, 1, 12, 30, 15, 123456)
+    as_string = str(timestamp)
+    as_ms = to_epoch_ms(timestamp)
+    candidates = {
+        "strptime (former)": lambda: datetime.datetime.strptime(as_string, "%Y-%m-%d %H:%M:%S.%f").replace(tzinfo=UTC),
+        "fromisoformat": lambda: parse_timestamp(as_string),
+        "epoch ms": lambda: parse_timestamp(as_ms),
+        "encode str (former)": lambda: str(timestamp),
+        "encode epoch ms": lambda: json_default(timestamp),
+    }
+    print(f"{'codec':<22} | {'us per call':>11}")
+    for name, function in candidates.items():
+        seconds = min(timeit.repeat(function, number=number, repeat=3))
+        print(f"{name:<22} | {seconds / number * 1e6:>11.3f}")
+
+
+if __name__ == "__main__":
+    _benchmark()
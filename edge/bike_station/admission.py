@@ -0,0 +1,64 @@
+import logging
+
+from edge.timeutil import utcnow
+
+
+class AdmissionEngine:
+    """Decides a whole batch of reservation requests at once.
+    Requests are checked against the in-memory spot index of the station, conflicts for the same spot are
+    resolved deterministically (earliest request first, then lowest reservation id) and all decisions
+    are written with one transaction. The spots are only reserved once the decisions are stored (apply),
+    after a failed commit the requests are decided again.
+    """
+
+    def __init__(self, spots):
+        self.spots = spots  # spot_id -> BikeSpot
+
+    @staticmethod
+    def request_expired(received_timestamp, duration, now):
+        # same rule as Reservation.reservation_expired for requested reservations
+        return int(duration - (now - received_timestamp).total_seconds()) <= 0
+
+    def decide(self, requests, now=None):
+        """Decides the requests, given as (reservation_id, spot_id, duration, received_timestamp), without
+        changing the spots. Returns the confirmed reservations as (reservation_id, confirmed_at) and the ids of
+        rejected ones.
+        """
+        now = now or utcnow()
+        confirmed = []
+        rejected_ids = []
+        reserved_spot_ids = set()  # by an earlier request of this batch
+        for reservation_id, spot_id, duration, received_timestamp in sorted(
+                requests, key=lambda request: (request[3], request[0])
+        ):
+            spot = self.spots.get(spot_id)
+            if self.request_expired(received_timestamp, duration, now):
+                logging.warning(f"Reservation request {reservation_id} has expired. Will be rejected.")
+                rejected_ids.append(reservation_id)
+            elif spot is None or not spot.occupied_sensor.occupied:
+                logging.warning(
+                    f"Cannot make reservation for spot {spot_id} (reservation {reservation_id})."
+                    f" Spot is not occupied anymore."
+                )
+                rejected_ids.append(reservation_id)
+            elif spot.reservation_state.is_reserved or spot_id in reserved_spot_ids:
+                logging.warning(
+                    f"Cannot make reservation for spot {spot_id} (reservation {reservation_id})."
+                    f" Is already reserved."
+                )
+                rejected_ids.append(reservation_id)
+            else:
+                reserved_spot_ids.add(spot_id)
+                confirmed.append((reservation_id, now))
+        return confirmed, rejected_ids
+
+    def apply(self, confirmed, requests):
+        """Reserves the spots of the confirmed reservations, once the decisions are stored."""
+        requests = {request[0]: request for request in requests}
+        for reservation_id, confirmed_at in confirmed:
+            _, spot_id, duration, _ = requests[reservation_id]
+            self.spots[spot_id].reserve(reservation_id, duration, confirmed_at)
+            print(
+                f"Reservation made for spot {spot_id} at {confirmed_at} with reservation id {reservation_id} "
+                f"for {duration} seconds."
+            )
@@ -1,12 +1,32 @@
-import logging
+import itertools
+import os
 import random
-from time import sleep
 
+from edge.bike_station.admission import AdmissionEngine
 from edge.bike_station.bike_spot import BikeSpot
 from edge.bike_station.sensors import SolarPanelSensor
 from edge.bike_station import models
-from edge.constants import ELECTRICITY_CONTRACT_KWH_PRICE
-from edge.models import Constant, Reservation, ReservationStatus
+from edge.bike_station.snapshot import write_snapshot, restore_snapshot
+from edge.clock import Scheduler, clock_from_env
+from edge.constants import (
+    ELECTRICITY_CONTRACT_KWH_PRICE,
+    NUMBER_OF_SPOTS,
+    OUTBOX_CHECK_INTERVAL,
+    SNAPSHOT_FILE,
+    SNAPSHOT_INTERVAL,
+    STATION_CYCLE_INTERVAL,
+)
+from edge.compactor import Compactor
+from edge.instrumentation import get_instrumentation
+from edge.outbox import OutboxBudget
+from edge.models import (
+    Reservation, current_constant_cache, current_reservation_log, current_ring_outbox, transaction,
+    release_session,
+)
+from edge.reservation_log import Event
+from edge.timeutil import utcnow, to_epoch_ms
+
+metrics = get_instrumentation("bike_station")
 
 
 class BikeStation:
@@ -17,9 +37,13 @@ class BikeStation:
     electricity_contract_price = 0.4
     current_market_price = 0.4
 
-    def __init__(self, number_of_spots=5):
+    def __init__(self, number_of_spots=5, outbox=None):
         self.number_of_spots = number_of_spots
+        self.outbox = outbox
+        self.last_stored_occupied_state = {}
+        self.last_read_id = 0  # last reading stored in the outbox, its tail starts after it
         self.spots = dict((i, BikeSpot(i)) for i in range(0, number_of_spots))
+        self.admission = AdmissionEngine(self.spots)
         # solar panel's production capacity is abstracted to equal exactly the demand
         # of the fully occupied station, i.e. number_of_spots
         self.solar_panel_sensor = SolarPanelSensor(production_capacity=number_of_spots)
@@ -34,7 +58,9 @@ class BikeStation:
         decide whether to feed in and/or self-consume produced electricity.
         """
         # electricity demand is abstracted to equal the number of occupied spots
-        self.current_market_price = models.Constant.get_real_value_by_name('current_market_price')
+        self.current_market_price = current_constant_cache().get_real_value(
+            'current_market_price', self.electricity_contract_price
+        )
         current_demand = self.get_number_of_occupied_spots()
         current_production = self.solar_panel_sensor.current_production
         if (
@@ -63,55 +89,34 @@ class BikeStation:
     def calculate_self_consumption_savings(self):
         return round(self.self_consumption * self.electricity_contract_price, 4)
 
-    def reserve_spot(self, spot_id, reservation_id, duration):
-        spot_to_reserve = self.spots.get(spot_id)
-        if (
-            spot_to_reserve is not None
-            and spot_to_reserve.occupied_sensor.occupied
-            and not spot_to_reserve.reservation_state.is_reserved
-
-        ):
-            # spot can be reserved
-            created_at = spot_to_reserve.reserve(reservation_id, duration)
-            print(
-                f"Reservation made for spot {spot_id} at {created_at} with reservation id {reservation_id} for {duration} seconds."
-            )
-            return ReservationStatus.reservation_confirmed, created_at
-        elif not spot_to_reserve.occupied_sensor.occupied:
-            logging.warning(
-                f"Cannot make reservation for spot {spot_id} (reservation {reservation_id})."
-                f" Spot is not occupied anymore."
-                )
-            # %a, %d %b %Y %H:%M:%S UTC'
-            return ReservationStatus.reservation_unfeasible, None
-        else:
-            logging.warning(
-                f"Cannot make reservation for spot {spot_id} (reservation {reservation_id})."
-                f" Is already reserved."
-            )
-            return ReservationStatus.reservation_unfeasible, None
-
     def perform_reservations(self):
-        """Make reservations and update changes in DB to enable confirmation message for cloud component"""
-        open_reservations = Reservation.get_open_reservation_requests()
-        for reservation in open_reservations:
-            # check if validity of request has expired already
-            if reservation.reservation_expired():
-                print("Reservation request has expired. Will be rejected.")
-                reservation.update_to_unfeasible()
-                continue
-            # try to make reservation
-            reservation_status, reservation_created_at = self.reserve_spot(
-                spot_id=reservation.spot_id,
-                reservation_id=reservation.reservation_id,
-                duration=reservation.duration_in_seconds
-            )
-            if reservation_status == ReservationStatus.reservation_confirmed:
-                print(f"Confirming Reservation {reservation.reservation_id}")
-                reservation.update_to_confirmed(reservation_created_at)
-            else:
-                print(f"Rejecting Reservation {reservation.reservation_id}")
-                reservation.update_to_unfeasible()
+        """Make reservations and update changes in DB to enable confirmation message for cloud component.
+        All open requests are decided as one batch and written in one transaction.
+        """
+        with metrics.timer("db_query"), transaction():
+            Reservation.stamp_received_requests()
+            open_requests = Reservation.get_open_reservation_request_summaries()
+        metrics.count("reservation_requests", len(open_requests))
+        if not open_requests:
+            return
+        confirmed, rejected_ids = self.admission.decide(open_requests)
+        with metrics.timer("commit"), transaction():
+            Reservation.bulk_update_decisions(confirmed, rejected_ids)
+        # only stored decisions reserve spots, if the commit failed the requests are still open in the db
+        self.admission.apply(confirmed, open_requests)
+        log = current_reservation_log()
+        if log is not None:
+            requests = {request[0]: request for request in open_requests}
+            for reservation_id, confirmed_at in confirmed:
+                _, spot_id, duration, _ = requests[reservation_id]
+                log.append(Event.confirmed, reservation_id, spot_id, duration, timestamp=to_epoch_ms(confirmed_at))
+            for reservation_id in rejected_ids:
+                _, spot_id, duration, _ = requests[reservation_id]
+                log.append(Event.rejected, reservation_id, spot_id, duration)
+        if confirmed:
+            print(f"Confirming Reservations {[reservation_id for reservation_id, _ in confirmed]}")
+        if rejected_ids:
+            print(f"Rejecting Reservations {rejected_ids}")
 
     def update_electricity_status(self):
         self.solar_panel_sensor.update_current_production()
@@ -125,11 +130,13 @@ class BikeStation:
         }
 
     def run_station(self):
-        spot_states = dict(
-            (spot_id, spot.get_spot_state()) for spot_id, spot in self.spots.items()
-        )
-        electricity_status = self.update_electricity_status()
-        models.ElectricityData(**electricity_status).add()
+        with metrics.timer("sense"):
+            spot_states = dict(
+                (spot_id, spot.get_spot_state()) for spot_id, spot in self.spots.items()
+            )
+            electricity_status = self.update_electricity_status()
+        with metrics.timer("commit"):
+            models.ElectricityData(**electricity_status).add()
         print("\n-------------------------- Current Electricity info -----------------------------------------------------------")
         print(
             "{:<12} | {:<10} | {:<16} | {:<18} | {:<14} | {:<16}".format(
@@ -162,10 +169,22 @@ class BikeStation:
                 "Remaining Reservation Time",
             )
         )
+        ring_outbox = current_ring_outbox()
         for spot_id, spot_state in spot_states.items():
             battery_level = spot_state.get("bike_battery_level")
-            models.SpotSensorData(spot_id=spot_id, is_occupied=spot_state["occupied"],
-                                  battery_level=battery_level).add()
+            is_transition = self.last_stored_occupied_state.get(spot_id) != spot_state["occupied"]
+            if self.outbox is None or self.outbox.accepts_reading(is_transition):
+                if ring_outbox is None:
+                    with metrics.timer("commit"):
+                        reading = models.SpotSensorData(spot_id=spot_id, is_occupied=spot_state["occupied"],
+                                                        battery_level=battery_level).add()
+                    self.last_read_id = reading.read_id
+                else:
+                    self.last_read_id = ring_outbox.append(spot_id, spot_state["occupied"], battery_level)
+                self.last_stored_occupied_state[spot_id] = spot_state["occupied"]
+                metrics.count("readings")
+            else:
+                metrics.count("readings_rejected")
             print(
                 "{:<12} | {:<8} | {:<18} | {:<8} | {:<22} | {:<26} ".format(
                     spot_id,
@@ -176,28 +195,60 @@ class BikeStation:
                     spot_state.get("remaining_reservation_time") or "",
                 )
             )
+        if ring_outbox is not None:
+            # the readings of the cycle survive a power loss as well, like a commit
+            with metrics.timer("commit"):
+                ring_outbox.flush()
 
 
 if __name__ == "__main__":
     print("Starting Bike Station Edge Device")
-    # Set market price constant to electricity contract price until cloud component provides actual market price
-    Constant(name='current_market_price', real_value=ELECTRICITY_CONTRACT_KWH_PRICE).save_or_update()
+    clock = clock_from_env()
     # Setup station
-    station = BikeStation()
-    # If starting up happens after crash, there can be non-expired reservations that need to be added to state
-    confirmed_reservations = Reservation.get_confirmed_reservations()
-    for reservation in confirmed_reservations:
-        if not reservation.reservation_expired():
-            station.spots[reservation.spot_id].reservation_state.recover_from_db(reservation)
-
-    while True:
+    # clean up processed rows continuously in the background
+    Compactor(metrics=metrics).start()
+    outbox = OutboxBudget(metrics=metrics)
+    station = BikeStation(number_of_spots=NUMBER_OF_SPOTS, outbox=outbox)
+    # If starting up happens after crash, restore the state of the last snapshot
+    with metrics.timer("restore"):
+        market_price = restore_snapshot(station, SNAPSHOT_FILE)
+    if market_price is None:
+        # Set market price constant to electricity contract price until cloud component provides actual market price
+        market_price = ELECTRICITY_CONTRACT_KWH_PRICE
+        # there can be non-expired reservations that need to be added to state
+        confirmed_reservations = Reservation.get_confirmed_reservations()
+        now = utcnow()
+        for reservation in confirmed_reservations:
+            if not reservation.reservation_expired(now):
+                station.spots[reservation.spot_id].reservation_state.recover_from_db(reservation)
+    current_constant_cache().set_real_value('current_market_price', market_price)
+    release_session()
+
+    cycles = itertools.count()
+
+    def run_cycle():
+        cycle = next(cycles)
+        if cycle % OUTBOX_CHECK_INTERVAL == 0:
+            with metrics.timer("outbox"):
+                outbox.enforce()
         print(
             "\n \n------------------------------------------ GETTING NEW STATION STATE --------------------------------------"
         )
-        station.run_station()
+        # store all readings of the cycle in one transaction
+        with transaction():
+            station.run_station()
         print(
             "\n \n------------------------------------------ GETTING RESERVATIONS --------------------------------------------"
         )
         station.perform_reservations()
-
-        sleep(4)
+        if cycle % SNAPSHOT_INTERVAL == 0:
+            with metrics.timer("snapshot"):
+                write_snapshot(station, SNAPSHOT_FILE, station.last_read_id)
+        release_session()
+        metrics.end_cycle()
+
+    scheduler = Scheduler(clock)
+    scheduler.call_every(STATION_CYCLE_INTERVAL, run_cycle)
+    # clock_run_for limits the run, e.g. to simulate one day (86400) with clock=simulated
+    run_for = os.getenv("clock_run_for")
+    scheduler.run(float(run_for) if run_for else None)
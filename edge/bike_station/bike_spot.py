@@ -1,9 +1,10 @@
 import datetime
 
-import pytz as pytz
 
 from edge.bike_station.sensors import SpotOccupiedSensor, BikeBatterySensor
-from edge.models import Reservation
+from edge.models import Reservation, current_reservation_log
+from edge.reservation_log import Event
+from edge.timeutil import utcnow, UTC
 
 
 class BikeSpot:
@@ -25,10 +26,10 @@ class BikeSpot:
         spot_state_info.update(self._get_reservation_state())
         return spot_state_info
 
-    def reserve(self, reservation_id, duration):
+    def reserve(self, reservation_id, duration, created_at=None):
         """Create reservation for spot."""
         if self.occupied_sensor.occupied and not self.reservation_state.is_reserved:
-            return self.reservation_state.make_reservation(reservation_id, duration)
+            return self.reservation_state.make_reservation(reservation_id, duration, created_at)
 
     def _update_spot_state(self):
         """Simulates bike is staying/getting removed/just being parked at empty spot
@@ -42,12 +43,17 @@ class BikeSpot:
             # case bike has been removed
             self.bike_battery_sensor = None
             #Reservation.clean_when_bike_removed(self.spot_id) TODO remove if not required
-            self.reservation_state.end_reservation_if_exists()
+            self._log_reservation_event(Event.ended, self.reservation_state.end_reservation_if_exists())
         if not old_occupied_state and self.occupied_sensor.occupied:
             # case spot was empty and is now taken by new bike
             self.bike_battery_sensor = BikeBatterySensor()
         # update reservation state
-        self.reservation_state.end_reservation_if_expired()
+        self._log_reservation_event(Event.expired, self.reservation_state.end_reservation_if_expired())
+
+    def _log_reservation_event(self, event, reservation_id):
+        log = current_reservation_log()
+        if reservation_id is not None and log is not None:
+            log.append(event, reservation_id, self.spot_id)
 
     def _sense_bike_battery_level(self):
         """Returns current battery level of parked bike if spot is occupied."""
@@ -74,7 +80,7 @@ class ReservationState:
     def __init__(self):
         # dummy reservation creation timestamp
         self.default_created_at = datetime.datetime(
-            2000, 1, 1, 0, 0, 0, tzinfo=pytz.utc
+            2000, 1, 1, 0, 0, 0, tzinfo=UTC
         )
         self.reservation_created_at = self.default_created_at
         self.reservation_id = 0
@@ -92,27 +98,36 @@ class ReservationState:
             return 0
         return int(
             self.duration
-            - (datetime.datetime.utcnow() - self.reservation_created_at).total_seconds()
+            - (utcnow() - self.reservation_created_at).total_seconds()
         )
 
-    def make_reservation(self, reservation_id, duration):
-        self.reservation_created_at = datetime.datetime.utcnow()
+    def make_reservation(self, reservation_id, duration, created_at=None):
+        self.reservation_created_at = created_at or utcnow()
         self.reservation_id = reservation_id
         self.duration = duration
         return self.reservation_created_at
 
     def end_reservation_if_exists(self):
+        """Returns the id of the ended reservation, None if there was none."""
         if self.is_reserved:
             self.reservation_created_at = self.default_created_at
             self.last_reservation_id = self.reservation_id
             self.reservation_id = 0
             self.duration = 0
+            return self.last_reservation_id
+        return None
 
     def end_reservation_if_expired(self):
         if self.remaining_time <= 0:
-            self.end_reservation_if_exists()
+            return self.end_reservation_if_exists()
+        return None
+
+    def recover(self, reservation_id, duration, confirmed_at):
+        self.reservation_id = reservation_id
+        self.duration = duration
+        self.reservation_created_at = confirmed_at
 
     def recover_from_db(self, reservation_entry: Reservation):
-        self.reservation_id = reservation_entry.reservation_id
-        self.duration = reservation_entry.duration_in_seconds
-        self.reservation_created_at = reservation_entry.confirmed_at
+        self.recover(
+            reservation_entry.reservation_id, reservation_entry.duration_in_seconds, reservation_entry.confirmed_at
+        )
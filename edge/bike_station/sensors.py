@@ -1,6 +1,7 @@
-import datetime
 import random
 
+from edge.timeutil import monotonic
+
 
 class SpotOccupiedSensor:
     def __init__(self):
@@ -23,14 +24,14 @@ class BikeBatterySensor:
         # initial is battery level never 0% or 100%
         self.battery_level = round(random.uniform(0.01, 0.99), 4)
         self.level_increase_per_second = 0.0033
-        self.last_sensed = datetime.datetime.utcnow()
+        self.last_sensed = monotonic()  # only used for durations
 
     def _update_battery_level(self):
         """Increases battery level depending on seconds passed since last reading.
         No effect on battery level, if battery is fully charged
         """
-        now = datetime.datetime.utcnow()
-        seconds_passed = (now - self.last_sensed).total_seconds()
+        now = monotonic()
+        seconds_passed = now - self.last_sensed
         self.last_sensed = now
         if self.battery_level == 1:
             return
@@ -0,0 +1,194 @@
+"""Crash-recovery snapshots of the in-memory station state.
+
+The station periodically writes its full state (spots, sensors, reservations, last market price) to a small binary
+file, atomically: a crash while writing leaves the previous snapshot intact. On restart the snapshot is loaded and
+the outbox tail, i.e. readings stored and reservations confirmed after the snapshot, is replayed on top of it.
+With the reservation log enabled, reservations are replayed from the tail of the log instead of queried from the db.
+Without a usable snapshot the station falls back to recovering confirmed reservations from the db.
+
+File layout (little endian): header, one record per spot, crc32 of everything before it.
+"""
+import logging
+import os
+import struct
+import zlib
+
+from edge.bike_station.sensors import BikeBatterySensor
+from edge.clock import get_clock
+from edge.models import SpotSensorData, Reservation, current_reservation_log, current_ring_outbox
+from edge.reservation_log import Event, ReservationView
+from edge.timeutil import monotonic, to_epoch_ms, from_epoch_ms, utcnow, now_ms
+
+MAGIC = b"BSSN"
+FORMAT_VERSION = 1
+# magic, format version, wall clock time of the snapshot, last stored reading id, market price,
+# solar production, number of spot records
+HEADER = struct.Struct("<4sHdqdII")
+# spot id, occupied, has bike battery, battery level, reservation id, reservation duration,
+# reservation created at (epoch ms, 0 if not reserved), last reservation id (-1 if none),
+# last stored occupied state (0 = not occupied, 1 = occupied, 2 = unknown)
+SPOT = struct.Struct("<I??dqIqqB")
+CHECKSUM = struct.Struct("<I")
+
+UNKNOWN_OCCUPIED_STATE = 2
+
+
+def _encode_spot(spot_id, spot, last_stored_occupied_state):
+    reservation_state = spot.reservation_state
+    battery_sensor = spot.bike_battery_sensor
+    return SPOT.pack(
+        spot_id,
+        spot.occupied_sensor.occupied,
+        battery_sensor is not None,
+        battery_sensor.battery_level if battery_sensor is not None else 0.0,
+        reservation_state.reservation_id,
+        reservation_state.duration,
+        to_epoch_ms(reservation_state.reservation_created_at) if reservation_state.is_reserved else 0,
+        reservation_state.last_reservation_id if reservation_state.last_reservation_id is not None else -1,
+        UNKNOWN_OCCUPIED_STATE if last_stored_occupied_state is None else int(last_stored_occupied_state),
+    )
+
+
+def write_snapshot(station, path, last_read_id):
+    """Writes the state of the station to path atomically, last_read_id is the last reading stored in the db."""
+    records = [
+        _encode_spot(spot_id, spot, station.last_stored_occupied_state.get(spot_id))
+        for spot_id, spot in station.spots.items()
+    ]
+    data = HEADER.pack(
+        MAGIC,
+        FORMAT_VERSION,
+        get_clock().time(),
+        last_read_id or 0,
+        station.current_market_price,
+        station.solar_panel_sensor.current_production,
+        len(records),
+    ) + b"".join(records)
+    data += CHECKSUM.pack(zlib.crc32(data))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """Returns (header fields, spot records) of a snapshot, None if there is no intact snapshot."""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if len(data) < HEADER.size + CHECKSUM.size:
+        logging.warning(f"Snapshot {path} is truncated, ignoring it.")
+        return None
+    (checksum,) = CHECKSUM.unpack_from(data, len(data) - CHECKSUM.size)
+    if zlib.crc32(data[:-CHECKSUM.size]) != checksum:
+        logging.warning(f"Snapshot {path} is corrupt, ignoring it.")
+        return None
+    header = HEADER.unpack_from(data)
+    magic, version, _, _, _, _, number_of_spots = header
+    if magic != MAGIC or version != FORMAT_VERSION:
+        logging.warning(f"Snapshot {path} has an unknown format, ignoring it.")
+        return None
+    spots = [SPOT.unpack_from(data, HEADER.size + i * SPOT.size) for i in range(number_of_spots)]
+    return header, spots
+
+
+def _restore_spot(spot, record, seconds_since_snapshot):
+    (_, occupied, has_battery, battery_level, reservation_id, duration,
+     reservation_created_at, last_reservation_id, _) = record
+    spot.occupied_sensor.occupied = occupied
+    spot.bike_battery_sensor = None
+    if has_battery:
+        spot.bike_battery_sensor = BikeBatterySensor()
+        spot.bike_battery_sensor.battery_level = battery_level
+        # the bike kept charging while the station was down
+        spot.bike_battery_sensor.last_sensed = monotonic() - seconds_since_snapshot
+    reservation_state = spot.reservation_state
+    reservation_state.last_reservation_id = None if last_reservation_id < 0 else last_reservation_id
+    if reservation_created_at:
+        reservation_state.reservation_id = reservation_id
+        reservation_state.duration = duration
+        # reservation timestamps are naive UTC, like the ones read from sqlite
+        reservation_state.reservation_created_at = from_epoch_ms(reservation_created_at).replace(tzinfo=None)
+
+
+def _replay_reservation_log(station, log, snapshot_time):
+    """Applies the reservation events appended after the snapshot was written, returns their number."""
+    view = ReservationView(log, since=int(snapshot_time * 1000))
+    view.catch_up()
+    now = now_ms()
+    for reservation_id, record in view.reservations.items():
+        spot = station.spots.get(record.spot_id)
+        if spot is None:
+            continue
+        reservation_state = spot.reservation_state
+        if record.event == Event.confirmed and record.updated_at + record.duration * 1000 > now:
+            confirmed_at = from_epoch_ms(record.updated_at).replace(tzinfo=None)
+            reservation_state.recover(reservation_id, record.duration, confirmed_at)
+        elif record.event in (Event.ended, Event.expired) and reservation_state.reservation_id == reservation_id:
+            reservation_state.end_reservation_if_exists()
+    return len(view.reservations)
+
+
+def _replay_outbox_tail(station, last_read_id, snapshot_time):
+    """Applies readings and reservation confirmations stored after the snapshot was written."""
+    ring_outbox = current_ring_outbox()
+    if ring_outbox is None:
+        latest_readings = SpotSensorData.get_latest_per_spot_after(last_read_id)
+    else:
+        latest_readings = ring_outbox.latest_per_spot_after(last_read_id)
+    for spot_id, is_occupied, battery_level in latest_readings:
+        spot = station.spots.get(spot_id)
+        if spot is None:
+            continue
+        spot.occupied_sensor.occupied = is_occupied
+        if not is_occupied:
+            spot.bike_battery_sensor = None
+        else:
+            if spot.bike_battery_sensor is None:
+                spot.bike_battery_sensor = BikeBatterySensor()
+            if battery_level is not None:
+                spot.bike_battery_sensor.battery_level = battery_level
+        station.last_stored_occupied_state[spot_id] = is_occupied
+    log = current_reservation_log()
+    if log is not None:
+        return len(latest_readings), _replay_reservation_log(station, log, snapshot_time)
+    now = utcnow()
+    snapshot_datetime = from_epoch_ms(int(snapshot_time * 1000)).replace(tzinfo=None)
+    confirmed_reservations = Reservation.get_confirmed_since(snapshot_datetime)
+    for reservation in confirmed_reservations:
+        if reservation.spot_id in station.spots and not reservation.reservation_expired(now):
+            station.spots[reservation.spot_id].reservation_state.recover_from_db(reservation)
+    return len(latest_readings), len(confirmed_reservations)
+
+
+def restore_snapshot(station, path):
+    """Restores the station from the snapshot at path and replays the outbox tail.
+    Returns the restored market price, None if there was no usable snapshot.
+    """
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return None
+    header, records = snapshot
+    _, _, snapshot_time, last_read_id, market_price, solar_production, _ = header
+    seconds_since_snapshot = max(0.0, get_clock().time() - snapshot_time)
+    for record in records:
+        spot_id, last_stored_occupied_state = record[0], record[-1]
+        spot = station.spots.get(spot_id)
+        if spot is None:
+            continue
+        _restore_spot(spot, record, seconds_since_snapshot)
+        if last_stored_occupied_state != UNKNOWN_OCCUPIED_STATE:
+            station.last_stored_occupied_state[spot_id] = bool(last_stored_occupied_state)
+    station.current_market_price = market_price
+    station.solar_panel_sensor.current_production = solar_production
+    station.last_read_id = last_read_id
+    readings, reservations = _replay_outbox_tail(station, last_read_id, snapshot_time)
+    logging.info(
+        f"Restored station from snapshot of {seconds_since_snapshot:.0f}s ago, "
+        f"replayed {readings} spot readings and {reservations} reservations."
+    )
+    return market_price
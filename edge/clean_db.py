@@ -1,7 +1,8 @@
-# script for calling every hour as cronjob
+# one-off cleanup of processed entries, the bike station application compacts the db continuously
 import os, sys
-from models import SpotSensorData, ElectricityData, Reservation
 sys.path.insert(1, os.path.join(sys.path[0], '..'))  # to avoid possible relative import errors
-SpotSensorData.clean_processed()
-ElectricityData.clean_processed()
-Reservation.clean_finished()
+from edge.compactor import Compactor
+
+compactor = Compactor()
+compactor.enable_incremental_vacuum()
+print(f"Deleted {compactor.run_until_clean()} rows.")
@@ -2,82 +2,130 @@ import json
 import os, itertools
 import logging
 import time
+from collections import namedtuple
+
 import zmq
 from dotenv import load_dotenv
-from models import SpotSensorData, Status, Reservation, ElectricityData
+from edge.models import (
+    SpotSensorData, Status, Reservation, ElectricityData, transaction, release_session, current_ring_outbox
+)
+from edge.clock import clock_from_env
+from edge.compression import Codec, compression_enabled
+from edge.connection import ReliableRequester
+from edge.constants import DEFAULT_STATION_ID, NUMBER_OF_SPOTS
+from edge.instrumentation import get_instrumentation
+from edge.timeutil import json_default
 
 load_dotenv()
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
 
-REQUEST_TIMEOUT = 2500
+MAX_ATTEMPTS_PER_BATCH = 5  # the batch is fetched again afterwards, so it doesn't get stale
 server_url = os.getenv("server_address")
-context = zmq.Context()
-
-logging.info("Connecting to server...")
-client = context.socket(zmq.REQ)
-client.connect(server_url)
-
-for sequence in itertools.count():
-    # get oldest 10 sensor readings from db
-    queued_readings = SpotSensorData.get_oldest_n_readings(10)
-    # get oldest 10 electricity data items from db
-    queued_electricity_data = ElectricityData.get_oldest_n_readings(10)
-
-    # get processed reservations from db
-    confirmed_reservations = Reservation.get_confirmed_reservation_requests()
-    rejected_reservations = Reservation.get_rejected_reservation_requests()
-    if (
-            len(queued_readings) == 0
-            and len(confirmed_reservations) == 0
-            and len(rejected_reservations) == 0
-            and len(queued_electricity_data) == 0
-    ):
-        logging.info("No new data to be sent. Waiting...")
-        time.sleep(1)
-        continue
-
-    sensor_data_dict = SpotSensorData.make_query_dictionary(queued_readings)
-    electricity_data_dict = ElectricityData.make_query_dictionary(queued_electricity_data)
-    confirmed_reservations_dict = Reservation.make_confirmed_reservations_dict(confirmed_reservations)
-    rejected_reservations_list = [reservation.reservation_id for reservation in rejected_reservations]
-
-    message_dict = {
-        "sensor_data": sensor_data_dict,
-        "rejected_reservations": rejected_reservations_list,
-        "confirmed_reservations": confirmed_reservations_dict,
-        "electricity_info": electricity_data_dict,
-    }
-    encoded = json.dumps(message_dict, default=str).encode()
-
-    logging.info("Sending sensor data, electricity info and reservation responses.")
-    client.send(encoded)
-
-    while True:
-        if (client.poll(REQUEST_TIMEOUT) & zmq.POLLIN) != 0:
-            reply = client.recv()
-            if int(reply) == 4:  # sanity check with length of sent object
-                logging.info("Server replied OK")
-                # status of sent records need to be set to "processed"
-                if len(queued_readings) > 0:
-                    SpotSensorData.set_to_processed(queued_readings[len(queued_readings)-1].read_id)
-                if len(queued_electricity_data) > 0:
-                    ElectricityData.set_to_processed(queued_electricity_data[len(queued_electricity_data)-1].data_item_id)
-                for reservation in rejected_reservations:
-                    reservation.update_response_sent()
-                for reservation in confirmed_reservations:
-                    reservation.update_response_sent()
-                break
+station_id = int(os.getenv("station_id", DEFAULT_STATION_ID))
+
+# queued data and reservation responses sent to the cloud in one message
+OutgoingBatch = namedtuple(
+    "OutgoingBatch", ["readings", "electricity_data", "confirmed_reservations", "rejected_reservations"]
+)
+
+
+def get_outgoing_batch(metrics, reservation_responses=True):
+    """Queued data for the next message, without reservation_responses they are left to a batch of their own."""
+    ring_outbox = current_ring_outbox()
+    with metrics.timer("db_query"):
+        return OutgoingBatch(
+            # oldest 10 sensor readings and electricity data items
+            readings=SpotSensorData.get_oldest_n_readings(10) if ring_outbox is None else ring_outbox.peek(10),
+            electricity_data=ElectricityData.get_oldest_n_readings(10),
+            # processed reservations
+            confirmed_reservations=(
+                Reservation.get_confirmed_reservation_requests() if reservation_responses else []
+            ),
+            rejected_reservations=Reservation.get_rejected_reservation_requests() if reservation_responses else [],
+        )
+
+
+def get_reservation_responses(metrics):
+    """Batch of only the processed reservations, sent ahead of queued sensor data."""
+    with metrics.timer("db_query"):
+        return OutgoingBatch(
+            readings=[],
+            electricity_data=[],
+            confirmed_reservations=Reservation.get_confirmed_reservation_requests(),
+            rejected_reservations=Reservation.get_rejected_reservation_requests(),
+        )
+
+
+def is_empty(batch):
+    return not any(batch)
+
+
+def make_message_dict(batch, metrics, own_station_id=station_id, number_of_spots=NUMBER_OF_SPOTS):
+    metrics.count("readings", len(batch.readings))
+    metrics.count("electricity_items", len(batch.electricity_data))
+    metrics.count("reservation_responses", len(batch.confirmed_reservations) + len(batch.rejected_reservations))
+    with metrics.timer("serialize"):
+        return {
+            "station_id": own_station_id,
+            "number_of_spots": number_of_spots,
+            "sensor_data": SpotSensorData.make_query_dictionary(batch.readings),
+            "rejected_reservations": [reservation.reservation_id for reservation in batch.rejected_reservations],
+            "confirmed_reservations": Reservation.make_confirmed_reservations_dict(batch.confirmed_reservations),
+            "electricity_info": ElectricityData.make_query_dictionary(batch.electricity_data),
+        }
+
+
+def encode(message_dict):
+    return json.dumps(message_dict, default=json_default).encode()
+
+
+def mark_batch_sent(batch, metrics):
+    # status of sent records need to be set to "processed"
+    ring_outbox = current_ring_outbox()
+    with metrics.timer("commit"), transaction():
+        if len(batch.readings) > 0:
+            if ring_outbox is None:
+                SpotSensorData.set_to_processed(batch.readings[-1].read_id)
             else:
-                logging.error("Malformed reply from server: %s", reply)
-                continue
-        # {REQUEST_TIMEOUT} seconds passed, but no results yet
-        logging.warning("No response from server")
-        # Socket is confused. Close and remove it.
-        client.setsockopt(zmq.LINGER, 0)
-        client.close()
-        logging.info("Reconnecting to server…")
-        # Create new connection
-        client = context.socket(zmq.REQ)
-        client.connect(server_url)
-        logging.info("Resending sensor data, electricity info and reservation responses.")
-        client.send(encoded)
+                ring_outbox.consume(batch.readings[-1].read_id)
+        if len(batch.electricity_data) > 0:
+            ElectricityData.set_to_processed(batch.electricity_data[-1].data_item_id)
+        for reservation in batch.rejected_reservations:
+            reservation.update_response_sent()
+        for reservation in batch.confirmed_reservations:
+            reservation.update_response_sent()
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    context = zmq.Context()
+    metrics = get_instrumentation("edge_client")
+
+    logging.info("Connecting to server...")
+    client = ReliableRequester(context, server_url, metrics, name="cloud", codec=Codec(compression_enabled(), metrics))
+
+    for sequence in itertools.count():
+        batch = get_outgoing_batch(metrics)
+        if is_empty(batch):
+            logging.info("No new data to be sent. Waiting...")
+            release_session()
+            metrics.end_cycle()
+            time.sleep(1)
+            continue
+
+        message_dict = make_message_dict(batch, metrics)
+        with metrics.timer("serialize"):
+            encoded = encode(message_dict)
+
+        logging.info("Sending sensor data, electricity info and reservation responses.")
+        reply = client.request(encoded, max_attempts=MAX_ATTEMPTS_PER_BATCH)
+        if reply is None:
+            # the next batch also carries reservation responses and data queued in the meantime
+            logging.warning("No response from server, sending an up to date batch.")
+        elif int(reply) == len(message_dict):  # sanity check with length of sent object
+            logging.info("Server replied OK")
+            mark_batch_sent(batch, metrics)
+        else:
+            logging.error("Malformed reply from server: %s", reply)
+        release_session()
+        metrics.end_cycle()
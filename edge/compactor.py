@@ -0,0 +1,101 @@
+"""Continuous, incremental cleanup of the edge database.
+
+Deletes processed readings and electricity items and finished reservations in small chunks,
+hands freed pages back to the file system with incremental vacuum and checkpoints the write-ahead log.
+Every step is a short transaction on its own connection, so cleanup never stalls the station.
+"""
+import logging
+import threading
+import time
+
+from sqlalchemy import select
+
+from edge.constants import COMPACTION_INTERVAL, COMPACTION_CHUNK_SIZE, COMPACTION_VACUUM_PAGES
+from edge.models import current_engine, SpotSensorData, ElectricityData, Reservation, Status
+
+AUTO_VACUUM_INCREMENTAL = 2
+BACKLOG_PAUSE = 0.1  # seconds between steps while there is a backlog, lets writers of other processes in
+
+
+class Compactor:
+
+    def __init__(
+            self,
+            interval=COMPACTION_INTERVAL,
+            chunk_size=COMPACTION_CHUNK_SIZE,
+            vacuum_pages=COMPACTION_VACUUM_PAGES,
+            metrics=None,
+    ):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.vacuum_pages = vacuum_pages
+        self.metrics = metrics
+
+    def _delete_chunk(self, connection, table, key_column, condition):
+        chunk = select(key_column).where(condition).limit(self.chunk_size)
+        return connection.execute(table.delete().where(key_column.in_(chunk))).rowcount
+
+    def enable_incremental_vacuum(self):
+        """Converts a db created without auto_vacuum once, afterwards space can be reclaimed incrementally."""
+        with current_engine().connect() as connection:
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == AUTO_VACUUM_INCREMENTAL:
+                return
+            logging.info("Converting database to incremental auto vacuum (one-time full vacuum)...")
+            connection.exec_driver_sql(f"PRAGMA auto_vacuum={AUTO_VACUUM_INCREMENTAL}")
+            connection.exec_driver_sql("VACUUM")
+
+    def step(self):
+        """Runs one bounded compaction step and returns the number of deleted rows."""
+        sensor_table = SpotSensorData.__table__
+        electricity_table = ElectricityData.__table__
+        reservation_table = Reservation.__table__
+        engine = current_engine()
+        with engine.begin() as connection:
+            deleted = self._delete_chunk(
+                connection, sensor_table, sensor_table.c.read_id,
+                sensor_table.c.sent_status == Status.processed,
+            )
+            deleted += self._delete_chunk(
+                connection, electricity_table, electricity_table.c.data_item_id,
+                electricity_table.c.sent_status == Status.processed,
+            )
+            deleted += self._delete_chunk(
+                connection, reservation_table, reservation_table.c.reservation_id,
+                Reservation.finished_condition(),
+            )
+        with engine.connect() as connection:
+            # incremental_vacuum frees one page per step and has no result columns: a plain execute only runs its
+            # first step (and fetching raises), executescript steps it to completion
+            connection.connection.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+            if connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal":
+                connection.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        if self.metrics is not None:
+            self.metrics.count("compacted_rows", deleted)
+        return deleted
+
+    def run_until_clean(self):
+        """Compacts in bounded steps until nothing is left to delete."""
+        total = 0
+        while True:
+            deleted = self.step()
+            total += deleted
+            if deleted == 0:
+                return total
+
+    def run(self):
+        self.enable_incremental_vacuum()
+        while True:
+            try:
+                deleted = self.step()
+            except Exception as e:
+                # e.g. database locked by a long write of another process, try again next step
+                logging.warning(f"Compaction step failed: {e}")
+                deleted = 0
+            # work through a backlog (e.g. right after an outage ended) in quick consecutive steps
+            time.sleep(self.interval if deleted == 0 else BACKLOG_PAUSE)
+
+    def start(self):
+        """Runs the compactor in a background thread of the current process."""
+        thread = threading.Thread(target=self.run, name="compactor", daemon=True)
+        thread.start()
+        return thread
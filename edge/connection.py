@@ -0,0 +1,137 @@
+"""Failure detection and retries for the connections between edge and cloud.
+
+ZeroMQ heartbeats detect a dead peer within HEARTBEAT_TIMEOUT and let the socket reconnect in the background.
+Reply timeouts follow the measured round trip time (like TCP's retransmission timeout) instead of a fixed value,
+retries back off exponentially with jitter, and a REQ socket is kept across retries (relaxed and correlated)
+instead of being torn down on every miss. Round trip time, current timeout and link state are reported as gauges.
+"""
+import logging
+import random
+import time
+
+import zmq
+
+HEARTBEAT_INTERVAL = 1000  # milliseconds between two heartbeats on an idle connection
+HEARTBEAT_TIMEOUT = 3000  # milliseconds without any traffic until the peer is considered dead
+INITIAL_TIMEOUT = 2.5  # seconds, reply timeout until the first round trip time has been measured
+MIN_TIMEOUT = 0.2
+MAX_TIMEOUT = 30.0
+BACKOFF_BASE = 0.1  # seconds
+BACKOFF_MAX = 10.0
+RECREATE_AFTER_FAILURES = 5  # consecutive timeouts until the socket is recreated after all
+
+
+def configure_heartbeat(socket):
+    socket.setsockopt(zmq.HEARTBEAT_IVL, HEARTBEAT_INTERVAL)
+    socket.setsockopt(zmq.HEARTBEAT_TIMEOUT, HEARTBEAT_TIMEOUT)
+    socket.setsockopt(zmq.HEARTBEAT_TTL, HEARTBEAT_TIMEOUT)
+
+
+class RttEstimator:
+    """Smoothed round trip time and its variation, the timeout is the smoothed value plus four variations."""
+
+    def __init__(self, initial_timeout=INITIAL_TIMEOUT):
+        self.smoothed = None
+        self.variation = None
+        self.timeout = initial_timeout
+
+    def observe(self, rtt):
+        if self.smoothed is None:
+            self.smoothed = rtt
+            self.variation = rtt / 2
+        else:
+            self.variation = 0.75 * self.variation + 0.25 * abs(self.smoothed - rtt)
+            self.smoothed = 0.875 * self.smoothed + 0.125 * rtt
+        self.timeout = min(MAX_TIMEOUT, max(MIN_TIMEOUT, self.smoothed + 4 * self.variation))
+
+    def on_timeout(self):
+        """A lossy or congested link: wait longer for the next reply."""
+        self.timeout = min(MAX_TIMEOUT, self.timeout * 2)
+
+
+class Backoff:
+    """Exponential backoff with full jitter, so many stations don't retry in lockstep after an outage."""
+
+    def __init__(self, base=BACKOFF_BASE, maximum=BACKOFF_MAX):
+        self.base = base
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = random.uniform(0, min(self.maximum, self.base * 2 ** self.attempt))
+        self.attempt += 1
+        return delay
+
+    def reset(self):
+        self.attempt = 0
+
+
+class ReliableRequester:
+    """REQ connection that retries requests with adaptive timeouts and backoff."""
+
+    def __init__(self, context, url, metrics, name="link", codec=None):
+        self.context = context
+        self.url = url
+        self.metrics = metrics
+        self.name = name
+        self.codec = codec  # compresses requests, see compression.py
+        self.rtt = RttEstimator()
+        self.backoff = Backoff()
+        self.consecutive_failures = 0
+        self.socket = self._connect()
+
+    def _connect(self):
+        socket = self.context.socket(zmq.REQ)
+        # allow sending again without a reply, replies to earlier attempts are dropped
+        socket.setsockopt(zmq.REQ_RELAXED, 1)
+        socket.setsockopt(zmq.REQ_CORRELATE, 1)
+        socket.setsockopt(zmq.LINGER, 0)
+        configure_heartbeat(socket)
+        socket.connect(self.url)
+        return socket
+
+    def _report(self, link_up):
+        self.metrics.gauge(f"{self.name}_link_up", int(link_up))
+        self.metrics.gauge(f"{self.name}_timeout_ms", round(self.rtt.timeout * 1000, 1))
+        if self.rtt.smoothed is not None:
+            self.metrics.gauge(f"{self.name}_rtt_ms", round(self.rtt.smoothed * 1000, 1))
+
+    def request(self, payload, max_attempts=None):
+        """Sends payload until a reply arrives and returns the reply,
+        None if there was no reply after max_attempts (None retries forever).
+        """
+        message = self.codec.encode(payload) if self.codec else payload
+        attempt = 0
+        while True:
+            sent_at = time.monotonic()
+            with self.metrics.timer("send"):
+                self.socket.send(message)
+            self.metrics.count("bytes_sent", len(message))
+            with self.metrics.timer("wait_for_ack"):
+                reply_ready = self.socket.poll(self.rtt.timeout * 1000) & zmq.POLLIN
+            if reply_ready:
+                reply = self.socket.recv()
+                # replies to earlier attempts are dropped by the socket, so this is the round trip of the last one
+                self.rtt.observe(time.monotonic() - sent_at)
+                self.backoff.reset()
+                self.consecutive_failures = 0
+                self._report(link_up=True)
+                return self.codec.decode(reply) if self.codec else reply
+            self.metrics.count("timeouts")
+            self.consecutive_failures += 1
+            self.rtt.on_timeout()
+            self._report(link_up=False)
+            logging.warning(f"No reply from {self.url} within {self.rtt.timeout / 2:.2f}s")
+            if self.consecutive_failures % RECREATE_AFTER_FAILURES == 0:
+                # heartbeats reconnect a dead connection by themselves, this is the last resort
+                logging.info(f"Recreating connection to {self.url}")
+                self.metrics.count("reconnects")
+                self.socket.close()
+                self.socket = self._connect()
+            attempt += 1
+            if max_attempts is not None and attempt >= max_attempts:
+                return None
+            time.sleep(self.backoff.next_delay())
+
+    def close(self):
+        self.socket.close()
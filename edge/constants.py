@@ -1 +1,41 @@
 ELECTRICITY_CONTRACT_KWH_PRICE = 0.4
+# identity of this station in the cloud, overridden by the station_id environment variable
+DEFAULT_STATION_ID = 0
+NUMBER_OF_SPOTS = 5
+STATION_CYCLE_INTERVAL = 4  # seconds between two readings of the station's sensors
+# reservation ids recently received from the cloud, resent reservations are recognized without a db query
+SEEN_RESERVATIONS_CACHE_SIZE = 4096
+# file holding the version counter of the constant table, bumped by the process that changes a constant
+CONSTANTS_VERSION_FILE = "constants.version"  # relative path, next to sqlite.db
+
+# storage budget of the outbox (unsent data while cloud is unreachable), see outbox.py
+OUTBOX_MAX_READINGS = 50000  # roughly 11 hours of readings of 5 spots, at one reading per spot every 4 seconds
+OUTBOX_MAX_ELECTRICITY_ITEMS = 10000
+OUTBOX_MAX_DB_SIZE = 64 * 1024 * 1024  # bytes
+OUTBOX_POLICY = "priority"  # downsample | priority | aggregate
+OUTBOX_ELECTRICITY_GROUP_SIZE = 6  # number of electricity items merged into one aggregate item
+OUTBOX_CHECK_INTERVAL = 15  # station cycles between two budget checks
+# where spot readings wait to be sent: "db" (spot_sensor_reading table) or "ring" (memory-mapped ring buffer file,
+# see ring_outbox.py), overridden by the outbox_backend environment variable
+OUTBOX_BACKEND = "db"
+RING_OUTBOX_FILE = "readings.ring"  # relative path, next to sqlite.db
+RING_OUTBOX_CAPACITY = OUTBOX_MAX_READINGS  # readings, the oldest unsent one is overwritten when full
+
+# sqlite journal mode, e.g. "WAL" lets readers and the writer work concurrently.
+# Only use WAL if all processes see the db directory (the -wal file lives next to sqlite.db),
+# i.e. not when only the db file is mounted into a docker container. None keeps sqlite's default.
+SQLITE_JOURNAL_MODE = None
+
+# crash-recovery snapshot of the station's in-memory state, see bike_station/snapshot.py
+SNAPSHOT_FILE = "station.snapshot"  # relative path, next to sqlite.db
+SNAPSHOT_INTERVAL = 5  # station cycles between two snapshots
+
+# continuous compaction of processed rows, see compactor.py
+COMPACTION_INTERVAL = 10  # seconds between two compaction steps
+COMPACTION_CHUNK_SIZE = 500  # rows deleted per table and step
+COMPACTION_VACUUM_PAGES = 200  # free pages returned to the file system per step
+
+# connection pool of the db engine, shared by the threads of a process
+DB_POOL_SIZE = 3
+DB_MAX_OVERFLOW = 2
+DB_BUSY_TIMEOUT = 15  # seconds to wait for the sqlite lock held by another process
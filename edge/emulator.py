@@ -0,0 +1,156 @@
+"""Emulates many bike stations against a real cloud, to find the load the cloud can take on one machine.
+
+Every worker process hosts a share of the stations in one event loop: each station is a BikeStation with its own
+in-memory db (or db file) and its own link to the cloud (see link.py), its sensor cycle is scheduled every
+STATION_CYCLE_INTERVAL seconds and its link is serviced when the cloud sent something or there is data to send.
+Run against the cloud's link.py and raise --stations until acknowledgement round trip times and timeouts in the
+metrics summaries grow; a growing cycle lag means the emulator itself is saturated and needs more --workers.
+
+    python emulator.py --stations 200 --workers 4 --server tcp://<cloud_ip>:6666
+"""
+import os, sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))  # to avoid possible relative import errors
+import argparse
+import heapq
+import logging
+import multiprocessing
+import time
+
+import zmq
+from dotenv import load_dotenv
+
+from edge.bike_station.application import BikeStation
+from edge.clock import clock_from_env
+from edge.compactor import Compactor
+from edge.constants import ELECTRICITY_CONTRACT_KWH_PRICE, NUMBER_OF_SPOTS, STATION_CYCLE_INTERVAL
+from edge.instrumentation import get_instrumentation
+from edge.link import StationLink, KEEPALIVE_INTERVAL
+from edge.models import StationDatabase, use_station_database, ensure_schema, transaction, release_session
+from edge.timeutil import monotonic
+
+load_dotenv()
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+LINK_POLL_INTERVAL = 0.2  # seconds the loop waits for messages at most, so resends are not delayed
+COMPACTION_CYCLES = 25  # station cycles between two compaction steps of a station's db
+
+
+class EmulatedStation:
+
+    def __init__(self, station_id, server_url, context, metrics, db_directory=None):
+        url = "sqlite://" if db_directory is None else f"sqlite:///{db_directory}/station_{station_id}.db"
+        self.station_id = station_id
+        self.database = StationDatabase(url)
+        self.cycles = 0
+        self.has_new_data = False
+        with use_station_database(self.database):
+            ensure_schema()
+            self.database.constant_cache.set_real_value("current_market_price", ELECTRICITY_CONTRACT_KWH_PRICE)
+            self.station = BikeStation(number_of_spots=NUMBER_OF_SPOTS)
+            self.link = StationLink(server_url, metrics, station_id, NUMBER_OF_SPOTS, context=context)
+            release_session()
+
+    def run_cycle(self, compactor):
+        with use_station_database(self.database):
+            with transaction():
+                self.station.run_station()
+            self.station.perform_reservations()
+            self.cycles += 1
+            if self.cycles % COMPACTION_CYCLES == 0:
+                try:
+                    compactor.step()
+                except Exception as e:
+                    # maintenance of one station's db must not take down the worker, try again next interval
+                    logging.warning(f"Compaction step of station {self.station_id} failed: {e}")
+            if self.link.in_flight is None and self.link.priority_in_flight is None:
+                # the unacknowledged batches of the link share the session
+                release_session()
+        self.has_new_data = True
+
+    def link_due(self, now):
+        """Whether the link may have something to send, querying the db of every station every time is expensive."""
+        link = self.link
+        if link.priority_in_flight is not None and now >= link.priority_resend_at:
+            return True
+        if link.in_flight is not None:
+            # new reservation responses don't wait for the data in flight
+            return now >= link.resend_at or self.has_new_data
+        return self.has_new_data or now - link.sent_at >= KEEPALIVE_INTERVAL
+
+    def service_link(self, now):
+        with use_station_database(self.database):
+            self.link.service(now)
+        self.has_new_data = False
+
+
+def run_worker(worker_number, station_ids, server_url, db_directory):
+    """Event loop of one worker process, hosting the given stations."""
+    sys.stdout = open(os.devnull, "w")  # the station's tables would drown the metrics summaries
+    # spawned, the worker doesn't inherit the clock of the parent
+    clock = clock_from_env()
+    context = zmq.Context()
+    metrics = get_instrumentation(f"emulator_worker_{worker_number}")
+    compactor = Compactor(metrics=metrics)
+    stations = [EmulatedStation(station_id, server_url, context, metrics, db_directory) for station_id in station_ids]
+    sockets = {station.link.socket: station for station in stations}
+    poller = zmq.Poller()
+    for socket in sockets:
+        poller.register(socket, zmq.POLLIN)
+    start = monotonic()
+    # spread the cycles of the stations over the interval instead of running them all at once
+    due_cycles = [
+        (start + STATION_CYCLE_INTERVAL * i / len(stations), station.station_id, station)
+        for i, station in enumerate(stations)
+    ]
+    heapq.heapify(due_cycles)
+    logging.info(f"Worker {worker_number} emulates {len(stations)} stations.")
+    while True:
+        now = monotonic()
+        while due_cycles[0][0] <= now:
+            due, station_id, station = heapq.heappop(due_cycles)
+            metrics.gauge("cycle_lag_ms", round((now - due) * 1000, 1))
+            with metrics.timer("station_cycle"):
+                station.run_cycle(compactor)
+            heapq.heappush(due_cycles, (max(due + STATION_CYCLE_INTERVAL, now), station_id, station))
+            metrics.count("station_cycles")
+            now = monotonic()
+        timeout = max(0.0, min(LINK_POLL_INTERVAL, due_cycles[0][0] - now))
+        with metrics.timer("poll"):
+            ready = dict(poller.poll(timeout * 1000))
+        if not ready:
+            # a simulated clock doesn't move while polling, it jumps ahead instead
+            clock.sleep(max(0.0, timeout - (monotonic() - now)))
+        # the links time out and resend in real time, like link.py
+        link_now = time.monotonic()
+        with metrics.timer("link"):
+            # links also need servicing without received messages: to send new data, resends and keepalives
+            for socket, station in sockets.items():
+                if socket in ready or station.link_due(link_now):
+                    station.service_link(link_now)
+        metrics.end_cycle()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate many bike stations against a real cloud.")
+    parser.add_argument("--stations", type=int, default=100, help="number of emulated stations")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--first-station-id", type=int, default=1000, help="ids are assigned consecutively")
+    parser.add_argument("--server", default=os.getenv("server_address"), help="address of the cloud's link.py")
+    parser.add_argument("--db-directory", help="keep the station dbs as files in this directory, default: in memory")
+    args = parser.parse_args()
+    if args.db_directory:
+        os.makedirs(args.db_directory, exist_ok=True)
+    station_ids = list(range(args.first_station_id, args.first_station_id + args.stations))
+    workers = min(args.workers, args.stations)
+    processes = [
+        multiprocessing.get_context("spawn").Process(
+            target=run_worker,
+            args=(number, station_ids[number::workers], args.server, args.db_directory),
+            name=f"emulator-worker-{number}",
+        )
+        for number in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
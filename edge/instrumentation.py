@@ -0,0 +1,175 @@
+"""Lightweight timing and counting of the stages of long-running loops.
+
+Configured through environment variables:
+    metrics_interval  seconds between two summaries (default 60)
+    metrics_file      if set, every summary is also appended to this file as one json line
+    profiler          "cprofile" or "sampling" to profile the process, summaries then include the hottest functions
+"""
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_SUMMARY_INTERVAL = 60
+PROFILE_TOP_N = 15
+
+
+class StageTimer:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        if duration > self.max:
+            self.max = duration
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stack of the profiled thread at a fixed interval.
+    Much cheaper than cProfile, so it can stay enabled on slow edge devices.
+    """
+
+    def __init__(self, thread_id, interval=0.01):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            location = f"{frame.f_code.co_filename}:{frame.f_lineno}({frame.f_code.co_name})"
+            with self.lock:
+                self.samples[location] += 1
+
+    def report(self):
+        with self.lock:
+            total = sum(self.samples.values())
+            top = self.samples.most_common(PROFILE_TOP_N)
+            self.samples.clear()
+        return "\n".join(f"{count / total:6.1%}  {location}" for location, count in top)
+
+
+class Instrumentation:
+    """Collects stage timings, counters and gauges of a loop and periodically logs a summary."""
+
+    def __init__(self, name, summary_interval=DEFAULT_SUMMARY_INTERVAL, summary_file=None, profiler=None):
+        self.name = name
+        self.summary_interval = summary_interval
+        self.summary_file = summary_file
+        self.timers = collections.defaultdict(StageTimer)
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.cycles = 0
+        self.last_summary = time.monotonic()
+        self.profiler = None
+        if profiler == "cprofile":
+            import cProfile  # only imported when profiling, keeps startup fast
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif profiler == "sampling":
+            self.profiler = SamplingProfiler(threading.get_ident())
+            self.profiler.start()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[stage].add(time.perf_counter() - start)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def end_cycle(self):
+        """Marks the end of one loop cycle, logs the summary once the interval has passed."""
+        self.cycles += 1
+        if time.monotonic() - self.last_summary >= self.summary_interval:
+            self.dump_summary()
+
+    def summary(self):
+        cycles = self.cycles or 1
+        return {
+            "name": self.name,
+            "timestamp": time.time(),
+            "cycles": self.cycles,
+            "stages": {
+                stage: {
+                    "count": timer.count,
+                    "total_ms": round(timer.total * 1000, 3),
+                    "mean_ms": round(timer.total * 1000 / timer.count, 3),
+                    "max_ms": round(timer.max * 1000, 3),
+                }
+                for stage, timer in self.timers.items()
+            },
+            "counters_per_cycle": {counter: round(value / cycles, 2) for counter, value in self.counters.items()},
+            "gauges": dict(self.gauges),
+        }
+
+    def dump_summary(self):
+        summary = self.summary()
+        logging.info(f"[{self.name}] {summary['cycles']} cycles in the last {self.summary_interval}s")
+        for stage, stats in summary["stages"].items():
+            logging.info(
+                f"[{self.name}] {stage:<14} n={stats['count']:<6} mean={stats['mean_ms']:.2f}ms "
+                f"max={stats['max_ms']:.2f}ms total={stats['total_ms']:.1f}ms"
+            )
+        if summary["counters_per_cycle"]:
+            logging.info(f"[{self.name}] per cycle: {summary['counters_per_cycle']}")
+        if summary["gauges"]:
+            logging.info(f"[{self.name}] gauges: {summary['gauges']}")
+        profile = self._profile_report()
+        if profile:
+            logging.info(f"[{self.name}] hottest functions:\n{profile}")
+        if self.summary_file:
+            with open(self.summary_file, "a") as f:
+                f.write(json.dumps(summary) + "\n")
+        self.timers.clear()
+        self.counters.clear()
+        self.cycles = 0
+        self.last_summary = time.monotonic()
+
+    def _profile_report(self):
+        if isinstance(self.profiler, SamplingProfiler):
+            return self.profiler.report()
+        if self.profiler is not None:
+            import cProfile
+            import io
+            import pstats
+
+            self.profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+            self.profiler.dump_stats(f"{self.name}.prof")  # full profile for snakeviz/pstats
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+            return output.getvalue()
+        return None
+
+
+def get_instrumentation(name):
+    """Creates the instrumentation of a loop configured by the environment."""
+    return Instrumentation(
+        name,
+        summary_interval=float(os.getenv("metrics_interval", DEFAULT_SUMMARY_INTERVAL)),
+        summary_file=os.getenv("metrics_file"),
+        profiler=os.getenv("profiler"),
+    )
@@ -0,0 +1,190 @@
+"""Edge end of the multiplexed station link, replaces client.py and server.py.
+
+One DEALER connection to the cloud's link carries both directions concurrently: readings, electricity data and
+reservation responses go up as soon as they are queued, market price and reservations come down without a
+second connection. Acks are piggybacked on the next message going the other way, see cloud/link.py.
+
+Reservation responses have a lane of their own: they go up as priority messages with their own unacknowledged
+message, so a confirmation never waits behind the backlog of sensor data (or its resends) after an outage.
+Sensor data is sent in the remaining time, one batch at a time.
+"""
+import itertools
+import logging
+import os
+import time
+
+import zmq
+from dotenv import load_dotenv
+
+from edge.client import (
+    get_outgoing_batch, get_reservation_responses, is_empty, make_message_dict, encode, mark_batch_sent, station_id,
+)
+from edge.server import handle_cloud_message
+from edge.models import release_session
+from edge.clock import clock_from_env
+from edge.compression import Codec, compression_enabled
+from edge.connection import RttEstimator, Backoff, configure_heartbeat
+from edge.constants import NUMBER_OF_SPOTS
+from edge.instrumentation import get_instrumentation
+
+load_dotenv()
+logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+DATA = b"data"
+PRIORITY = b"priority"
+DOWN = b"down"
+ACK = b"ack"
+
+POLL_INTERVAL = 200  # milliseconds
+KEEPALIVE_INTERVAL = 10  # seconds, an empty data message lets the cloud know the station is connected
+
+
+def station_identity(station_id):
+    """Socket identity of a station's link, the cloud routes messages to the station with it."""
+    return f"station-{station_id}".encode()
+
+
+class StationLink:
+
+    def __init__(self, server_url, metrics, own_station_id=station_id, number_of_spots=NUMBER_OF_SPOTS, context=None):
+        self.metrics = metrics
+        self.station_id = own_station_id
+        self.number_of_spots = number_of_spots
+        self.context = context or zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        # same identity after a restart, so the cloud can route messages to the reconnected station
+        self.socket.setsockopt(zmq.IDENTITY, station_identity(own_station_id))
+        self.socket.setsockopt(zmq.LINGER, 0)
+        # a dead connection is detected by heartbeats and reconnected by the socket itself
+        configure_heartbeat(self.socket)
+        self.socket.connect(server_url)
+        self.sequences = itertools.count(1)
+        self.in_flight = None  # (sequence, batch, encoded message) of unacknowledged data
+        self.sent_at = 0.0
+        self.resend_at = 0.0
+        self.resent = False
+        self.priority_in_flight = None  # (sequence, batch, encoded message) of unacknowledged reservation responses
+        self.priority_sent_at = 0.0
+        self.priority_resend_at = 0.0
+        self.rtt = RttEstimator()
+        self.backoff = Backoff()
+        self.down_sequence_to_ack = None
+        self.last_handled_down_sequence = None
+        # the cloud's link understands compressed messages, it answers in the framing of the station
+        self.codec = Codec(compression_enabled(), metrics, peer_accepts=True)
+
+    def _send(self, message_type, sequence=b"", payload=b""):
+        ack = b""
+        if self.down_sequence_to_ack is not None:
+            ack = str(self.down_sequence_to_ack).encode()
+            self.down_sequence_to_ack = None
+        with self.metrics.timer("send"):
+            self.socket.send_multipart([message_type, sequence, ack, payload])
+        self.metrics.count("bytes_sent", len(payload))
+
+    def _on_message(self, message_type, sequence, ack, payload):
+        if ack and self.in_flight is not None and int(ack) == self.in_flight[0]:
+            logging.info("Cloud acknowledged data.")
+            if not self.resent:
+                # the round trip of a resent message is ambiguous
+                self.rtt.observe(time.monotonic() - self.sent_at)
+                self.metrics.gauge("cloud_rtt_ms", round(self.rtt.smoothed * 1000, 1))
+            self.backoff.reset()
+            self.metrics.gauge("cloud_link_up", 1)
+            self.metrics.gauge("cloud_timeout_ms", round(self.rtt.timeout * 1000, 1))
+            mark_batch_sent(self.in_flight[1], self.metrics)
+            self.in_flight = None
+        if ack and self.priority_in_flight is not None and int(ack) == self.priority_in_flight[0]:
+            self.metrics.gauge(
+                "reservation_response_latency_ms", round((time.monotonic() - self.priority_sent_at) * 1000, 1)
+            )
+            mark_batch_sent(self.priority_in_flight[1], self.metrics)
+            self.priority_in_flight = None
+        if message_type != DOWN:
+            return
+        sequence = int(sequence)
+        # a resent message (our ack got lost) is acknowledged again without handling it twice
+        if sequence != self.last_handled_down_sequence:
+            handle_cloud_message(self.codec.decode(payload), self.metrics, self.station_id)
+            self.last_handled_down_sequence = sequence
+        self.down_sequence_to_ack = sequence
+
+    def _encode(self, batch):
+        with self.metrics.timer("serialize"):
+            encoded = encode(make_message_dict(batch, self.metrics, self.station_id, self.number_of_spots))
+        return self.codec.encode(encoded)
+
+    def _send_priority(self, now):
+        """Sends new reservation responses, or resends unacknowledged ones, regardless of data in flight."""
+        if self.priority_in_flight is not None:
+            if now < self.priority_resend_at:
+                return False
+            logging.warning("No acknowledgement from cloud, resending reservation responses.")
+            self.metrics.count("timeouts")
+            sequence, _, encoded = self.priority_in_flight
+            self.priority_resend_at = now + self.rtt.timeout + self.backoff.next_delay()
+            self._send(PRIORITY, str(sequence).encode(), encoded)
+            return True
+        batch = get_reservation_responses(self.metrics)
+        if is_empty(batch):
+            return False
+        encoded = self._encode(batch)
+        sequence = next(self.sequences)
+        self.priority_in_flight = (sequence, batch, encoded)
+        self.priority_sent_at = now
+        self.priority_resend_at = now + self.rtt.timeout
+        self._send(PRIORITY, str(sequence).encode(), encoded)
+        return True
+
+    def _send_data(self, now):
+        if self.in_flight is not None:
+            if now < self.resend_at:
+                return False
+            logging.warning("No acknowledgement from cloud, resending data.")
+            self.metrics.count("timeouts")
+            self.metrics.gauge("cloud_link_up", 0)
+            self.rtt.on_timeout()
+            sequence, _, encoded = self.in_flight
+            self.resent = True
+            self.resend_at = now + self.rtt.timeout + self.backoff.next_delay()
+            self._send(DATA, str(sequence).encode(), encoded)
+            return True
+        batch = get_outgoing_batch(self.metrics, reservation_responses=False)
+        if is_empty(batch) and self.down_sequence_to_ack is None and now - self.sent_at < KEEPALIVE_INTERVAL:
+            return False
+        encoded = self._encode(batch)
+        sequence = next(self.sequences)
+        self.in_flight = (sequence, batch, encoded)
+        self.sent_at = now
+        self.resend_at = now + self.rtt.timeout
+        self.resent = False
+        self._send(DATA, str(sequence).encode(), encoded)
+        return True
+
+    def service(self, now):
+        """Handles all received messages and sends queued data, resends or acks. Never blocks."""
+        while self.socket.poll(0) & zmq.POLLIN:
+            message_type, sequence, ack, payload = self.socket.recv_multipart()
+            self.metrics.count("bytes_received", len(payload))
+            self._on_message(message_type, sequence, ack, payload)
+        # reservation responses first, they also carry a pending ack
+        self._send_priority(now)
+        if not self._send_data(now) and self.down_sequence_to_ack is not None:
+            # data can't carry the ack right now
+            self._send(ACK)
+        if self.in_flight is None and self.priority_in_flight is None:
+            # the unacknowledged batches keep their objects in the session until the ack arrives
+            release_session()
+
+    def run(self):
+        while True:
+            with self.metrics.timer("poll"):
+                self.socket.poll(POLL_INTERVAL)
+            self.service(time.monotonic())
+            self.metrics.end_cycle()
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    logging.info("Connecting to cloud link...")
+    StationLink(os.getenv("server_address"), get_instrumentation("edge_link")).run()
@@ -1,27 +1,210 @@
-import datetime
 import enum
+import fcntl
 import os
-import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
-import pytz
-from sqlalchemy import Column, Integer, DateTime, Boolean, Enum, REAL, String, false, true
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import (
+    Column, Integer, DateTime, Boolean, Enum, REAL, String, false, true, and_, or_, event, insert, update, bindparam,
+)
 from sqlalchemy.sql import func
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
 from dotenv import load_dotenv
 
-from edge.constants import ELECTRICITY_CONTRACT_KWH_PRICE
+from edge.constants import (
+    ELECTRICITY_CONTRACT_KWH_PRICE,
+    CONSTANTS_VERSION_FILE,
+    SQLITE_JOURNAL_MODE,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_BUSY_TIMEOUT,
+    DEFAULT_STATION_ID,
+    SEEN_RESERVATIONS_CACHE_SIZE,
+)
+from edge.reservation_log import Event, get_reservation_log_from_env
+from edge.ring_outbox import get_ring_outbox_from_env
+from edge.timeutil import utcnow, UTC
 
 load_dotenv()
 
-engine = create_engine(f'sqlite:///sqlite.db', echo=False)  # sqlite db relative path
-Session = sessionmaker(bind=engine)
-# create a Session
-session = Session()
+# stored in the db (PRAGMA user_version), bump it whenever tables or columns change
+SCHEMA_VERSION = 2
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # lets the compactor hand freed pages back to the file system, takes effect for new db files
+    # (existing ones are converted once by the compactor)
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    if SQLITE_JOURNAL_MODE:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.close()
+
+
+def create_station_engine(url):
+    """Engine of a station db, "sqlite://" is an in-memory db."""
+    if url == "sqlite://":
+        # one connection keeps the in-memory db alive
+        pool_args = {"poolclass": StaticPool}
+    else:
+        pool_args = {"poolclass": QueuePool, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW}
+    station_engine = create_engine(
+        url,
+        echo=False,
+        # the pool hands connections between threads, but a connection is never used by two threads at once
+        connect_args={"check_same_thread": False, "timeout": DB_BUSY_TIMEOUT},
+        **pool_args,
+    )
+    event.listen(station_engine, "connect", set_sqlite_pragmas)
+    return station_engine
+
+
+STATION_DB_URL = 'sqlite:///sqlite.db'  # sqlite db relative path
+# of the station db, created with the first use (see current_engine), importing the models doesn't touch the db
+engine = None
+_engine_lock = threading.Lock()
+# reservation log and ring outbox of the process (None if not enabled), opened with their first use as well
+_storage = {}
+_storage_lock = threading.Lock()
+
+_station_state = threading.local()
+
+
+class StationDatabase:
+    """Own db and constants of one of many stations emulated in a process, see emulator.py."""
+
+    def __init__(self, url="sqlite://"):
+        self.engine = create_station_engine(url)
+        self.constant_cache = ConstantCache(version_file=None)
+        self.seen_reservations = RecentIds()
+        self.reservation_log = None
+        self.ring_outbox = None
+
+
+@contextmanager
+def use_station_database(station_database):
+    """Model methods called by this thread inside the block work on the db of the given station."""
+    previous = getattr(_station_state, "database", None)
+    _station_state.database = station_database
+    try:
+        yield station_database
+    finally:
+        _station_state.database = previous
+
+
+def current_engine():
+    database = getattr(_station_state, "database", None)
+    if database is not None:
+        return database.engine
+    return engine or _create_engine()
+
+
+def _create_engine():
+    """Creates the engine of the station db and its missing tables."""
+    global engine
+    with _engine_lock:
+        if engine is None:
+            station_engine = create_station_engine(STATION_DB_URL)
+            ensure_schema(schema_engine=station_engine)
+            engine = station_engine
+    return engine
+
+
+def current_constant_cache():
+    database = getattr(_station_state, "database", None)
+    return constant_cache if database is None else database.constant_cache
+
+
+def current_seen_reservations():
+    database = getattr(_station_state, "database", None)
+    return seen_reservations if database is None else database.seen_reservations
+
+
+def _process_storage(name, open_storage):
+    if name not in _storage:
+        with _storage_lock:
+            if name not in _storage:
+                _storage[name] = open_storage()
+    return _storage[name]
+
+
+def current_reservation_log():
+    """Reservation events, if enabled."""
+    database = getattr(_station_state, "database", None)
+    if database is not None:
+        return database.reservation_log
+    return _process_storage(
+        "reservation_log", lambda: get_reservation_log_from_env(int(os.getenv("station_id", DEFAULT_STATION_ID)))
+    )
+
+
+def current_ring_outbox():
+    """Spot readings waiting to be sent, if they are not kept in spot_sensor_reading."""
+    database = getattr(_station_state, "database", None)
+    if database is not None:
+        return database.ring_outbox
+    return _process_storage("ring_outbox", get_ring_outbox_from_env)
+
+
+def _session_scope():
+    database = getattr(_station_state, "database", None)
+    return threading.get_ident(), None if database is None else id(database)
+
+
+_session_factory = sessionmaker()
+# sessions per thread (and emulated station): `session` proxies to the session of the calling thread
+Session = scoped_session(lambda: _session_factory(bind=current_engine()), scopefunc=_session_scope)
+session = Session
+
+_transaction_state = threading.local()
+
+
+@contextmanager
+def transaction():
+    """Unit of work: commits of all model methods called inside are batched into one commit at the end.
+    Nested blocks join the outermost one. Everything is rolled back if the block raises.
+    """
+    depth = getattr(_transaction_state, "depth", 0)
+    _transaction_state.depth = depth + 1
+    try:
+        yield session
+        if depth == 0:
+            session.commit()
+    except BaseException:
+        if depth == 0:
+            session.rollback()
+        raise
+    finally:
+        _transaction_state.depth = depth
+
+
+def commit():
+    """Commits, unless called inside a transaction() block, where it only flushes (e.g. to get generated ids).
+    A failed commit is rolled back, so the session stays usable for the next unit of work.
+    """
+    if getattr(_transaction_state, "depth", 0):
+        session.flush()
+        return
+    try:
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def release_session():
+    """Closes the session of the calling thread and drops its identity map.
+    Call at the end of every loop cycle, objects loaded before must not be used afterwards.
+    """
+    Session.remove()
 
 Base = declarative_base()
 
+DELETE_CHUNK_SIZE = 500  # stay below sqlite's limit of bound variables per statement
+
 
 class Status(enum.Enum):
     created = 0
@@ -37,19 +220,138 @@ class Constant(Base):
 
     def save_or_update(self):
         session.merge(self)
-        session.commit()
+        commit()
         return self
 
     @staticmethod
     def get_real_value_by_name(name):
         return session.query(Constant).filter(Constant.name == name).first().real_value
 
+    @staticmethod
+    def get_all_real_values():
+        return dict(session.query(Constant.name, Constant.real_value).all())
+
+
+class ConstantCache:
+    """In-process cache of the constant table.
+    Values are read from memory. A process that changes a constant bumps the version counter
+    in the version file, which makes the caches of all other processes reload on their next read.
+    A read only stats the version file, it is opened once the file was replaced since the last check.
+    Without a version file the process is the only one using the db, the cache is loaded once.
+    """
+
+    def __init__(self, version_file=CONSTANTS_VERSION_FILE):
+        self.version_file = version_file
+        self._values = {}
+        self._version = None
+        self._file_state = None  # (inode, mtime) of the version file when the version was read
+        self._lock_fd = None
+
+    def _stat_version_file(self):
+        try:
+            stat = os.stat(self.version_file)
+        except FileNotFoundError:
+            return None
+        # every bump replaces the file, a new inode tells it apart even within the mtime resolution
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _read_version(self) -> int:
+        if self.version_file is None:
+            return 0
+        try:
+            with open(self.version_file) as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _bump_version(self):
+        """Increments the version under the lock of the version file, bumps of other processes aren't lost."""
+        if self.version_file is None:
+            return
+        if self._lock_fd is None:
+            self._lock_fd = os.open(f"{self.version_file}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            version = self._read_version()
+            # constants changed by another process since the last refresh are reloaded on the next read
+            up_to_date = version == self._version
+            version += 1
+            tmp_file = f"{self.version_file}.tmp"
+            with open(tmp_file, "w") as f:
+                f.write(str(version))
+            os.replace(tmp_file, self.version_file)  # atomic, readers never see a partial counter
+            self._version = version if up_to_date else None
+            self._file_state = self._stat_version_file()
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def refresh_if_changed(self):
+        """Reload all constants from db if another process changed one since the last read."""
+        if self.version_file is None:
+            if self._version is None:
+                self._values = Constant.get_all_real_values()
+                self._version = 0
+            return
+        file_state = self._stat_version_file()
+        if self._version is not None and file_state == self._file_state:
+            return
+        version = self._read_version()
+        if version != self._version:
+            self._values = Constant.get_all_real_values()
+            self._version = version
+        self._file_state = file_state
+
+    def get_real_value(self, name, default=None) -> float:
+        self.refresh_if_changed()
+        return self._values.get(name, default)
+
+    def set_real_value(self, name, value: float) -> bool:
+        """Persist the value only if it differs from the current one.
+        Returns True if the value was written.
+        """
+        self.refresh_if_changed()
+        if name in self._values and self._values[name] == value:
+            return False
+        Constant(name=name, real_value=value).save_or_update()
+        self._values[name] = value
+        self._bump_version()
+        return True
+
+
+constant_cache = ConstantCache()
+
+
+class RecentIds:
+    """Bounded set of recently seen ids, the least recently seen one is dropped when it is full."""
+
+    def __init__(self, capacity=SEEN_RESERVATIONS_CACHE_SIZE):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+
+    def __contains__(self, id_):
+        if id_ not in self._ids:
+            return False
+        self._ids.move_to_end(id_)
+        return True
+
+    def add(self, id_):
+        self._ids[id_] = None
+        self._ids.move_to_end(id_)
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+
+seen_reservations = RecentIds()
+
 
 class SpotSensorData(Base):
     __tablename__ = "spot_sensor_reading"
+    # read ids are never reused, not even after the compactor deleted all readings: the snapshot replays the readings
+    # stored after its last read id
+    __table_args__ = {"sqlite_autoincrement": True}
     read_id = Column(Integer, primary_key=True)
-    read_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc))
-    update_timestamp = Column(DateTime(timezone=True), onupdate=func.now(tz=pytz.utc))
+    read_timestamp = Column(DateTime(timezone=True), default=utcnow, server_default=func.now(tz=UTC))
+    update_timestamp = Column(DateTime(timezone=True), onupdate=utcnow)
     spot_id = Column(Integer, nullable=False)
     is_occupied = Column(Boolean, default=False)
     battery_level = Column(REAL)
@@ -57,7 +359,7 @@ class SpotSensorData(Base):
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
     @staticmethod
@@ -65,7 +367,7 @@ class SpotSensorData(Base):
         session.query(SpotSensorData).filter(
             SpotSensorData.sent_status == Status.processed
         ).delete()
-        session.commit()
+        commit()
 
     @staticmethod
     def get_oldest_n_readings(n):
@@ -78,14 +380,47 @@ class SpotSensorData(Base):
         session.query(SpotSensorData).filter(
             SpotSensorData.read_id <= last_read_id
         ).update({"sent_status": Status.processed})
-        session.commit()
+        commit()
+
+    @staticmethod
+    def count_unsent():
+        return session.query(func.count(SpotSensorData.read_id)).filter(
+            SpotSensorData.sent_status == Status.created
+        ).scalar()
+
+    @staticmethod
+    def get_oldest_unsent_summary(n):
+        """Gets (read_id, spot_id, is_occupied) of the oldest n unsent readings without loading ORM objects."""
+        return session.query(
+            SpotSensorData.read_id, SpotSensorData.spot_id, SpotSensorData.is_occupied
+        ).filter(
+            SpotSensorData.sent_status == Status.created
+        ).order_by(SpotSensorData.read_id).limit(n).all()
+
+    @staticmethod
+    def get_latest_per_spot_after(read_id):
+        """Gets (spot_id, is_occupied, battery_level) of the latest reading of every spot stored after read_id."""
+        latest = {}
+        for spot_id, is_occupied, battery_level in session.query(
+                SpotSensorData.spot_id, SpotSensorData.is_occupied, SpotSensorData.battery_level
+        ).filter(SpotSensorData.read_id > read_id).order_by(SpotSensorData.read_id):
+            latest[spot_id] = (spot_id, is_occupied, battery_level)
+        return list(latest.values())
+
+    @staticmethod
+    def delete_by_ids(read_ids):
+        for start in range(0, len(read_ids), DELETE_CHUNK_SIZE):
+            session.query(SpotSensorData).filter(
+                SpotSensorData.read_id.in_(read_ids[start:start + DELETE_CHUNK_SIZE])
+            ).delete(synchronize_session=False)
+        commit()
 
     @staticmethod
     def make_query_dictionary(query):
-        summary_dict = {'0': [], '1': [], '2': [], '3': [], '4': []}
+        summary_dict = {}
         for reading in query:
             spot_id = reading.spot_id
-            summary_dict[str(spot_id)].append(
+            summary_dict.setdefault(str(spot_id), []).append(
                 {
                     'datetime': reading.read_timestamp,
                     'reading_id': reading.read_id,
@@ -99,7 +434,7 @@ class SpotSensorData(Base):
 class ElectricityData(Base):
     __tablename__ = "electricity_data"
     data_item_id = Column(Integer, primary_key=True)
-    data_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc))
+    data_timestamp = Column(DateTime(timezone=True), default=utcnow, server_default=func.now(tz=UTC))
     production = Column(Integer, nullable=False, default=0)
     self_consumption = Column(Integer, nullable=False, default=0)
     feed_in = Column(Integer, nullable=False, default=0)
@@ -109,7 +444,7 @@ class ElectricityData(Base):
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
     @staticmethod
@@ -117,7 +452,7 @@ class ElectricityData(Base):
         session.query(ElectricityData).filter(
             ElectricityData.sent_status == Status.processed
         ).delete()
-        session.commit()
+        commit()
 
     @staticmethod
     def get_oldest_n_readings(n):
@@ -130,7 +465,41 @@ class ElectricityData(Base):
         session.query(ElectricityData).filter(
             ElectricityData.data_item_id <= last_sent_item_id
         ).update({"sent_status": Status.processed})
-        session.commit()
+        commit()
+
+    @staticmethod
+    def count_unsent():
+        return session.query(func.count(ElectricityData.data_item_id)).filter(
+            ElectricityData.sent_status == Status.created
+        ).scalar()
+
+    @staticmethod
+    def compact_oldest_unsent(n, group_size):
+        """Merges groups of group_size of the oldest n unsent items into one aggregate item per group.
+        Production, consumption and revenue are summed up into the newest item of the group, so totals are kept.
+        Returns the number of deleted items.
+        """
+        items = session.query(ElectricityData).filter(
+            ElectricityData.sent_status == Status.created
+        ).order_by(ElectricityData.data_item_id).limit(n).all()
+        deleted_ids = []
+        for start in range(0, len(items) - group_size + 1, group_size):
+            group = items[start:start + group_size]
+            aggregate = group[-1]
+            for item in group[:-1]:
+                aggregate.production += item.production
+                aggregate.self_consumption += item.self_consumption
+                aggregate.feed_in += item.feed_in
+                aggregate.consumption_saving = round(aggregate.consumption_saving + item.consumption_saving, 4)
+                aggregate.feed_in_revenue = round(aggregate.feed_in_revenue + item.feed_in_revenue, 4)
+                deleted_ids.append(item.data_item_id)
+        session.flush()
+        for start in range(0, len(deleted_ids), DELETE_CHUNK_SIZE):
+            session.query(ElectricityData).filter(
+                ElectricityData.data_item_id.in_(deleted_ids[start:start + DELETE_CHUNK_SIZE])
+            ).delete(synchronize_session=False)
+        commit()
+        return len(deleted_ids)
 
     @staticmethod
     def make_query_dictionary(query):
@@ -158,7 +527,8 @@ class ReservationStatus(enum.Enum):
 class Reservation(Base):
     __tablename__ = "reservations"
     reservation_id = Column(Integer, primary_key=True)
-    received_timestamp = Column(DateTime(timezone=True), server_default=func.now(tz=pytz.utc))
+    # when the station first saw the request, on the station's clock (see stamp_received_requests)
+    received_timestamp = Column(DateTime(timezone=True))
     confirmed_at = Column(DateTime(timezone=True))
     spot_id = Column(Integer, nullable=False)
     duration_in_seconds = Column(Integer, nullable=False)
@@ -167,57 +537,157 @@ class Reservation(Base):
 
     def add(self):
         session.add(self)
-        session.commit()
+        commit()
         return self
 
-    def reservation_expired(self):
+    def reservation_expired(self, now=None):
+        # pass now when checking many reservations, so the clock is read once per batch
+        now = now or utcnow()
         # Request expires if after receiving the request the full duration time has already passed
         if self.status == ReservationStatus.reservation_requested:
+            if self.received_timestamp is None:
+                # not seen by the station yet
+                return False
             return int(
                 self.duration_in_seconds
-                - (datetime.datetime.utcnow() - self.received_timestamp).total_seconds()
+                - (now - self.received_timestamp).total_seconds()
             ) <= 0
         # Confirmed requests expire when full duration time has passed after confirmation
         if self.status == ReservationStatus.reservation_confirmed:
             return int(
                 self.duration_in_seconds
-                - (datetime.datetime.utcnow() - self.confirmed_at).total_seconds()
+                - (now - self.confirmed_at).total_seconds()
             ) <= 0
         return False
 
     def update_to_confirmed(self, confirmation_timestamp):
         self.status = ReservationStatus.reservation_confirmed
         self.confirmed_at = confirmation_timestamp
-        session.commit()
+        commit()
 
     def update_to_unfeasible(self):
         self.status = ReservationStatus.reservation_unfeasible
-        session.commit()
+        commit()
 
     def update_response_sent(self):
         self.response_sent = True
-        session.commit()
+        commit()
+
+    @staticmethod
+    def finished_condition(now=None):
+        """SQL condition for reservations that can be removed: communicated rejections and
+        communicated confirmations that have expired (same rule as reservation_expired, evaluated in the db).
+        """
+        # the time of the clock, not the db's "now": confirmed_at is written from the clock, which may be simulated
+        now = bindparam("now", now or utcnow(), type_=DateTime)
+        seconds_since_confirmation = (func.julianday(now) - func.julianday(Reservation.confirmed_at)) * 86400
+        return and_(
+            Reservation.response_sent == true(),
+            or_(
+                Reservation.status == ReservationStatus.reservation_unfeasible,
+                and_(
+                    Reservation.status == ReservationStatus.reservation_confirmed,
+                    seconds_since_confirmation >= Reservation.duration_in_seconds,
+                ),
+            ),
+        )
 
     @staticmethod
     def clean_finished():
-        # delete all rejected reservations which have been communicated already
-        session.query(Reservation).filter(
-            Reservation.status == ReservationStatus.reservation_unfeasible,
-            Reservation.response_sent == true()
-        ).delete()
-        # get confirmed and communicated reservations and clean if expired
-        for reservation in session.query(Reservation).filter(
-            Reservation.status == ReservationStatus.reservation_confirmed,
-            Reservation.response_sent == true()
-        ).all():
-            if reservation.reservation_expired():
-                session.delete(reservation)
-        session.commit()
+        session.query(Reservation).filter(Reservation.finished_condition()).delete(synchronize_session=False)
+        commit()
 
     @staticmethod
     def get_open_reservation_requests():
         return session.query(Reservation).filter(Reservation.status == ReservationStatus.reservation_requested).all()
 
+    @staticmethod
+    def stamp_received_requests(now=None):
+        """Sets the received time of requests the station hasn't seen yet to now, their duration starts then.
+        Stamped by the station rather than the process storing the request, so expiry only depends on the
+        station's clock, which may be simulated.
+        """
+        session.query(Reservation).filter(
+            Reservation.status == ReservationStatus.reservation_requested,
+            Reservation.received_timestamp.is_(None),
+        ).update({"received_timestamp": now or utcnow()}, synchronize_session=False)
+        commit()
+
+    @staticmethod
+    def get_open_reservation_request_summaries():
+        """Gets (reservation_id, spot_id, duration_in_seconds, received_timestamp) of all open requests,
+        earliest first, without loading ORM objects.
+        """
+        return session.query(
+            Reservation.reservation_id,
+            Reservation.spot_id,
+            Reservation.duration_in_seconds,
+            Reservation.received_timestamp,
+        ).filter(
+            Reservation.status == ReservationStatus.reservation_requested
+        ).order_by(Reservation.received_timestamp, Reservation.reservation_id).all()
+
+    @staticmethod
+    def bulk_update_decisions(confirmed, rejected_ids):
+        """Writes admission decisions with two statements.
+        confirmed is a list of (reservation_id, confirmed_at), rejected_ids a list of reservation ids.
+        """
+        if confirmed:
+            table = Reservation.__table__
+            session.execute(
+                update(table).where(table.c.reservation_id == bindparam("b_reservation_id")).values(
+                    status=ReservationStatus.reservation_confirmed,
+                    confirmed_at=bindparam("b_confirmed_at"),
+                ),
+                [
+                    {"b_reservation_id": reservation_id, "b_confirmed_at": confirmed_at}
+                    for reservation_id, confirmed_at in confirmed
+                ],
+            )
+        for start in range(0, len(rejected_ids), DELETE_CHUNK_SIZE):
+            session.query(Reservation).filter(
+                Reservation.reservation_id.in_(rejected_ids[start:start + DELETE_CHUNK_SIZE])
+            ).update({"status": ReservationStatus.reservation_unfeasible}, synchronize_session=False)
+        commit()
+
+    @staticmethod
+    def add_new(reservations):
+        """Stores the reservations (reservation_id -> (spot_id, duration)) not stored before, in one transaction.
+        Recently seen ids are skipped without a query, the others are checked with one query per chunk.
+        Returns the ids of the new reservations.
+        """
+        seen = current_seen_reservations()
+        unseen = [reservation_id for reservation_id in reservations if reservation_id not in seen]
+        if not unseen:
+            return []
+        known = set()
+        for start in range(0, len(unseen), DELETE_CHUNK_SIZE):
+            known.update(reservation_id for reservation_id, in session.query(Reservation.reservation_id).filter(
+                Reservation.reservation_id.in_(unseen[start:start + DELETE_CHUNK_SIZE])
+            ))
+        new = [reservation_id for reservation_id in unseen if reservation_id not in known]
+        if new:
+            session.execute(insert(Reservation.__table__), [
+                {
+                    "reservation_id": reservation_id,
+                    # stamped by the station, dbs of older versions have a server default for it
+                    "received_timestamp": None,
+                    "spot_id": reservations[reservation_id][0],
+                    "duration_in_seconds": reservations[reservation_id][1],
+                }
+                for reservation_id in new
+            ])
+        commit()
+        # only after the commit (don't call inside transaction()), a failed insert is retried with the next message
+        for reservation_id in unseen:
+            seen.add(reservation_id)
+        log = current_reservation_log()
+        if log is not None:
+            for reservation_id in new:
+                spot_id, duration = reservations[reservation_id]
+                log.append(Event.requested, reservation_id, spot_id, duration)
+        return new
+
     @staticmethod
     def get_reservation_by_id(reservation_id):
         return session.query(Reservation).get(reservation_id)
@@ -232,6 +702,14 @@ class Reservation(Base):
             Reservation.response_sent == true()
         ).all()
 
+    @staticmethod
+    def get_confirmed_since(timestamp):
+        """Gets reservations confirmed at or after timestamp, communicated or not."""
+        return session.query(Reservation).filter(
+            Reservation.status == ReservationStatus.reservation_confirmed,
+            Reservation.confirmed_at >= timestamp,
+        ).all()
+
     @staticmethod
     def get_confirmed_reservation_requests():
         """Gets processed and confirmed reservation requests that haven't been communicated back."""
@@ -257,5 +735,34 @@ class Reservation(Base):
         ).all()
 
 
-Base.metadata.create_all(engine)
-
+def _migrate_read_ids(connection):
+    """Recreates spot_sensor_reading of schema version 1 with AUTOINCREMENT, read ids restarted at 1 without it."""
+    table = SpotSensorData.__table__
+    sql = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'spot_sensor_reading'"
+    ).scalar()
+    if sql is None or "AUTOINCREMENT" in sql.upper():
+        return
+    columns = ", ".join(column.name for column in table.columns)
+    connection.exec_driver_sql("ALTER TABLE spot_sensor_reading RENAME TO spot_sensor_reading_old")
+    table.create(connection)
+    connection.exec_driver_sql(
+        f"INSERT INTO spot_sensor_reading ({columns}) SELECT {columns} FROM spot_sensor_reading_old"
+    )
+    connection.exec_driver_sql("DROP TABLE spot_sensor_reading_old")
+
+
+def ensure_schema(force=False, schema_engine=None):
+    """Creates missing tables, unless the db is already stamped with the current schema version.
+    Skipping the schema check keeps starting an edge process cheap.
+    """
+    schema_engine = schema_engine or current_engine()
+    with schema_engine.connect() as connection:
+        if not force and connection.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION:
+            return False
+    with schema_engine.begin() as connection:
+        _migrate_read_ids(connection)
+    Base.metadata.create_all(schema_engine)
+    with schema_engine.connect() as connection:
+        connection.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION}")
+    return True
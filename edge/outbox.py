@@ -0,0 +1,177 @@
+"""Storage budget for the edge outbox, i.e. the unsent rows of spot_sensor_reading and electricity_data.
+
+While the cloud is unreachable, the outbox would grow without limit. Once the budget is exceeded,
+the oldest unsent spot readings are reduced with the configured policy:
+    downsample  delete every second reading per spot
+    priority    delete readings that don't change the occupied state of their spot (battery samples),
+                occupancy transitions are kept
+    aggregate   collapse each run of equal occupied state of a spot into its first reading (the transition)
+                and its last reading (the latest battery level)
+Electricity items carry production and revenue per interval, so they are always compacted into
+aggregate items, which keeps the totals. If a policy can't free enough space, the oldest readings are dropped.
+With the ring outbox backend (see ring_outbox.py) the readings are bounded by the ring's capacity, which overwrites
+the oldest unsent reading when full; only its depth is reported then.
+"""
+import logging
+
+from edge.constants import (
+    OUTBOX_MAX_READINGS,
+    OUTBOX_MAX_ELECTRICITY_ITEMS,
+    OUTBOX_MAX_DB_SIZE,
+    OUTBOX_POLICY,
+    OUTBOX_ELECTRICITY_GROUP_SIZE,
+)
+from edge.models import SpotSensorData, ElectricityData, current_engine, current_ring_outbox
+
+# reduce the outbox to this share of the budget, so the policy doesn't have to run on every check
+TARGET_FILL_RATIO = 0.9
+MAX_READINGS_PER_PASS = 20000
+
+
+def downsample(readings, excess):
+    """Ids of every second reading per spot, oldest first."""
+    readings_per_spot = {}
+    read_ids = []
+    for read_id, spot_id, _ in readings:
+        readings_per_spot[spot_id] = readings_per_spot.get(spot_id, 0) + 1
+        if readings_per_spot[spot_id] % 2 == 0:
+            read_ids.append(read_id)
+            if len(read_ids) >= excess:
+                break
+    return read_ids
+
+
+def drop_by_priority(readings, excess):
+    """Ids of readings which don't change the occupied state of their spot, oldest first."""
+    last_occupied_state = {}
+    read_ids = []
+    for read_id, spot_id, is_occupied in readings:
+        if last_occupied_state.get(spot_id) == is_occupied:
+            read_ids.append(read_id)
+            if len(read_ids) >= excess:
+                break
+        last_occupied_state[spot_id] = is_occupied
+    return read_ids
+
+
+def compact_runs(readings, excess):
+    """Ids of all readings between the first and the last reading of a run of equal occupied state."""
+    runs = {}  # spot_id -> [is_occupied, last read_id of run or None]
+    read_ids = []
+    for read_id, spot_id, is_occupied in readings:
+        run = runs.get(spot_id)
+        if run is not None and run[0] == is_occupied:
+            if run[1] is not None:
+                # previous last reading of the run is now in the middle of the run
+                read_ids.append(run[1])
+                if len(read_ids) >= excess:
+                    break
+            run[1] = read_id
+        else:
+            runs[spot_id] = [is_occupied, None]
+    return read_ids
+
+
+POLICIES = {
+    "downsample": downsample,
+    "priority": drop_by_priority,
+    "aggregate": compact_runs,
+}
+
+
+def get_db_size():
+    """Bytes of the sqlite database in use, i.e. without its free pages.
+    The file doesn't shrink when rows are deleted, their pages stay free in it until they are reused or handed
+    back by the compactor's incremental vacuum, so its size would stay over the budget after a reduction.
+    """
+    with current_engine().connect() as connection:
+        page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+        freelist_count = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+    return (page_count - freelist_count) * page_size
+
+
+class OutboxBudget:
+    """Keeps the unsent data of the edge outbox within its storage budget."""
+
+    def __init__(
+            self,
+            max_readings=OUTBOX_MAX_READINGS,
+            max_electricity_items=OUTBOX_MAX_ELECTRICITY_ITEMS,
+            max_db_size=OUTBOX_MAX_DB_SIZE,
+            policy=OUTBOX_POLICY,
+            metrics=None,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown outbox policy {policy}, use one of {list(POLICIES)}")
+        self.max_readings = max_readings
+        self.max_electricity_items = max_electricity_items
+        self.max_db_size = max_db_size
+        self.policy = policy
+        self.metrics = metrics
+        self.readings_depth = 0
+        self.electricity_depth = 0
+        self.db_size = 0
+        self.size_after_reduction = 0
+
+    @property
+    def is_full(self):
+        return self.readings_depth >= self.max_readings or self.db_size >= self.max_db_size
+
+    def accepts_reading(self, is_transition):
+        """Backpressure for the producer: while the outbox is full, only occupancy transitions are stored."""
+        return is_transition or not self.is_full
+
+    def _count_unsent_readings(self):
+        ring_outbox = current_ring_outbox()
+        return SpotSensorData.count_unsent() if ring_outbox is None else ring_outbox.depth()
+
+    def enforce(self):
+        """Updates queue depth metrics and reduces the outbox if it exceeds the budget."""
+        self.readings_depth = self._count_unsent_readings()
+        self.electricity_depth = ElectricityData.count_unsent()
+        self.db_size = get_db_size()
+
+        target_readings = int(self.max_readings * TARGET_FILL_RATIO)
+        # Deleting readings only frees the pages that end up (almost) empty, readings deleted by a policy are spread
+        # over the pages. The queue is halved again only once the db grew since the last reduction, otherwise
+        # every check would halve it while the size stays the same.
+        over_size = self.max_db_size <= self.db_size and self.size_after_reduction < self.db_size
+        if over_size:
+            target_readings = min(target_readings, self.readings_depth // 2)
+        # the ring outbox is bounded by its capacity, it isn't reduced with the policy
+        over_budget = self.readings_depth > self.max_readings or over_size
+        if over_budget and current_ring_outbox() is None:
+            self.readings_depth -= self._reduce_readings(self.readings_depth - target_readings)
+            self.db_size = get_db_size()
+            if over_size:
+                self.size_after_reduction = self.db_size
+
+        if self.electricity_depth > self.max_electricity_items:
+            excess = self.electricity_depth - int(self.max_electricity_items * TARGET_FILL_RATIO)
+            self.electricity_depth -= self._compact_electricity_data(excess)
+
+        if self.metrics is not None:
+            self.metrics.gauge("outbox_readings", self.readings_depth)
+            self.metrics.gauge("outbox_electricity_items", self.electricity_depth)
+            self.metrics.gauge("db_size_bytes", self.db_size)
+
+    def _reduce_readings(self, excess):
+        readings = SpotSensorData.get_oldest_unsent_summary(min(MAX_READINGS_PER_PASS, max(2 * excess, 1000)))
+        read_ids = POLICIES[self.policy](readings, excess)
+        if len(read_ids) < excess:
+            # policy couldn't free enough, drop the oldest remaining readings to stay within the budget
+            selected = set(read_ids)
+            read_ids += [
+                reading[0] for reading in readings if reading[0] not in selected
+            ][:excess - len(read_ids)]
+        SpotSensorData.delete_by_ids(read_ids)
+        logging.warning(f"Outbox over budget, removed {len(read_ids)} unsent readings ({self.policy}).")
+        return len(read_ids)
+
+    def _compact_electricity_data(self, excess):
+        group_size = OUTBOX_ELECTRICITY_GROUP_SIZE
+        number_of_groups = -(-excess // (group_size - 1))  # ceil
+        deleted = ElectricityData.compact_oldest_unsent(number_of_groups * group_size, group_size)
+        logging.warning(f"Outbox over budget, compacted {deleted} unsent electricity items.")
+        return deleted
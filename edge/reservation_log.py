@@ -0,0 +1,230 @@
+"""Append-only log of reservation events, kept next to the reservation tables.
+
+Every change of a reservation is appended as an event (requested, confirmed, rejected, expired, ended) instead of
+only flipping status flags in place. Views of the reservations are derived from the log incrementally
+(ReservationView), a restart replays the tail of the log from a point in time, and copying a range of offsets
+(read_range/append_raw) is all it takes to ship events to another log.
+
+Layout of the log directory:
+    <base offset>.seg  fixed size records: event, timestamp (epoch ms), reservation id, station id, spot id,
+                       duration, crc32 of the record. The offset of a record is its number in the whole log.
+    <base offset>.idx  every INDEX_INTERVAL-th record of the segment: (timestamp, offset), to find where to start
+                       a replay from a point in time without scanning the whole log.
+Several processes append to the same log, appends are serialized with a lock file.
+
+Enabled by the reservation_log environment variable (directory of the log).
+"""
+import bisect
+import enum
+import fcntl
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+from edge.timeutil import now_ms
+
+RECORD = struct.Struct("<BqqIHI")
+CHECKSUM = struct.Struct("<I")
+RECORD_SIZE = RECORD.size + CHECKSUM.size
+INDEX_ENTRY = struct.Struct("<qq")
+SEGMENT_RECORDS = 65536  # about 2 MB per segment
+INDEX_INTERVAL = 256
+SEGMENT_NAME = "{:020d}.seg"
+INDEX_NAME = "{:020d}.idx"
+
+
+class Event(enum.IntEnum):
+    requested = 0
+    confirmed = 1
+    rejected = 2
+    expired = 3
+    ended = 4  # e.g. the bike was taken
+
+
+ReservationEvent = namedtuple(
+    "ReservationEvent", ["offset", "event", "timestamp", "reservation_id", "station_id", "spot_id", "duration"]
+)
+
+
+class ReservationLog:
+
+    def __init__(self, directory, station_id=0):
+        self.directory = directory
+        self.station_id = station_id  # of events appended without one, i.e. on the edge
+        os.makedirs(directory, exist_ok=True)
+        self.lock_fd = os.open(os.path.join(directory, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        self.segment_base = None
+        self.segment_fd = None
+
+    def _path(self, name, base):
+        return os.path.join(self.directory, name.format(base))
+
+    def segment_bases(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".seg"))
+
+    def _open_active_segment(self):
+        """Opens the newest segment for appending, must hold the lock. Another process may have rolled it."""
+        if self.segment_base is None:
+            bases = self.segment_bases()
+            self.segment_base = bases[-1] if bases else 0
+        else:
+            next_base = self._next_base()
+            if os.path.exists(self._path(SEGMENT_NAME, next_base)):
+                os.close(self.segment_fd)
+                self.segment_fd = None
+                self.segment_base = self.segment_bases()[-1]
+        if self.segment_fd is None:
+            self.segment_fd = os.open(
+                self._path(SEGMENT_NAME, self.segment_base), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            # a record torn by a crash while appending would misalign all later ones
+            size = os.fstat(self.segment_fd).st_size
+            if size % RECORD_SIZE:
+                os.ftruncate(self.segment_fd, size - size % RECORD_SIZE)
+
+    def _next_base(self):
+        return self.segment_base + os.fstat(self.segment_fd).st_size // RECORD_SIZE
+
+    def append(self, event, reservation_id, spot_id, duration=0, station_id=None, timestamp=None):
+        """Appends an event and returns its offset."""
+        record = RECORD.pack(
+            event, timestamp or now_ms(), reservation_id,
+            self.station_id if station_id is None else station_id, spot_id, duration or 0,
+        )
+        return self.append_raw(record + CHECKSUM.pack(zlib.crc32(record)))[0]
+
+    def append_raw(self, records):
+        """Appends complete records, e.g. a range read from another log.
+        Returns the offset of the first record and the offset behind the last one.
+        """
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            self._open_active_segment()
+            first = self._next_base()
+            os.write(self.segment_fd, records)
+            end = self._next_base()
+            indexed = [
+                offset for offset in range(first, end) if (offset - self.segment_base) % INDEX_INTERVAL == 0
+            ]
+            if indexed:
+                with open(self._path(INDEX_NAME, self.segment_base), "ab") as index:
+                    for offset in indexed:
+                        timestamp = RECORD.unpack_from(records, (offset - first) * RECORD_SIZE)[1]
+                        index.write(INDEX_ENTRY.pack(timestamp, offset))
+            if end - self.segment_base >= SEGMENT_RECORDS:
+                # roll over, the next append (of any process) goes to the new segment
+                os.close(os.open(self._path(SEGMENT_NAME, end), os.O_WRONLY | os.O_CREAT, 0o644))
+            return first, end
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def end_offset(self):
+        bases = self.segment_bases()
+        if not bases:
+            return 0
+        return bases[-1] + os.path.getsize(self._path(SEGMENT_NAME, bases[-1])) // RECORD_SIZE
+
+    def read_range(self, start, end=None):
+        """Raw records from offset start up to (excluding) end, for copying them to another log."""
+        chunks = []
+        bases = self.segment_bases()
+        for i, base in enumerate(bases):
+            segment_end = bases[i + 1] if i + 1 < len(bases) else None
+            if segment_end is not None and segment_end <= start or end is not None and base >= end:
+                continue
+            with open(self._path(SEGMENT_NAME, base), "rb") as f:
+                f.seek(max(0, start - base) * RECORD_SIZE)
+                data = f.read() if end is None else f.read((end - max(start, base)) * RECORD_SIZE)
+            chunks.append(data[:len(data) - len(data) % RECORD_SIZE])
+        return b"".join(chunks)
+
+    def read(self, start=0):
+        """Yields the events from offset start on, records with a wrong checksum are skipped."""
+        data = self.read_range(start)
+        for i in range(len(data) // RECORD_SIZE):
+            position = i * RECORD_SIZE
+            (checksum,) = CHECKSUM.unpack_from(data, position + RECORD.size)
+            if zlib.crc32(data[position:position + RECORD.size]) != checksum:
+                continue
+            event, *fields = RECORD.unpack_from(data, position)
+            yield ReservationEvent(start + i, Event(event), *fields)
+
+    def offset_at(self, timestamp):
+        """An offset at or before the first event at or after timestamp (epoch ms), found with the index.
+        Appends of different processes aren't strictly ordered by time, so replays filter by timestamp as well.
+        """
+        start = 0
+        for base in self.segment_bases():
+            try:
+                with open(self._path(INDEX_NAME, base), "rb") as f:
+                    index = f.read()
+            except FileNotFoundError:
+                continue
+            entries = [INDEX_ENTRY.unpack_from(index, i) for i in range(0, len(index), INDEX_ENTRY.size)]
+            if not entries or entries[0][0] >= timestamp:
+                return start
+            position = bisect.bisect_left(entries, (timestamp,))
+            start = entries[position - 1][1]
+            if position < len(entries):
+                return start
+        return start
+
+    def close(self):
+        if self.segment_fd is not None:
+            os.close(self.segment_fd)
+        os.close(self.lock_fd)
+
+
+# current state of a reservation derived from the log
+ReservationRecord = namedtuple(
+    "ReservationRecord", ["event", "station_id", "spot_id", "duration", "requested_at", "updated_at"]
+)
+
+
+class ReservationView:
+    """Current state of all reservations, kept up to date by applying new events of the log."""
+
+    def __init__(self, log, since=None):
+        self.log = log
+        self.since = since  # epoch ms, older events are ignored
+        self.offset = 0 if since is None else log.offset_at(since)
+        self.reservations = {}  # reservation_id -> ReservationRecord
+
+    def apply(self, event):
+        if self.since is not None and event.timestamp < self.since:
+            return
+        previous = self.reservations.get(event.reservation_id)
+        self.reservations[event.reservation_id] = ReservationRecord(
+            event.event,
+            event.station_id,
+            event.spot_id,
+            event.duration or (previous.duration if previous else 0),
+            previous.requested_at if previous else event.timestamp,
+            event.timestamp,
+        )
+
+    def catch_up(self):
+        """Applies the events appended since the last call, returns how many."""
+        applied = 0
+        for event in self.log.read(self.offset):
+            self.apply(event)
+            self.offset = event.offset + 1
+            applied += 1
+        return applied
+
+    def active_confirmed(self, now=None):
+        """Confirmed reservations whose duration hasn't passed, as reservation_id -> ReservationRecord."""
+        now = now or now_ms()
+        return {
+            reservation_id: record for reservation_id, record in self.reservations.items()
+            if record.event == Event.confirmed and record.updated_at + record.duration * 1000 > now
+        }
+
+
+def get_reservation_log_from_env(station_id=0):
+    """Returns the reservation log if the reservation_log environment variable is set, None otherwise."""
+    directory = os.getenv("reservation_log")
+    if not directory:
+        return None
+    return ReservationLog(directory, station_id)
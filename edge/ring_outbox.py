@@ -0,0 +1,144 @@
+"""Outbox of spot readings in a memory-mapped ring buffer file, an alternative to the spot_sensor_reading table.
+
+A reading is one fixed width record written into the mapped file, sending it advances the consumer cursor:
+no ORM objects, no insert, status update and delete per reading. The producer (the station) and the consumer
+(the uplink) are different processes, both map the same file; the producer and consumer cursors live in its header,
+so buffered readings survive a crash of either process. Cursors are sequence numbers that only grow, a record's
+sequence number is also its read id. When the buffer is full the oldest unsent reading is overwritten.
+
+Enabled with outbox_backend=ring (or OUTBOX_BACKEND in constants.py).
+"""
+import fcntl
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from edge.constants import OUTBOX_BACKEND, RING_OUTBOX_FILE, RING_OUTBOX_CAPACITY
+from edge.timeutil import now_ms
+
+MAGIC = b"BSRING1\x00"
+# magic, record size, capacity in records, producer cursor (next sequence number), consumer cursor (oldest unsent)
+HEADER = struct.Struct("<8sIIqq")
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+CURSOR = struct.Struct("<q")
+# sequence number, timestamp (epoch ms), spot id, occupied, has battery level, battery level
+RECORD = struct.Struct("<qqI??d")
+
+# same attributes as a SpotSensorData row, read_timestamp is in epoch ms
+Reading = namedtuple("Reading", ["read_id", "read_timestamp", "spot_id", "is_occupied", "battery_level"])
+
+
+class RingOutbox:
+
+    def __init__(self, path=RING_OUTBOX_FILE, capacity=RING_OUTBOX_CAPACITY):
+        self.path = path
+        size = HEADER.size + capacity * RECORD.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if os.fstat(self.fd).st_size == 0:
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, RECORD.size, capacity, 1, 1), 0)
+            magic, record_size, self.capacity, _, _ = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError(f"{path} is not a ring outbox of this version")
+        self.map = mmap.mmap(self.fd, HEADER.size + self.capacity * RECORD.size)
+
+    def _locked(self):
+        return _FileLock(self.fd)
+
+    def _cursors(self):
+        return CURSOR.unpack_from(self.map, HEAD_OFFSET)[0], CURSOR.unpack_from(self.map, TAIL_OFFSET)[0]
+
+    def _position(self, sequence):
+        return HEADER.size + (sequence % self.capacity) * RECORD.size
+
+    def append(self, spot_id, is_occupied, battery_level, timestamp=None):
+        """Appends a reading and returns its read id."""
+        with self._locked():
+            head, tail = self._cursors()
+            if head - tail >= self.capacity:
+                # full: the oldest unsent reading is overwritten
+                CURSOR.pack_into(self.map, TAIL_OFFSET, head - self.capacity + 1)
+            RECORD.pack_into(
+                self.map, self._position(head),
+                head, timestamp or now_ms(), spot_id, is_occupied, battery_level is not None, battery_level or 0.0,
+            )
+            # the record is complete before the producer cursor makes it visible
+            CURSOR.pack_into(self.map, HEAD_OFFSET, head + 1)
+        return head
+
+    def _decode(self, start, end):
+        """Readings from sequence start to end (excluding), decoded straight from the mapped file."""
+        readings = []
+        while start < end:
+            first = self._position(start)
+            # up to the end of the buffer, a range that wraps around is read as two slices
+            count = min(end - start, self.capacity - start % self.capacity)
+            # slices of the map are released right away, the map can't be closed while one exists
+            with memoryview(self.map) as view, view[first:first + count * RECORD.size] as records:
+                readings += [
+                    Reading(sequence, timestamp, spot_id, is_occupied, battery_level if has_battery else None)
+                    for sequence, timestamp, spot_id, is_occupied, has_battery, battery_level
+                    in RECORD.iter_unpack(records)
+                ]
+            start += count
+        return readings
+
+    def peek(self, n):
+        """The oldest n unsent readings, they stay in the outbox until consumed."""
+        with self._locked():
+            head, tail = self._cursors()
+            return self._decode(tail, min(head, tail + n))
+
+    def consume(self, last_read_id):
+        """Marks all readings up to last_read_id as sent."""
+        with self._locked():
+            _, tail = self._cursors()
+            if last_read_id >= tail:
+                CURSOR.pack_into(self.map, TAIL_OFFSET, last_read_id + 1)
+
+    def depth(self):
+        head, tail = self._cursors()
+        return head - tail
+
+    def latest_per_spot_after(self, read_id):
+        """(spot_id, is_occupied, battery_level) of the latest reading of every spot after read_id,
+        as far as the readings are still in the buffer, sent or not.
+        """
+        with self._locked():
+            head, _ = self._cursors()
+            readings = self._decode(max(read_id + 1, head - self.capacity), head)
+        latest = {reading.spot_id: (reading.spot_id, reading.is_occupied, reading.battery_level) for reading in readings}
+        return list(latest.values())
+
+    def flush(self):
+        """Writes the mapped pages to disk, the readings then also survive a power loss."""
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class _FileLock:
+    """Exclusive lock on the file shared by the producer and consumer processes."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return False
+
+
+def get_ring_outbox_from_env():
+    """Returns the ring outbox if it is the configured outbox backend, None if readings go to the db."""
+    if os.getenv("outbox_backend", OUTBOX_BACKEND) != "ring":
+        return None
+    return RingOutbox()
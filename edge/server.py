@@ -1,4 +1,3 @@
-from random import randint
 import os
 import itertools
 import logging
@@ -6,20 +5,28 @@ import zmq
 import json
 from dotenv import load_dotenv
 
-from edge.constants import ELECTRICITY_CONTRACT_KWH_PRICE
+from edge.clock import clock_from_env
+from edge.compression import decode, frame_like
+from edge.constants import ELECTRICITY_CONTRACT_KWH_PRICE, DEFAULT_STATION_ID
+from edge.instrumentation import get_instrumentation
 
 load_dotenv()
-from models import Constant, Reservation
+from edge.models import Reservation, current_constant_cache, release_session
 
 logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
-context = zmq.Context()
-server = context.socket(zmq.REP)
-logging.info('Listening to the incoming requests...')
-server.bind(os.getenv("bind_address"))
-for cycles in itertools.count():
+station_id = int(os.getenv("station_id", DEFAULT_STATION_ID))
+
+
+def handle_cloud_message(request, metrics, own_station_id=station_id):
+    """Stores market price and new reservations of a message from the cloud.
+    Returns False if the message was malformed or a reservation couldn't be stored.
+    """
     normal_request = True
-    request = server.recv()
-    request_dict = json.loads(request.decode())
+    metrics.count("bytes_received", len(request))
+    with metrics.timer("deserialize"):
+        request_dict = json.loads(request.decode())
+    if request_dict.get("station_id", own_station_id) != own_station_id:
+        logging.warning(f"Received request for station {request_dict['station_id']}, this is station {own_station_id}.")
     current_market_price = request_dict.get("current_market_price")
     if not current_market_price:
         normal_request = False
@@ -27,33 +34,46 @@ for cycles in itertools.count():
         current_market_price = ELECTRICITY_CONTRACT_KWH_PRICE
     else:
         logging.info(f"Received current market price: {current_market_price}")
-    # write it to constants table so that application can read it
-    Constant(name='current_market_price', real_value=current_market_price).save_or_update()
+    # write it to constants table so that application can read it, only if price has changed
+    with metrics.timer("commit_price"):
+        if current_constant_cache().set_real_value('current_market_price', current_market_price):
+            logging.info("Market price changed, constant updated.")
 
     reservations = request_dict.get("reservations")
-    for reservation_id, reservation_details in reservations.items():
-        spot_id = reservation_details.get("spot_id")
-        duration = reservation_details.get("duration")
+    metrics.count("reservations", len(reservations))
+    # the cloud resends all pending reservations until they are confirmed, most of them are known already
+    reservations = {
+        int(reservation_id): (reservation_details.get("spot_id"), reservation_details.get("duration"))
+        for reservation_id, reservation_details in reservations.items()
+    }
+    try:
+        with metrics.timer("commit"):
+            new_reservation_ids = Reservation.add_new(reservations)
+    except Exception as e:
+        logging.error("Something went wrong when processing reservation info: " + str(e))
+        return False
+    metrics.count("new_reservations", len(new_reservation_ids))
+    for reservation_id in new_reservation_ids:
+        spot_id, duration = reservations[reservation_id]
         logging.info(f"Received reservation {reservation_id} for spot {spot_id}, duration: {duration}")
-        # create entry for open reservations that have not been received yet
-        if not Reservation.get_reservation_by_id(reservation_id):
-            logging.debug(f"Saving reservation {reservation_id}")
-            try:
-                Reservation(
-                    reservation_id=reservation_id,
-                    spot_id=spot_id,
-                    duration_in_seconds=duration,
-                ).add()
-            except Exception as e:
-                logging.error(
-                    "Something went wrong when processing reservation info: "
-                    + str(e)
-                )
-                normal_request = False
-
-
-    if normal_request:
-        logging.info("Normal request.")
-    # time.sleep(1)
-    # after making sure that all data have been processed send ok reply
-    server.send('ok'.encode())
+    return normal_request
+
+
+if __name__ == "__main__":
+    clock_from_env()
+    context = zmq.Context()
+    server = context.socket(zmq.REP)
+    logging.info('Listening to the incoming requests...')
+    server.bind(os.getenv("bind_address"))
+    metrics = get_instrumentation("edge_server")
+    for cycles in itertools.count():
+        with metrics.timer("decompress"):
+            request, framed = decode(server.recv())
+        if handle_cloud_message(request, metrics):
+            logging.info("Normal request.")
+        # time.sleep(1)
+        # after making sure that all data have been processed send ok reply
+        with metrics.timer("send"):
+            server.send(frame_like('ok'.encode(), framed))
+        release_session()
+        metrics.end_cycle()
@@ -0,0 +1,70 @@
+# measures how long edge processes take to start: import time of the edge modules (each in a fresh interpreter)
+# and the schema check with and without a matching schema version stamp
+import os, sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))  # to avoid possible relative import errors
+import statistics
+import subprocess
+import time
+
+MODULES = ["edge.models", "edge.compactor", "edge.outbox", "edge.bike_station.application"]
+RUNS = 5
+IMPORT_TIME_TOP_N = 10
+
+MEASURE_IMPORT = "import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+
+
+def measure_import(module):
+    durations = []
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE_IMPORT.format(module=module)],
+            capture_output=True, text=True, check=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        ).stdout
+        durations.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(durations)
+
+
+def slowest_imports(module):
+    """Cumulative import time of the slowest modules imported by module, from python -X importtime."""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True, env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative), name.rstrip()))
+    return sorted(imports, reverse=True)[:IMPORT_TIME_TOP_N]
+
+
+if __name__ == "__main__":
+    print(f"{'module':<32} | {'import ms (median of ' + str(RUNS) + ')':>24}")
+    for module in MODULES:
+        print(f"{module:<32} | {measure_import(module) * 1000:>24.1f}")
+
+    print("\nSlowest imports of edge.models (cumulative ms):")
+    for cumulative, name in slowest_imports("edge.models"):
+        print(f"{cumulative / 1000:>8.1f}  {name}")
+
+    from edge.models import current_engine, current_reservation_log, current_ring_outbox, ensure_schema
+
+    # the engine (with the sqlite dialect) is created, and the schema checked, with the first use of the db,
+    # reservation log and ring outbox (if enabled) are opened with their first use
+    start = time.perf_counter()
+    current_engine()
+    first_use = time.perf_counter() - start
+    start = time.perf_counter()
+    current_reservation_log()
+    current_ring_outbox()
+    storage_first_use = time.perf_counter() - start
+    print(f"\nFirst use of the db: {first_use * 1000:.2f} ms, of reservation log and ring outbox: "
+          f"{storage_first_use * 1000:.2f} ms")
+    start = time.perf_counter()
+    ensure_schema()
+    stamped = time.perf_counter() - start
+    start = time.perf_counter()
+    ensure_schema(force=True)
+    full = time.perf_counter() - start
+    print(f"Schema check: {stamped * 1000:.2f} ms with matching stamp, {full * 1000:.2f} ms with create_all")
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def station_database(tmp_path, monkeypatch):
+    """A station db file of its own, used by the edge models in the test."""
+    pytest.importorskip("sqlalchemy")
+    monkeypatch.chdir(tmp_path)  # the models open sqlite.db (and other files) in the working directory on first use
+    from edge.models import StationDatabase, use_station_database, ensure_schema
+    database = StationDatabase(f"sqlite:///{tmp_path}/station.db")
+    with use_station_database(database):
+        ensure_schema()
+        yield database
+
+
+@pytest.fixture(scope="session")
+def cloud_models(tmp_path_factory):
+    """The cloud models, with their db files in a directory of the test session."""
+    pytest.importorskip("sqlalchemy")
+    pytest.importorskip("pytz")
+    # the cloud models open sqlite.db (and the history shards) in the working directory
+    working_directory = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("cloud"))
+    from cloud import models
+    yield models
+    models.release_session()
+    os.chdir(working_directory)
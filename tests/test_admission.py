@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+@pytest.fixture
+def station(station_database):
+    from edge.bike_station.application import BikeStation
+    station = BikeStation(number_of_spots=2)
+    for spot in station.spots.values():
+        spot.occupied_sensor.occupied = True
+    return station
+
+
+def test_spots_are_not_reserved_when_storing_the_decisions_fails(station, monkeypatch):
+    from edge.models import Reservation, ReservationStatus, release_session
+
+    def failing_update(confirmed, rejected_ids):
+        raise RuntimeError("database is locked")
+
+    Reservation.add_new({1: (0, 600)})
+    with monkeypatch.context() as patch:
+        patch.setattr(Reservation, "bulk_update_decisions", staticmethod(failing_update))
+        with pytest.raises(RuntimeError):
+            station.perform_reservations()
+    assert not station.spots[0].reservation_state.is_reserved
+    release_session()
+
+    # decided again with the next cycle, not rejected as already reserved
+    station.perform_reservations()
+    release_session()
+    reservation = Reservation.get_reservation_by_id(1)
+    assert reservation.status == ReservationStatus.reservation_confirmed
+    assert station.spots[0].reservation_state.reservation_id == 1
+    assert station.spots[0].reservation_state.reservation_created_at == reservation.confirmed_at
+
+
+def test_second_request_for_a_spot_in_the_same_batch_is_rejected(station):
+    from edge.bike_station.admission import AdmissionEngine
+    from edge.timeutil import utcnow
+    now = utcnow()
+    engine = AdmissionEngine(station.spots)
+    confirmed, rejected_ids = engine.decide([(2, 1, 600, now), (1, 1, 600, now)], now)
+    assert confirmed == [(1, now)]
+    assert rejected_ids == [2]
+    assert not station.spots[1].reservation_state.is_reserved
+    engine.apply(confirmed, [(2, 1, 600, now), (1, 1, 600, now)])
+    assert station.spots[1].reservation_state.reservation_id == 1
@@ -0,0 +1,38 @@
+import time
+
+from edge.clock import Scheduler, SystemClock, SimulatedClock
+
+
+def test_callback_overrunning_its_interval_under_system_clock():
+    calls = []
+
+    def slow_callback():
+        calls.append(time.monotonic())
+        time.sleep(0.03)  # longer than the interval
+
+    scheduler = Scheduler(SystemClock())
+    scheduler.call_every(0.01, slow_callback)
+    scheduler.run(0.1)
+    assert len(calls) >= 2
+    # no burst of catch-up calls
+    assert all(later - earlier >= 0.025 for earlier, later in zip(calls, calls[1:]))
+
+
+def test_run_ends_after_duration_when_last_callback_overran():
+    scheduler = Scheduler(SystemClock())
+    scheduler.call_every(0.05, lambda: time.sleep(0.08))
+    start = time.monotonic()
+    scheduler.run(0.06)
+    assert time.monotonic() - start < 0.5
+
+
+def test_simulated_clock_jumps_instead_of_waiting():
+    clock = SimulatedClock(start=0)
+    calls = []
+    scheduler = Scheduler(clock)
+    scheduler.call_every(4, lambda: calls.append(clock.monotonic()))
+    start = time.monotonic()
+    scheduler.run(86400)
+    assert time.monotonic() - start < 5
+    assert calls[:3] == [0, 4, 8]
+    assert clock.monotonic() == 86400
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+def freelist_count(engine):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
+def test_step_deletes_processed_rows_and_returns_free_pages(station_database):
+    from edge.compactor import Compactor
+    from edge.models import SpotSensorData, Status
+    compactor = Compactor(chunk_size=5000, vacuum_pages=1000)
+    compactor.enable_incremental_vacuum()
+    table = SpotSensorData.__table__
+    with station_database.engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"spot_id": i % 5, "is_occupied": True, "battery_level": 0.5, "sent_status": Status.processed}
+            for i in range(3000)
+        ])
+    # the pages freed by the deletes are handed back by the vacuum of the steps
+    assert compactor.step() == 3000
+    assert compactor.step() == 0
+    assert freelist_count(station_database.engine) == 0
+
+
+def test_freelist_shrinks_by_vacuum_pages_per_step(station_database):
+    from edge.compactor import Compactor
+    from edge.models import SpotSensorData, Status
+    table = SpotSensorData.__table__
+    Compactor().enable_incremental_vacuum()
+    with station_database.engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"spot_id": i % 5, "is_occupied": True, "battery_level": 0.5, "sent_status": Status.processed}
+            for i in range(20000)
+        ])
+        connection.execute(table.delete())
+    before = freelist_count(station_database.engine)
+    assert before > 10
+    Compactor(vacuum_pages=10).step()
+    assert freelist_count(station_database.engine) == before - 10
+
+
+def test_run_until_clean(station_database):
+    from edge.compactor import Compactor
+    from edge.models import SpotSensorData, Status
+    table = SpotSensorData.__table__
+    with station_database.engine.begin() as connection:
+        connection.execute(table.insert(), [
+            {"spot_id": 0, "is_occupied": False, "sent_status": Status.processed} for _ in range(1200)
+        ])
+    assert Compactor(chunk_size=500).run_until_clean() == 1200
@@ -0,0 +1,37 @@
+import json
+
+from edge.compression import Codec, MIN_COMPRESSED_SIZE, ZLIB_DICTIONARY, decode, frame_like
+from edge.instrumentation import get_instrumentation
+
+MESSAGE = {"station_id": 0, "sensor_data": {str(spot_id): [] for spot_id in range(100)}}
+
+
+def test_uncompressed_messages_are_json_for_peers_without_compression():
+    codec = Codec(enabled=True, metrics=get_instrumentation("test_compression"))
+    payload = json.dumps(MESSAGE).encode()
+    assert len(payload) >= MIN_COMPRESSED_SIZE
+    # not compressed before the peer answered in kind
+    assert json.loads(codec.encode(payload)) == MESSAGE
+    # a peer without compression answers unframed
+    assert codec.decode(b"12") == b"12"
+    assert json.loads(codec.encode(payload)) == MESSAGE
+
+
+def test_messages_are_compressed_once_the_peer_answered_framed():
+    codec = Codec(enabled=True, metrics=get_instrumentation("test_compression"))
+    payload = json.dumps(MESSAGE).encode()
+    request, framed = decode(codec.encode(payload))
+    assert (request, framed) == (payload, True)
+    assert codec.decode(frame_like(b"ok", framed)) == b"ok"
+
+    message = codec.encode(payload)
+    assert message[:1] == ZLIB_DICTIONARY
+    assert decode(message) == (payload, True)
+    # too small to be compressed
+    assert json.loads(codec.encode(b'{"station_id": 0}')) == {"station_id": 0}
+
+
+def test_plain_json_is_answered_plain():
+    request, framed = decode(b'{"station_id": 0}')
+    assert (request, framed) == (b'{"station_id": 0}', False)
+    assert frame_like(b"ok", framed) == b"ok"
@@ -0,0 +1,47 @@
+import multiprocessing
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+BUMPS_PER_PROCESS = 200
+
+
+def bump_versions(version_file):
+    from edge.models import ConstantCache
+    cache = ConstantCache(version_file=version_file)
+    for _ in range(BUMPS_PER_PROCESS):
+        cache._bump_version()
+
+
+def test_concurrent_bumps_are_not_lost(tmp_path):
+    from edge.models import ConstantCache
+    version_file = str(tmp_path / "constants.version")
+    processes = [multiprocessing.Process(target=bump_versions, args=(version_file,)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert ConstantCache(version_file=version_file)._read_version() == 4 * BUMPS_PER_PROCESS
+
+
+def test_cached_reads_only_open_the_version_file_after_a_change(station_database, tmp_path, monkeypatch):
+    from edge.models import ConstantCache
+    version_file = str(tmp_path / "constants.version")
+    cache, other_process_cache = ConstantCache(version_file), ConstantCache(version_file)
+    cache.set_real_value("price", 1.0)
+    assert other_process_cache.get_real_value("price") == 1.0
+
+    reads = []
+    read_version = ConstantCache._read_version
+    monkeypatch.setattr(ConstantCache, "_read_version", lambda self: reads.append(self) or read_version(self))
+    for _ in range(3):
+        assert cache.get_real_value("price") == 1.0
+        assert other_process_cache.get_real_value("price") == 1.0
+    assert reads == []
+
+    other_process_cache.set_real_value("price", 2.0)
+    assert cache.get_real_value("price") == 2.0
+    assert cache.get_real_value("price") == 2.0
+    assert reads.count(cache) == 1
+
@@ -0,0 +1,68 @@
+import csv
+import datetime
+import glob
+import gzip
+import os
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+UTC = datetime.timezone.utc
+
+
+def reading(spot_id, reading_id, timestamp):
+    return {
+        "station_id": 7,
+        "spot_id": spot_id,
+        "sensor_reading_id": reading_id,
+        "is_occupied": True,
+        "sensor_reading_timestamp": timestamp,
+        "battery_level": 0.5,
+    }
+
+
+def exported_reading_ids(output_dir):
+    reading_ids = []
+    for path in glob.glob(os.path.join(output_dir, "spot_state", "*", "station_id=7", "*.csv.gz")):
+        with gzip.open(path, "rt", newline="") as f:
+            reading_ids += [int(row["sensor_reading_id"]) for row in csv.DictReader(f)]
+    return sorted(reading_ids)
+
+
+def test_rows_ingested_late_with_older_timestamps_are_exported(cloud_models, tmp_path):
+    from cloud.export import export
+    day = datetime.datetime(2026, 10, 1, 12, tzinfo=UTC)
+    with cloud_models.transaction():
+        cloud_models.SpotStateData.bulk_add(7, [reading(0, i, day + datetime.timedelta(minutes=i)) for i in range(5)])
+    export(str(tmp_path), ["spot_state"], "csv")
+    assert exported_reading_ids(tmp_path) == [0, 1, 2, 3, 4]
+
+    # backlog of a station after an outage: older than everything exported so far, from another day as well
+    with cloud_models.transaction():
+        cloud_models.SpotStateData.bulk_add(7, [
+            reading(1, 100, day - datetime.timedelta(hours=1)),
+            reading(1, 101, day - datetime.timedelta(days=1)),
+        ])
+    export(str(tmp_path), ["spot_state"], "csv")
+    assert exported_reading_ids(tmp_path) == [0, 1, 2, 3, 4, 100, 101]
+
+    export(str(tmp_path), ["spot_state"], "csv")
+    assert exported_reading_ids(tmp_path) == [0, 1, 2, 3, 4, 100, 101]
+
+
+def test_rows_are_ingested_while_the_export_writes_a_page(cloud_models, monkeypatch):
+    from cloud import export
+    monkeypatch.setattr(export, "FETCH_SIZE", 2)
+    day = datetime.datetime(2026, 10, 2, 12, tzinfo=UTC)
+    with cloud_models.transaction():
+        cloud_models.SpotStateData.bulk_add(7, [reading(2, 200 + i, day) for i in range(5)])
+    table = cloud_models.SpotStateData.__table__
+    pages = export.read_pages(7, table, None)
+    rows, _ = next(pages)
+    assert len(rows) == 2
+    # the shard isn't locked by the export in the middle of a page
+    with cloud_models.transaction():
+        cloud_models.SpotStateData.bulk_add(7, [reading(2, 300, day)])
+    reading_id_index = [column.name for column in table.columns].index("sensor_reading_id")
+    assert 300 in [row[reading_id_index] for rows, _ in export.read_pages(7, table, None) for row in rows]
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("zmq")
+pytest.importorskip("sqlalchemy")
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.sent = []
+
+    def send_multipart(self, frames):
+        self.sent.append(frames)
+
+
+@pytest.fixture
+def link_server(cloud_models):
+    from cloud.instrumentation import get_instrumentation
+    from cloud.link import LinkServer
+    server = LinkServer("inproc://test-link", get_instrumentation("test_link"))
+    for name in ("router", "backend", "priority_backend"):
+        getattr(server, name).close()
+        setattr(server, name, RecordingSocket())
+    yield server
+
+
+def sent_sequences(socket):
+    return [int(frames[1]) for frames in socket.sent]
+
+
+def test_messages_of_one_station_are_processed_one_at_a_time_priority_first(link_server):
+    from cloud.link import DATA, PRIORITY
+    identity = b"station-3"
+    link_server._on_station_message(identity, DATA, b"1", b"", b"{}")
+    link_server._on_station_message(identity, DATA, b"2", b"", b"{}")
+    link_server._on_station_message(identity, PRIORITY, b"3", b"", b"{}")
+    # waits for the data message of the same station
+    assert sent_sequences(link_server.backend) == [1]
+    assert sent_sequences(link_server.priority_backend) == []
+
+    link_server._on_processed(DATA, identity, b"1", b"2")
+    assert sent_sequences(link_server.priority_backend) == [3]
+    assert sent_sequences(link_server.backend) == [1]
+    # a resend of the priority message in progress is not processed twice
+    link_server._on_station_message(identity, PRIORITY, b"3", b"", b"{}")
+    assert sent_sequences(link_server.priority_backend) == [3]
+
+    link_server._on_processed(PRIORITY, identity, b"3", b"2")
+    assert sent_sequences(link_server.backend) == [1, 2]
+    # other stations don't wait
+    link_server._on_station_message(b"station-4", PRIORITY, b"1", b"", b"{}")
+    assert sent_sequences(link_server.priority_backend) == [3, 1]
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+def store_unsent_readings(engine, number_of_readings):
+    from edge.models import SpotSensorData, Status
+    with engine.begin() as connection:
+        connection.execute(SpotSensorData.__table__.insert(), [
+            {"spot_id": i % 5, "is_occupied": True, "battery_level": 0.5, "sent_status": Status.created}
+            for i in range(number_of_readings)
+        ])
+
+
+@pytest.mark.parametrize("policy", ["downsample", "priority"])
+def test_budget_checks_at_constant_file_size_dont_keep_dropping_readings(station_database, tmp_path, policy):
+    from edge.models import SpotSensorData
+    from edge.outbox import OutboxBudget, get_db_size
+    store_unsent_readings(station_database.engine, 20000)
+    budget = OutboxBudget(max_readings=10 ** 6, max_db_size=get_db_size(), policy=policy)
+    budget.enforce()
+    remaining = SpotSensorData.count_unsent()
+    assert remaining == 10000
+    file_size = os.path.getsize(tmp_path / "station.db")
+
+    for _ in range(3):
+        budget.enforce()
+    assert SpotSensorData.count_unsent() == remaining
+    assert os.path.getsize(tmp_path / "station.db") == file_size
+
+
+def test_budget_is_enforced_again_once_the_db_grew(station_database):
+    from edge.models import SpotSensorData
+    from edge.outbox import OutboxBudget, get_db_size
+    store_unsent_readings(station_database.engine, 20000)
+    budget = OutboxBudget(max_readings=10 ** 6, max_db_size=get_db_size() // 2, policy="downsample")
+    budget.enforce()
+    assert SpotSensorData.count_unsent() == 10000
+    assert budget.is_full
+
+    store_unsent_readings(station_database.engine, 10000)
+    budget.enforce()
+    assert SpotSensorData.count_unsent() == 10000
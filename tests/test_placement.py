@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("pytz")
+
+
+def test_refresh_picks_up_spot_updated_between_refreshes(cloud_models):
+    from cloud.placement import PlacementIndex
+    CurrentSpotState = cloud_models.CurrentSpotState
+    with cloud_models.transaction():
+        CurrentSpotState.initialize_spots(1, [0, 1])
+    placement_index = PlacementIndex(station_locations={})
+    assert placement_index.refresh() == 2
+    assert placement_index.best_spot() is None  # no bikes parked yet
+
+    # within the same second as the first refresh
+    with cloud_models.transaction():
+        CurrentSpotState.get_spot_state(1, 1).update_occupied_and_battery_state(is_occupied=True, battery_level=0.8)
+    cloud_models.release_session()
+    assert placement_index.refresh() == 1
+    assert placement_index.best_spot() == (1, 1)
+
+    with cloud_models.transaction():
+        CurrentSpotState.get_spot_state(1, 0).update_occupied_and_battery_state(is_occupied=True, battery_level=0.9)
+    cloud_models.release_session()
+    assert placement_index.refresh() == 1
+    assert placement_index.best_spot() == (1, 0)
+    assert placement_index.refresh() == 0
+
+
+def test_station_without_location_is_ranked_last(cloud_models):
+    ReservationStatus = cloud_models.ReservationStatus
+    from cloud.placement import PlacementIndex
+    placement_index = PlacementIndex(station_locations={1: (52.52, 13.40)})
+    placement_index.update_spot(0, True, ReservationStatus.no_reservation, 1.0, station_id=2)  # no location
+    placement_index.update_spot(0, True, ReservationStatus.no_reservation, 0.2, station_id=1)
+    assert placement_index.best_spot(user_location=(52.51, 13.32)) == (1, 0)
+    assert placement_index.best_spots([(52.51, 13.32)] * 3) == [(1, 0), (2, 0), None]
+
+
+def test_stations_number_their_changes_with_counters_of_their_own(cloud_models):
+    from cloud.placement import PlacementIndex
+    CurrentSpotState = cloud_models.CurrentSpotState
+    with cloud_models.transaction():
+        CurrentSpotState.initialize_spots(21, [0])
+        CurrentSpotState.initialize_spots(22, [0])
+    placement_index = PlacementIndex(station_locations={})
+    placement_index.refresh()
+
+    for battery_level in (0.1, 0.2, 0.3):
+        with cloud_models.transaction():
+            CurrentSpotState.get_spot_state(21, 0).update_occupied_and_battery_state(True, battery_level)
+    with cloud_models.transaction():
+        CurrentSpotState.get_spot_state(22, 0).update_occupied_and_battery_state(True, 0.99)
+    cloud_models.release_session()
+    assert CurrentSpotState.get_spot_state(21, 0).change_number == 4
+    assert CurrentSpotState.get_spot_state(22, 0).change_number == 2
+    assert placement_index.refresh() == 2
+    assert placement_index.best_spot() == (22, 0)
+    assert placement_index.refresh() == 0
+
+
+def test_counter_of_a_station_continues_after_numbers_of_the_shared_counter(cloud_models):
+    CurrentSpotState = cloud_models.CurrentSpotState
+    with cloud_models.transaction():
+        CurrentSpotState.initialize_spots(23, [0, 1])
+    # numbered before stations had counters of their own
+    with cloud_models.engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE current_spot_state SET change_number = 41 WHERE station_id = 23")
+        connection.exec_driver_sql("DELETE FROM change_counter WHERE name = 'current_spot_state:23'")
+    cloud_models.release_session()
+    with cloud_models.transaction():
+        CurrentSpotState.get_spot_state(23, 1).update_occupied_and_battery_state(True, 0.5)
+    cloud_models.release_session()
+    assert CurrentSpotState.get_spot_state(23, 1).change_number == 42
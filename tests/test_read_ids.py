@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+def test_read_ids_are_not_reused_after_all_readings_were_deleted(station_database):
+    from edge.models import SpotSensorData, transaction
+    with transaction():
+        last_read_id = max(SpotSensorData(spot_id=spot_id, is_occupied=True).add().read_id for spot_id in range(5))
+    with station_database.engine.begin() as connection:
+        connection.execute(SpotSensorData.__table__.delete())
+    with transaction():
+        new_read_id = SpotSensorData(spot_id=0, is_occupied=False).add().read_id
+    assert new_read_id > last_read_id
+    assert SpotSensorData.get_latest_per_spot_after(last_read_id) == [(0, False, None)]
+
+
+def test_schema_version_1_table_is_migrated(station_database):
+    from edge.models import ensure_schema
+    with station_database.engine.begin() as connection:
+        connection.exec_driver_sql("DROP TABLE spot_sensor_reading")
+        connection.exec_driver_sql(
+            "CREATE TABLE spot_sensor_reading (read_id INTEGER NOT NULL, read_timestamp DATETIME, "
+            "update_timestamp DATETIME, spot_id INTEGER NOT NULL, is_occupied BOOLEAN, battery_level REAL, "
+            "sent_status VARCHAR(9), PRIMARY KEY (read_id))"
+        )
+        connection.exec_driver_sql("INSERT INTO spot_sensor_reading (read_id, spot_id) VALUES (7, 1)")
+        connection.exec_driver_sql("PRAGMA user_version=1")
+    assert ensure_schema()
+    with station_database.engine.connect() as connection:
+        sql = connection.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE name = 'spot_sensor_reading'"
+        ).scalar()
+        assert "AUTOINCREMENT" in sql
+        assert connection.exec_driver_sql("SELECT read_id, spot_id FROM spot_sensor_reading").fetchall() == [(7, 1)]
@@ -0,0 +1,59 @@
+import datetime
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+
+@pytest.fixture
+def simulated_clock():
+    from edge.clock import SimulatedClock, SystemClock, set_clock
+    clock = SimulatedClock(start=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+    set_clock(clock)
+    yield clock
+    set_clock(SystemClock())
+
+
+def test_confirmed_reservation_finishes_on_simulated_time(station_database, simulated_clock):
+    from edge.models import Reservation, ReservationStatus, session, transaction
+    from edge.timeutil import utcnow
+    with transaction():
+        Reservation(
+            reservation_id=1, spot_id=0, duration_in_seconds=60, status=ReservationStatus.reservation_confirmed,
+            confirmed_at=utcnow(), response_sent=True,
+        ).add()
+
+    def number_of_finished():
+        return session.query(Reservation).filter(Reservation.finished_condition()).count()
+
+    # decades before the wall clock, the db's now would have expired it long ago
+    assert number_of_finished() == 0
+    simulated_clock.advance(59)
+    assert number_of_finished() == 0
+    simulated_clock.advance(2)
+    assert number_of_finished() == 1
+
+
+def test_request_expires_on_the_station_clock_from_when_the_station_read_it(station_database, simulated_clock):
+    from edge.bike_station.admission import AdmissionEngine
+    from edge.models import Reservation, transaction
+    from edge.timeutil import utcnow
+
+    def read_open_request():
+        with transaction():
+            Reservation.stamp_received_requests()
+            (request,) = Reservation.get_open_reservation_request_summaries()
+        return request
+
+    # stored by the server process, whose clock isn't the station's
+    Reservation.add_new({1: (0, 60)})
+    simulated_clock.advance(3600)
+    request = read_open_request()
+    assert request.received_timestamp == utcnow()
+    assert not AdmissionEngine.request_expired(request.received_timestamp, request.duration_in_seconds, utcnow())
+
+    simulated_clock.advance(59)
+    assert read_open_request().received_timestamp == request.received_timestamp
+    assert not AdmissionEngine.request_expired(request.received_timestamp, request.duration_in_seconds, utcnow())
+    simulated_clock.advance(1)
+    assert AdmissionEngine.request_expired(request.received_timestamp, request.duration_in_seconds, utcnow())
@@ -0,0 +1,29 @@
+from edge.ring_outbox import RingOutbox
+
+
+def test_close_after_appending_and_consuming(tmp_path):
+    path = str(tmp_path / "readings.ring")
+    outbox = RingOutbox(path, capacity=4)
+    for spot_id in range(6):
+        outbox.append(spot_id, True, 0.5)
+    batch = outbox.peek(3)
+    outbox.consume(batch[-1].read_id)
+    assert outbox.latest_per_spot_after(0)
+    outbox.flush()
+    outbox.close()
+
+    reopened = RingOutbox(path)
+    assert reopened.capacity == 4
+    assert [reading.read_id for reading in reopened.peek(10)] == [6]
+    reopened.close()
+
+
+def test_full_ring_overwrites_oldest_unsent_reading(tmp_path):
+    outbox = RingOutbox(str(tmp_path / "readings.ring"), capacity=3)
+    read_ids = [outbox.append(0, spot_id % 2 == 0, None) for spot_id in range(5)]
+    assert outbox.depth() == 3
+    readings = outbox.peek(10)
+    assert [reading.read_id for reading in readings] == read_ids[2:]
+    assert readings[0].battery_level is None
+    outbox.close()
+
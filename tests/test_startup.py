@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_importing_the_models_doesnt_open_storage(tmp_path):
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT,
+        "outbox_backend": "ring",
+        "reservation_log": str(tmp_path / "reservation_log"),
+    }
+    subprocess.run([sys.executable, "-c", "import edge.models"], cwd=tmp_path, env=env, check=True)
+    assert list(tmp_path.iterdir()) == []
+
+    subprocess.run(
+        [sys.executable, "-c", "import edge.models; edge.models.current_ring_outbox().close()"],
+        cwd=tmp_path, env=env, check=True,
+    )
+    assert [path.name for path in tmp_path.iterdir()] == ["readings.ring"]